@@ -0,0 +1,123 @@
+import time
+import base64
+import subprocess
+from pathlib import Path
+from textwrap import dedent
+
+from jobman import gcloud
+from jobman.fingerprint import DISK_DIR, MEM_DIR
+from jobman.utils import setup_logger
+
+# Runs as root on every worker at boot, before the stages. Stage scripts run as
+# the job's SSH user so files land in the same home as with SSH-driven setup.
+BOOT_HEADER = """#!/bin/bash
+# Rendered by jobman for job {job_id}; runs on every boot of every worker
+U={user}
+PREFIX={prefix}
+W=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/agent-worker-number)
+LOG_DIR=/var/log/jobman-boot
+mkdir -p $LOG_DIR
+
+# The account gcloud / ssh.user logs in with; created here if the guest agent has not yet
+id -u $U >/dev/null 2>&1 || useradd -m -s /bin/bash $U
+echo "$U ALL=(ALL) NOPASSWD:ALL" > /etc/sudoers.d/jobman-$U
+
+# report <stage> <state> <fingerprint>: one object per worker and stage in the bucket
+report() {{
+    echo "w$W $1 $2 $3" | gcloud storage cp - "$PREFIX/w$W-$1" >/dev/null 2>&1 || true
+}}
+
+# run_stage <stage> <fingerprint> <marker dir> <base64 script>: skipped if the marker matches
+run_stage() {{
+    if [ "$(sudo -u $U -H bash -c "cat $3/$1 2>/dev/null")" = "$2" ]; then
+        report $1 done $2
+        return
+    fi
+    report $1 running $2
+    if echo "$4" | base64 -d | sudo -u $U -H bash -l > $LOG_DIR/$1.log 2>&1; then
+        sudo -u $U -H bash -c "mkdir -p $3 && echo $2 > $3/$1"
+        report $1 done $2
+    else
+        report $1 failed $2
+    fi
+}}
+"""
+
+class Bootstrap:
+    """
+    Renders one startup script from the job config that sets each worker up
+    while it boots, instead of pushing every stage over SSH after allocation.
+
+    Each stage writes the same fingerprint marker an SSH-driven stage would
+    (see StageMarkers), so `Job.setup` skips it afterwards, and reports its
+    progress to `gs://<bucket>/jobman/boot/<tpu>/<job id>/` for `wait` to poll.
+    The script reruns on every boot, so a preempted slice that comes back
+    sets itself up again.
+    """
+
+    def __init__(self, cfg, stages, user):
+        self.cfg = cfg
+        # [(name, fingerprint, volatile, script)]
+        self.stages = stages
+        self.user = user
+        self.prefix = f"gs://{cfg.gcsfuse.bucket_name}/jobman/boot/{cfg.tpu.name}/{cfg.job.id}"
+        self.file = Path(cfg.job.dir) / "bootstrap.sh"
+
+        self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
+
+    def render(self):
+        """Write the startup script to the job dir (read by TPU.request) and clear old progress."""
+        parts = [BOOT_HEADER.format(job_id=self.cfg.job.id, user=self.user, prefix=self.prefix)]
+        startup = self.cfg.tpu.get("startup_script", None)
+        if startup:
+            path = Path(startup).expanduser()
+            parts.append("# tpu.startup_script\n" + (path.read_text() if path.is_file() else startup))
+        for name, fp, volatile, script in self.stages:
+            b64 = base64.b64encode(dedent(script).encode()).decode()
+            # Quoted: `~` must expand as the job user, not root. Stages run in parallel; the
+            # scripts' apt calls go through APT_GET, so they take turns on its lock
+            parts.append(f"run_stage {name} {fp} '{MEM_DIR if volatile else DISK_DIR}' {b64} &")
+        parts.append("wait\n")
+        self.file.write_text("\n".join(parts))
+        gcloud.run(["gcloud", "storage", "rm", "-r", self.prefix], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.logger.info(f"Rendered boot-time setup ({', '.join(s[0] for s in self.stages)}) to {self.file}")
+        return self.file
+
+    def progress(self):
+        """{(worker, stage): (state, fingerprint)} as reported so far."""
+        result = gcloud.run(["gcloud", "storage", "cat", f"{self.prefix}/*"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        states = {}
+        for line in (result.stdout or "").splitlines():
+            parts = line.split()
+            if len(parts) == 4 and parts[0].startswith("w") and parts[0][1:].isdigit():
+                states[(int(parts[0][1:]), parts[1])] = (parts[2], parts[3])
+        return states
+
+    def wait(self, workers, timeout=1800, interval=15, cancelled=None):
+        """
+        Poll the reports until every worker finished every stage (or failed it).
+        Returns True if all stages are done; stages that are not will run over SSH.
+        """
+        workers = list(workers)
+        expected = {(i, name): fp for i in workers for name, fp, _, _ in self.stages}
+        self.logger.info(f"Waiting for {len(workers)} workers to set themselves up at boot...")
+        start = time.monotonic()
+        seen = {}
+        while True:
+            states = self.progress()
+            for key, state in sorted(states.items()):
+                if key in expected and seen.get(key) != state:
+                    seen[key] = state
+                    self.logger.info(f"Worker {key[0]}: boot stage {key[1]} {state[0]}")
+            finished = {k for k, fp in expected.items() if states.get(k, (None, None))[1] == fp and states[k][0] in {"done", "failed"}}
+            if len(finished) == len(expected):
+                done = sum(1 for k in finished if states[k][0] == "done")
+                self.logger.info(f"Boot-time setup finished in {time.monotonic() - start:.0f}s: {done}/{len(expected)} worker stages done")
+                return done == len(expected)
+            if time.monotonic() - start > timeout:
+                self.logger.warning(f"Boot-time setup still incomplete after {timeout}s ({len(finished)}/{len(expected)} worker stages finished)")
+                return False
+            if cancelled is not None and cancelled.wait(interval):
+                return False
+            elif cancelled is None:
+                time.sleep(interval)
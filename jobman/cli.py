@@ -13,13 +13,11 @@ from jobman.profilers.storage_report import main as run_storage_report
 def get_cfg(job_id):
     jm = JobMan()  
     user = os.environ.get("USER")
-    key = f'job_{job_id}'
     
-    with jm.with_meta_lock() as meta:
-        if key not in meta:
-            raise KeyError(f"Job ID not found: {job_id}")
-        
-    job_meta = meta[key]
+    job_meta = jm.get_job_meta(job_id)
+    if job_meta is None:
+        raise KeyError(f"Job ID not found: {job_id}")
+    
     owner = job_meta['user']
     if owner != user:
         raise PermissionError(f"Meta owner mismatch for {job_id}: owner={owner}, current_user={user}")
@@ -70,6 +68,64 @@ def list_jobs():
     jm = JobMan()
     jm.list_jobs()
     
+@cli.command(name="daemon")
+@click.option("--max-jobs", default=64, show_default=True, help="Max jobs driven concurrently")
+@click.option("--max-procs", default=64, show_default=True, help="Max concurrent gcloud/ssh/scp calls (the job command itself is not limited)")
+@click.option("--per-worker", default=4, show_default=True, help="Max concurrent calls to one TPU worker")
+def daemon(max_jobs, max_procs, per_worker):
+    """Run the supervisor daemon that drives all jobs in one process."""
+    from jobman.jobman import jobman_dir
+    from jobman.daemon import Supervisor
+    from jobman.engine import engine
+    engine.configure(max_concurrency=max_procs, per_destination=per_worker)
+    jm = JobMan()
+    Supervisor(jm, jobman_dir / "daemon.sock", max_jobs=max_jobs).run()
+
+@cli.command(name="pool")
+@click.option("--reap", is_flag=True, help="Delete idle slices whose TTL has expired")
+def pool(reap):
+    """List the warm TPU pool."""
+    import time
+    from tabulate import tabulate
+    jm = JobMan()
+    if reap:
+        jm.pool.reap()
+    rows = []
+    for s in jm.store.list_slices():
+        if s["owner"] is not None:
+            state = f"LEASED ({s['owner']})"
+        else:
+            state = f"IDLE ({max(0, int(s['expires_at'] - time.time()))}s left)"
+        rows.append([s["name"], s["accelerator"], s["zone"], s["version"], s["pricing"], s.get("released_by"), state])
+    headers = ["TPU", "Accelerator", "Zone", "Version", "Pricing", "Released By", "State"]
+    print(tabulate(rows, headers=headers, tablefmt="github"))
+
+@cli.command(name="release")
+@click.argument("job_id")
+@click.option("--ttl", type=int, default=None, help="Seconds to keep the slice warm (default: tpu.pool.ttl or 1800)")
+def release(job_id, ttl):
+    """Release a finished job's READY TPU to the warm pool."""
+    from jobman.tpu import TPU
+    jm = JobMan()
+    cfg = get_cfg(job_id)
+    status = TPU(cfg)._check_tpu_vm_status()
+    if status not in {"READY", "ACTIVE"}:
+        raise click.ClickException(f"TPU {cfg.tpu.name} is {status}; only READY slices can be pooled.")
+    jm.pool.release(cfg, ttl=ttl)
+
+@cli.command(name="ledger")
+@click.argument("job_id")
+def ledger(job_id):
+    """Summarize gcloud calls recorded for a job."""
+    from tabulate import tabulate
+    from jobman.gcloud import summarize_ledger
+    cfg = get_cfg(job_id)
+    ledger_file = Path(cfg.job.dir) / "logs" / "gcloud_ledger.jsonl"
+    if not ledger_file.exists():
+        raise FileNotFoundError(f"No gcloud ledger found at {ledger_file}")
+    headers = ["Command", "Calls", "Exec", "Cached", "Coalesced", "Failed", "Total (s)", "Max (s)"]
+    print(tabulate(summarize_ledger(ledger_file), headers=headers, tablefmt="github"))
+    
 @cli.command()
 def billing():
     """Run billing report profiler."""
@@ -126,6 +182,50 @@ def gcsfuse(job_id):
     gcsfuse = GCSFUSE(cfg)
     gcsfuse.setup()
     
+@cli.command(name="gcsfuse-bench")
+@click.argument("job_id")
+@click.option("--size-mb", default=1024, show_default=True, help="Size of the file written and read back")
+@click.option("--files", default=500, show_default=True, help="Small files created for the metadata test")
+def gcsfuse_bench(job_id, size_mb, files):
+    """Benchmark the job's GCSFuse mount on every worker."""
+    from tabulate import tabulate
+    from jobman.gcsfuse import GCSFUSE
+    cfg = get_cfg(job_id)
+    gcsfuse = GCSFUSE(cfg)
+    rows = []
+    for r in gcsfuse.bench(size_mb=size_mb, files=files):
+        rows.append([r["worker"], r["profile"]] + [
+            f"{r[k]:.0f}" if k in r else "failed"
+            for k in ["write_mbps", "seq_read_mbps", "warm_read_mbps", "rand_read_iops", "meta_ops"]
+        ])
+    headers = ["Worker", "Profile", "Write (MB/s)", "Seq read (MB/s)", "Warm read (MB/s)", "Rand 64K (IOPS)", "Metadata (ops/s)"]
+    print(tabulate(rows, headers=headers, tablefmt="github"))
+    
+@cli.command(name="data")
+@click.argument("job_id")
+def data(job_id):
+    """Stage each worker's shard of the job's dataset to local disk."""
+    from jobman.data import DATA
+    cfg = get_cfg(job_id)
+    data = DATA(cfg)
+    data.setup()
+    
+@cli.command(name="sync")
+@click.argument("job_id")
+@click.argument("local_dir", type=click.Path(exists=True, file_okay=False))
+@click.argument("remote_dir")
+def sync(job_id, local_dir, remote_dir):
+    """Push changed files of LOCAL_DIR to REMOTE_DIR on every worker of a running job."""
+    from jobman.sync import SYNC
+    cfg = get_cfg(job_id)
+    stats = SYNC(cfg).sync(local_dir, remote_dir)
+    sent = sum(s[2] for s in stats.values())
+    updated = sum(1 for s in stats.values() if s[0] or s[1])
+    click.echo(
+        f"{updated}/{len(stats)} workers updated: {max(s[0] for s in stats.values())} changed, "
+        f"{max(s[1] for s in stats.values())} deleted files, {sent / 1024:.0f} KiB sent"
+    )
+    
 @cli.command(name="docker")
 @click.argument("job_id")
 def docker(job_id):
@@ -151,4 +251,7 @@ def venv(job_id):
     from jobman.venv import VENV
     cfg = get_cfg(job_id)
     venv = VENV(cfg)
-    venv.setup()  
\ No newline at end of file
+    venv.setup()
+
+if __name__ == "__main__":
+    cli()
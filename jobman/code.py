@@ -0,0 +1,167 @@
+import os
+import gzip
+import time
+import hashlib
+import tarfile
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+from jobman import gcloud
+from jobman.remote import Remote
+from jobman.fingerprint import fingerprint
+from jobman.utils import APT_GET, setup_logger
+
+def remote_path(d):
+    """`~` becomes `$HOME`, so the path also expands inside docker, `bash -c` and assignments."""
+    return "$HOME" + d[1:] if d.startswith("~") else d
+
+def remote_code_dir(cfg):
+    """Where workers unpack `job.code_dir`."""
+    return remote_path(cfg.job.get("code_remote_dir", None) or f"~/code/{cfg.job.name}")
+
+def tree_files(root):
+    """Relative paths under `root`, sorted: git's view (tracked + untracked, minus ignored) if it is a repo."""
+    root = Path(root)
+    result = subprocess.run(
+        ["git", "-C", str(root), "ls-files", "-co", "--exclude-standard", "-z"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    if result.returncode == 0:
+        paths = [p for p in result.stdout.decode().split("\0") if p]
+    else:
+        paths = [
+            str(Path(d, name).relative_to(root))
+            for d, dirs, names in os.walk(root)
+            if ".git" not in Path(d).relative_to(root).parts
+            for name in names
+        ]
+    # Deleted but still tracked files are listed by git
+    return sorted(p for p in paths if os.path.lexists(root / p))
+
+def file_digest(path):
+    """Hash of a file's mode and content (a symlink's target); what the snapshot and sync compare."""
+    st = os.lstat(path)
+    h = hashlib.sha256(oct(st.st_mode).encode() + b"\0")
+    if os.path.islink(path):
+        h.update(os.readlink(path).encode())
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+def add_file(tar, root, rel):
+    """Add root/rel to `tar` with fixed metadata, so the same tree always gives the same bytes."""
+    info = tar.gettarinfo(str(Path(root) / rel), arcname=rel)
+    info.mtime, info.uid, info.gid, info.uname, info.gname = 0, 0, 0, "", ""
+    if info.isfile():
+        with open(Path(root) / rel, "rb") as f:
+            tar.addfile(info, f)
+    else:
+        tar.addfile(info)
+
+class CODE:
+    """
+    Ships the local working tree in `job.code_dir` to every worker: it is packed
+    once into a reproducible tarball named by its content hash, uploaded to the
+    bucket unless a job already did, and each worker downloads it itself.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        code_dir = cfg.job.get("code_dir", None)
+        self.local_dir = Path(code_dir).expanduser().resolve() if code_dir else None
+        self.remote_dir = remote_code_dir(cfg)
+        self.env_var = cfg.job.get("code_env_var", "JOBMAN_CODE_DIR")
+        self.remote = Remote(cfg)
+        self.digest_lock = threading.Lock()
+        self.digest = None
+        self.upload_lock = threading.Lock()
+        self.uploaded = None
+
+        self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
+
+    @property
+    def enabled(self):
+        return self.local_dir is not None
+
+    def files(self):
+        return tree_files(self.local_dir)
+
+    def snapshot_digest(self):
+        """Content hash of the tree (paths, modes, contents); computed once per job."""
+        with self.digest_lock:
+            if self.digest is None:
+                h = hashlib.sha256()
+                for rel in self.files():
+                    h.update(f"{rel}\0{file_digest(self.local_dir / rel)}\0".encode())
+                self.digest = h.hexdigest()[:16]
+            return self.digest
+
+    def uri(self):
+        base = self.cfg.job.get("code_uri", None) or f"gs://{self.cfg.gcsfuse.bucket_name}/jobman/code"
+        return f"{base.rstrip('/')}/{self.snapshot_digest()}.tar.gz"
+
+    def fingerprint(self):
+        return fingerprint("code", self.snapshot_digest(), self.remote_dir)
+
+    def _pack(self, out):
+        with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as gz, tarfile.open(fileobj=gz, mode="w") as tar:
+            for rel in self.files():
+                add_file(tar, self.local_dir, rel)
+
+    def ensure_snapshot(self):
+        """Upload the snapshot unless it is already in GCS; returns True if this call uploaded it."""
+        with self.upload_lock:
+            if self.uploaded is None:
+                try:
+                    self.uploaded = self._ensure_snapshot()
+                except Exception as e:
+                    # Remembered so the other workers fail fast
+                    self.uploaded = e
+            if isinstance(self.uploaded, Exception):
+                raise self.uploaded
+            return self.uploaded
+
+    def _ensure_snapshot(self):
+        uri = self.uri()
+        if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            self.logger.info(f"Using code snapshot {uri}")
+            return False
+
+        start = time.monotonic()
+        with tempfile.NamedTemporaryFile(prefix="jobman-code-", suffix=".tar.gz") as f:
+            self._pack(f)
+            f.flush()
+            size = f.tell()
+            gcloud.run(["gcloud", "storage", "cp", f.name, uri], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.logger.info(f"Uploaded code snapshot {uri} ({size / 2**20:.1f} MB) in {time.monotonic() - start:.0f}s")
+        return True
+
+    def _setup_worker(self, i):
+        self.ensure_snapshot()
+        log_file = Path(self.cfg.job.dir) / "logs" / f"code_worker_{i}.log"
+        # Unpacked next to the target so a failed download leaves the old tree, then synced
+        # over it in place: the directory itself must stay, a running container bind-mounts it
+        cmd = f"""
+            set -eo pipefail
+            D={self.remote_dir}
+            rm -rf $D.jobman-tmp && mkdir -p $D.jobman-tmp $D
+            gcloud storage cp {self.uri()} - | tar -xzf - -C $D.jobman-tmp
+            command -v rsync >/dev/null || {APT_GET} install -y rsync
+            rsync -a --delete $D.jobman-tmp/ $D/
+            rm -rf $D.jobman-tmp
+        """
+        start = time.monotonic()
+        with open(log_file, "w") as f:
+            try:
+                self.remote.run(i, cmd, check=True, stdout=f, stderr=f)
+            except Exception as e:
+                self.logger.error(f"Worker {i}: Code snapshot download failed: {e}")
+                raise
+        self.logger.info(f"Worker {i}: code snapshot {self.snapshot_digest()} unpacked to {self.remote_dir} in {time.monotonic() - start:.0f}s")
+
+    def patch_command(self, cmd):
+        return f"export {self.env_var}={self.remote_dir} && {cmd}"
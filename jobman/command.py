@@ -1,3 +1,6 @@
+import time
+import uuid
+import asyncio
 import argparse
 import subprocess
 import concurrent.futures
@@ -5,8 +8,26 @@ from pathlib import Path
 from textwrap import dedent
 from omegaconf import OmegaConf
 from collections.abc import Iterable
+from jobman.engine import engine
+from jobman.remote import Remote
 from jobman.utils import setup_logger
 
+# Barrier files for synchronized launches; mounted into docker containers at the same path
+LAUNCH_DIR = "/tmp/jobman-launch"
+
+# <LAUNCH_DIR>/<token>/barrier.sh: runs right before the command on every worker. Signals
+# that the worker is staged, waits for the start time (ns since epoch) to be broadcast,
+# sleeps until then and records when it actually started. Every launch has its own
+# directory, so launches of other jobs on the same slice do not touch each other's files.
+BARRIER = dedent("""
+    D=$(dirname "$0")
+    touch "$D/ready"
+    while [ ! -s "$D/go" ]; do sleep 0.05; done
+    ns=$(( $(cat "$D/go") - $(date +%s%N) ))
+    if [ $ns -gt 0 ]; then sleep "$(printf '%d.%09d' $((ns / 1000000000)) $((ns % 1000000000)))"; fi
+    date +%s%N > "$D/start"
+""")
+
 class COMMAND:
     
     def __init__(self, cfg):
@@ -14,6 +35,10 @@ class COMMAND:
         self.base_cmd = cfg.command.cmd
         self.full_cmd = None
         self.workers = self.infer_workers() 
+        self.remote = Remote(cfg)
+        # Start every worker's process at one broadcast instant instead of as each SSH session comes up
+        self.sync_start = cfg.command.get("sync_start", False)
+        self.token = None
         
         self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
         
@@ -55,41 +80,115 @@ class COMMAND:
             self.full_cmd = self.base_cmd
         self.logger.debug("Executing command:")
         self.logger.debug(self.full_cmd) 
-        all_success = True
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
-            futures = {executor.submit(self.run_worker, i): i for i in self.workers}
-            for future in concurrent.futures.as_completed(futures):
-                i = futures[future]
-                if not future.result():
-                    all_success = False
+        if self.remote.relay_groups(self.workers) is not None:
+            self.logger.info(f"Dispatching command through {self.remote.relays} relay worker(s)")
+        log_dir = Path(self.cfg.job.dir) / "logs"
+        files = {i: open(log_dir / f"main_command_worker_{i}.log", "a") for i in self.workers}
+        try:
+            if self.token is not None and not self.stage_launch():
+                return False
+            # Not bounded by the engine's concurrency limit: every worker's process must start
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(
+                    self.remote.run_all, self.workers, f"stdbuf -oL -eL {self.full_cmd}", files,
+                    timeout=self.cfg.command.get("timeout", None), bounded=False,
+                )
+                if self.token is not None:
+                    self.trigger_launch(future)
+                codes = future.result()
+        finally:
+            if self.token is not None:
+                self._run_each(f"rm -rf {self.launch_dir()}")
+            self.token = None
+            for f in files.values():
+                f.close()
+        for i in self.workers:
+            if codes.get(i) != 0:
+                self.logger.error(f"Worker {i}: command failed (exit {codes.get(i)}).")
+        all_success = all(codes.get(i) == 0 for i in self.workers)
 
         if all_success:
             self.logger.info("Command ran successfully on all workers.")
         else:
             self.logger.warning("Command failed on one or more workers.")
         return all_success
-    
-    def run_worker(self, i):
-        self.logger.info(f"Worker {i}: Launching command")  
-
-        ssh_cmd = [
-            "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-            "--zone", self.cfg.tpu.zone,
-            f"--worker={i}",
-            "--ssh-key-file", str(self.cfg.ssh.private_key),
-            "--ssh-flag=-o ConnectTimeout=15",
-            "--ssh-flag=-o StrictHostKeyChecking=no",
-            "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-            "--command", f"stdbuf -oL -eL {self.full_cmd}",
-            "--quiet",
-        ]
-
-        log_file = Path(self.cfg.job.dir) / "logs" / f"main_command_worker_{i}.log"
-        with open(log_file, "a") as f:
-            result = subprocess.run(ssh_cmd, stdout=f, stderr=f)
-            if result.returncode != 0:
-                self.logger.error(f"Worker {i}: command failed.")
-                return False
-        return True
-    
\ No newline at end of file
+
+    def barrier(self, cmd):
+        """Prefix `cmd` (before the env wraps it) with the launch barrier; see `trigger_launch`."""
+        self.token = uuid.uuid4().hex[:12]
+        return f"bash {self.launch_dir()}/barrier.sh && {cmd}"
+
+    def launch_dir(self):
+        return f"{LAUNCH_DIR}/{self.token}"
+
+    def _run_each(self, command, input=None, workers=None):
+        workers = self.workers if workers is None else workers
+        async def _run():
+            results = await asyncio.gather(*[
+                self.remote.arun(i, command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, input=input)
+                for i in workers
+            ], return_exceptions=True)
+            return dict(zip(workers, results))
+        return engine.call(_run())
+
+    def stage_launch(self):
+        """Open a session to every worker and put the barrier script in place; False if any worker failed."""
+        self.remote.open_all(self.workers)
+        d = self.launch_dir()
+        # Also drops what launches that never cleaned up (e.g. killed ones) left a day ago or more
+        results = self._run_each(
+            f"find {LAUNCH_DIR} -mindepth 1 -maxdepth 1 -mmin +1440 -exec rm -rf {{}} + 2>/dev/null; "
+            f"mkdir -p {d} && cat > {d}/barrier.sh",
+            input=BARRIER,
+        )
+        failed = [i for i, r in results.items() if isinstance(r, Exception) or r.returncode != 0]
+        if failed:
+            # Their commands would wait at the barrier for a start time that never comes
+            self.logger.error(f"Could not stage the launch barrier on workers {failed}; not launching")
+        return not failed
+
+    def trigger_launch(self, running):
+        """
+        Wait until every worker's process reached the barrier, then broadcast a
+        start time slightly in the future; each worker sleeps until that instant,
+        so processes start within the workers' clock skew of each other.
+        """
+        timeout = self.cfg.command.get("launch_timeout", 120)
+        lead = self.cfg.command.get("launch_lead", 2.0)
+        d = self.launch_dir()
+        start = time.monotonic()
+        missing = list(self.workers)
+        # Rounds of ~1s waits, so a launch whose processes already exited is not waited on
+        while missing and not running.done() and time.monotonic() - start < timeout:
+            ready = self._run_each(f"for _ in $(seq 10); do [ -e {d}/ready ] && exit 0; sleep 0.1; done; exit 1", workers=missing)
+            missing = [i for i, r in ready.items() if isinstance(r, Exception) or r.returncode != 0]
+        if running.done():
+            # Every process already exited, e.g. the env failed to start
+            return
+        if missing:
+            # Released anyway: a worker that is not waiting must not hold the others forever
+            self.logger.warning(f"Workers {missing} did not reach the launch barrier; starting the rest now")
+        else:
+            self.logger.info(f"All {len(self.workers)} workers staged in {time.monotonic() - start:.1f}s")
+
+        start_ns = time.time_ns() + int(lead * 1e9)
+        sent = self._run_each(f"echo {start_ns} > {d}/go.tmp && mv {d}/go.tmp {d}/go")
+        unsent = [i for i, r in sent.items() if isinstance(r, Exception) or r.returncode != 0]
+        if unsent:
+            self.logger.error(f"Could not send the start time to workers {unsent}")
+        if time.time_ns() > start_ns:
+            self.logger.warning(f"Start time broadcast took longer than launch_lead ({lead}s); workers start on receipt")
+
+        started = self._run_each(f"for _ in $(seq 100); do [ -s {d}/start ] && exec cat {d}/start; sleep 0.05; done; exit 1")
+        times = {
+            i: int(r.stdout.strip()) for i, r in started.items()
+            if not isinstance(r, Exception) and r.returncode == 0 and r.stdout.strip().isdigit()
+        }
+        if len(times) > 1:
+            first = min(times.values())
+            skew = (max(times.values()) - first) / 1e6
+            offsets = ", ".join(f"{i}: +{(t - first) / 1e6:.1f}" for i, t in sorted(times.items()))
+            self.logger.info(f"Launch start skew {skew:.1f} ms across {len(times)} workers (ms after first: {offsets})")
+        elif not times:
+            self.logger.warning("Could not read launch start times from the workers")
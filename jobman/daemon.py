@@ -0,0 +1,195 @@
+import json
+import signal
+import socket
+import asyncio
+from pathlib import Path
+from datetime import datetime
+from omegaconf import OmegaConf
+from concurrent.futures import ThreadPoolExecutor
+
+from jobman import gcloud
+from jobman.job import Job
+from jobman.pool import WarmPool
+from jobman.utils import setup_logger
+
+class DaemonClient:
+    """Blocking client for the supervisor's Unix-socket API (one JSON line each way)."""
+
+    def __init__(self, socket_path: Path, timeout: float = 10.0):
+        self.socket_path = Path(socket_path)
+        self.timeout = timeout
+
+    def request(self, op, **kwargs):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(str(self.socket_path))
+            sock.sendall((json.dumps({"op": op, **kwargs}) + "\n").encode())
+            with sock.makefile("r") as f:
+                response = json.loads(f.readline())
+        if not response.get("ok"):
+            raise RuntimeError(response.get("error", "daemon request failed"))
+        return response
+
+    def is_alive(self):
+        if not self.socket_path.exists():
+            return False
+        try:
+            self.request("ping")
+            return True
+        except (OSError, RuntimeError, ValueError):
+            return False
+
+class Supervisor:
+    """
+    Drives every job's `Job.run` as an asyncio task inside one process.
+
+    Jobs share the process-wide gcloud layer (coalesced describes, read cache,
+    ledger) and a bounded executor for the blocking parts of `Job.run`. Loading
+    jobs and reaping the warm pool use a separate small executor, so they still
+    run while every job slot is taken by a long (or looping) job.
+    """
+
+    def __init__(self, jm, socket_path: Path, max_jobs: int = 64):
+        self.jm = jm
+        self.socket_path = Path(socket_path)
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
+        self.control = ThreadPoolExecutor(max_workers=4, thread_name_prefix="control")
+        self.jobs = {}
+        self.tasks = {}
+        self.logger = setup_logger(log_file=self.socket_path.parent / "daemon.log", stdout=True)
+        # No controlling terminal: run gcloud calls in their own process groups so cancel can kill them
+        gcloud.gcloud.isolate = True
+
+    def running_jobs(self):
+        return sorted(job_id for job_id, task in self.tasks.items() if not task.done())
+
+    async def start_job(self, job_id):
+        if job_id in self.running_jobs():
+            raise RuntimeError(f"Job {job_id} is already running")
+
+        meta = self.jm.get_job_meta(job_id)
+        if meta is None:
+            raise KeyError(f"Job ID not found: {job_id}")
+        cfg = OmegaConf.load(Path(meta["job_dir"]) / "config.yaml")
+
+        loop = asyncio.get_running_loop()
+        job = await loop.run_in_executor(self.control, Job, cfg)
+        self.jobs[job_id] = job
+        self.tasks[job_id] = asyncio.create_task(self._drive(job_id, job))
+
+        self.jm.update_job_meta(
+            job_id,
+            status="RUNNING",
+            backend="daemon",
+            session_name=None,
+            started_at=datetime.now().isoformat(),
+        )
+        self.logger.info(f"Job {job_id} started.")
+
+    async def _drive(self, job_id, job):
+        loop = asyncio.get_running_loop()
+        try:
+            success = await loop.run_in_executor(self.executor, job.run)
+        except Exception as e:
+            self.logger.exception(f"Job {job_id} crashed: {e}")
+            success = False
+
+        if job.cancelled.is_set():
+            return
+        self.jm.update_job_meta(
+            job_id,
+            status="FINISHED" if success else "FAILED",
+            ended_at=datetime.now().isoformat()
+        )
+        self.logger.info(f"Job {job_id} ended: {'FINISHED' if success else 'FAILED'}")
+
+    def cancel_job(self, job_id, update_meta=True):
+        """Request the cancel and return the job's task without waiting for it to wind down."""
+        task = self.tasks.get(job_id)
+        if task is None or task.done():
+            raise RuntimeError(f"Job {job_id} is not running")
+
+        job = self.jobs[job_id]
+        job.cancel()
+        killed = gcloud.gcloud.terminate(job.tpu.name)
+        self.logger.info(f"Cancelling job {job_id}: terminated {killed} gcloud calls")
+
+        if update_meta:
+            self.jm.update_job_meta(job_id, status="FAILED", ended_at=datetime.now().isoformat())
+        return task
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            op = request.get("op")
+            if op == "ping":
+                response = {"ok": True}
+            elif op == "start":
+                await self.start_job(request["job_id"])
+                response = {"ok": True}
+            elif op == "cancel":
+                # Replied to right away: the job may take a while to notice
+                self.cancel_job(request["job_id"])
+                response = {"ok": True}
+            elif op == "list":
+                response = {"ok": True, "running": self.running_jobs()}
+            else:
+                response = {"ok": False, "error": f"Unknown op: {op}"}
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+        writer.close()
+
+    async def adopt_orphans(self):
+        """Restart jobs the previous daemon was driving when it stopped."""
+        for meta in self.jm.store.list_jobs():
+            if meta.get("backend") == "daemon" and meta.get("status") == "RUNNING":
+                self.logger.info(f"Adopting job {meta['job_id']} from previous daemon")
+                try:
+                    await self.start_job(meta["job_id"])
+                except Exception as e:
+                    self.logger.error(f"Failed to adopt job {meta['job_id']}: {e}")
+
+    async def reap_pool(self, interval=60):
+        """Periodically delete warm-pool slices whose TTL has expired."""
+        loop = asyncio.get_running_loop()
+        pool = WarmPool(self.jm.store)
+        while True:
+            try:
+                await loop.run_in_executor(self.control, pool.reap)
+            except Exception as e:
+                self.logger.error(f"Warm pool reaper failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def serve(self):
+        if DaemonClient(self.socket_path).is_alive():
+            raise RuntimeError(f"A daemon is already listening on {self.socket_path}")
+        self.socket_path.unlink(missing_ok=True)
+
+        server = await asyncio.start_unix_server(self.handle, path=str(self.socket_path))
+        self.logger.info(f"Supervisor listening on {self.socket_path}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await self.adopt_orphans()
+        reaper = asyncio.create_task(self.reap_pool())
+        async with server:
+            await stop.wait()
+        reaper.cancel()
+
+        # Leave job status as RUNNING so the next daemon adopts them
+        self.logger.info("Shutting down supervisor...")
+        tasks = [self.cancel_job(job_id, update_meta=False) for job_id in self.running_jobs()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=60)
+        self.socket_path.unlink(missing_ok=True)
+        self.executor.shutdown(wait=False)
+        self.control.shutdown(wait=False)
+
+    def run(self):
+        asyncio.run(self.serve())
@@ -0,0 +1,142 @@
+import json
+import time
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tabulate import tabulate
+
+from jobman.engine import engine
+
+class Stage:
+    """
+    One setup step run per worker. `fn(i)` raises on failure.
+
+    `fingerprint()` optionally returns a hash of everything the stage's result
+    depends on; a worker whose marker matches it skips the stage. `volatile`
+    stages (e.g. mounts) do not survive a reboot of the worker.
+    """
+
+    def __init__(self, name, fn, after=(), fingerprint=None, volatile=False):
+        self.name = name
+        self.fn = fn
+        self.after = list(after)
+        self.fingerprint = fingerprint
+        self.volatile = volatile
+
+class SetupDAG:
+    """
+    Run setup stages as a dependency graph per worker.
+
+    Worker i starts a stage as soon as its own prerequisites for that worker
+    are done, independent stages of a worker run concurrently, and there is no
+    barrier between stages; `run` returns once every worker is done.
+    (worker, stage) pairs in `cached` count as done without running, and
+    `on_done(i, stage)` is called after each stage that succeeds.
+    """
+
+    def __init__(self, stages, workers, logger, timings_file=None, max_parallel=None, cached=(), on_done=None):
+        self.stages = {s.name: s for s in stages}
+        for s in stages:
+            missing = [d for d in s.after if d not in self.stages]
+            if missing:
+                raise ValueError(f"Stage {s.name} depends on unknown stages: {missing}")
+        self.workers = list(workers)
+        self.logger = logger
+        self.timings_file = timings_file
+        self.cached = set(cached)
+        self.on_done = on_done
+        # Stage threads mostly wait on the engine, which bounds the actual subprocesses
+        self.max_parallel = max_parallel or max(1, min(len(self.workers) * len(stages), engine.max_concurrency))
+
+        self.lock = threading.Lock()
+        self.all_done = threading.Event()
+        # (worker, stage) -> "pending" | "running" | "done" | "failed" | "skipped"
+        self.status = {}
+        self.timings = {}
+
+    def run(self):
+        if not self.workers or not self.stages:
+            return True
+
+        self.status = {
+            (i, name): "done" if (i, name) in self.cached else "pending"
+            for i in self.workers for name in self.stages
+        }
+        self.executor = ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="setup")
+        with self.lock:
+            for i in self.workers:
+                self._schedule_ready(i)
+        self.all_done.wait()
+        self.executor.shutdown(wait=True)
+
+        self._report()
+        return all(v == "done" for v in self.status.values())
+
+    def _schedule_ready(self, i):
+        """Submit every pending stage of worker i whose deps are done; skip those with failed deps. Lock held."""
+        changed = True
+        while changed:
+            changed = False
+            for name, stage in self.stages.items():
+                if self.status[(i, name)] != "pending":
+                    continue
+                deps = [self.status[(i, d)] for d in stage.after]
+                if any(d in {"failed", "skipped"} for d in deps):
+                    self.status[(i, name)] = "skipped"
+                    self.logger.warning(f"Worker {i}: skipping {name} because a prerequisite failed")
+                    changed = True
+                elif all(d == "done" for d in deps):
+                    self.status[(i, name)] = "running"
+                    self.executor.submit(self._run_stage, i, stage)
+        if all(v in {"done", "failed", "skipped"} for v in self.status.values()):
+            self.all_done.set()
+
+    def _run_stage(self, i, stage):
+        start = time.monotonic()
+        try:
+            stage.fn(i)
+            if self.on_done is not None:
+                self.on_done(i, stage)
+            result = "done"
+        except Exception as e:
+            self.logger.error(f"Worker {i}: stage {stage.name} failed: {e}")
+            result = "failed"
+        elapsed = time.monotonic() - start
+
+        with self.lock:
+            self.status[(i, stage.name)] = result
+            self.timings[(i, stage.name)] = round(elapsed, 2)
+            self._schedule_ready(i)
+
+    def _report(self):
+        names = list(self.stages)
+        rows = []
+        for i in self.workers:
+            row = [i]
+            for name in names:
+                status = self.status[(i, name)]
+                t = self.timings.get((i, name))
+                if (i, name) in self.cached:
+                    row.append("cached")
+                else:
+                    row.append(f"{t}s" if status == "done" else (f"{status} ({t}s)" if t is not None else status))
+            rows.append(row)
+        self.logger.info("Setup timings per worker:\n" + tabulate(rows, headers=["Worker"] + names, tablefmt="github"))
+
+        if self.timings_file is not None:
+            data = [
+                {
+                    "worker": i, "stage": name, "seconds": self.timings.get((i, name)),
+                    "status": "cached" if (i, name) in self.cached else self.status[(i, name)],
+                }
+                for i in self.workers for name in names
+            ]
+            Path(self.timings_file).write_text(json.dumps(data, indent=2))
+
+def run_per_worker(name, fn, workers, logger):
+    """
+    Run one blocking per-worker step `fn(i)` on every worker, e.g. for the
+    standalone `jobman ssh/gcsfuse/...` commands: a one-stage SetupDAG, so it
+    shares the setup pool and timing report instead of a thread per worker.
+    """
+    return SetupDAG([Stage(name, fn)], workers, logger).run()
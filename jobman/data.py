@@ -0,0 +1,153 @@
+import json
+import math
+import threading
+import subprocess
+from pathlib import Path
+from textwrap import dedent
+
+from jobman import gcloud
+from jobman.remote import Remote
+from jobman.dag import run_per_worker
+from jobman.fingerprint import fingerprint
+from jobman.utils import setup_logger
+
+# Run on a worker with python3, followed by a `main(local_dir, files)` line.
+# Skips files already downloaded with the same checksum (recorded in
+# <local_dir>/.jobman-data.json), copies the rest with one multi-stream
+# `gcloud storage cp -I` per destination directory and prints the totals.
+STAGE_SCRIPT = dedent("""
+    import os, json, time, subprocess, collections
+
+    def main(local_dir, files):
+        local_dir = os.path.expanduser(local_dir)
+        state_path = os.path.join(local_dir, ".jobman-data.json")
+        os.makedirs(local_dir, exist_ok=True)
+        state = json.load(open(state_path)) if os.path.exists(state_path) else {}
+        groups = collections.defaultdict(list)
+        skipped = 0
+        for rel, url, size, checksum in files:
+            path = os.path.join(local_dir, rel)
+            if state.get(rel) == checksum and os.path.exists(path) and os.path.getsize(path) == size:
+                skipped += 1
+            else:
+                groups[os.path.dirname(path)].append((rel, url, size, checksum))
+
+        start, copied = time.monotonic(), 0
+        for d, items in groups.items():
+            os.makedirs(d, exist_ok=True)
+            subprocess.run(["gcloud", "storage", "cp", "-I", d + "/"], input="".join(x[1] + "\\n" for x in items), text=True, check=True)
+            for rel, url, size, checksum in items:
+                if os.path.getsize(os.path.join(local_dir, rel)) != size:
+                    raise SystemExit(f"size mismatch for {rel}")
+                state[rel] = checksum
+                copied += size
+            # Saved per directory so an interrupted copy resumes where it stopped
+            with open(state_path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(state_path + ".tmp", state_path)
+        print(f"JOBMAN_DATA {len(files)} {skipped} {copied} {time.monotonic() - start:.3f}")
+""")
+
+class DATA:
+    """
+    Pre-stages each worker's shard of a GCS dataset onto its local disk (or a
+    tmpfs) so training does not read through the gcsfuse mount on a cold cache.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        data = cfg.get("data", None) or {}
+        self.source = (data.get("source", None) or "").rstrip("/")
+        self.local_dir = data.get("local_dir", "/tmp/jobman-data")
+        # round_robin: file k goes to worker k % n; contiguous: worker i gets the i-th block; all: every file
+        self.shard = data.get("shard", "round_robin")
+        if self.shard not in {"round_robin", "contiguous", "all"}:
+            raise ValueError(f"Invalid data shard {self.shard}, expected round_robin, contiguous or all")
+        self.streams = data.get("streams", None)
+        self.env_var = data.get("env_var", "JOBMAN_DATA_DIR")
+        # Copies into /dev/shm or /tmp are gone after a reboot, like mounts
+        self.volatile = str(self.local_dir).startswith(("/dev/shm", "/tmp"))
+        self.remote = Remote(cfg)
+        self.list_lock = threading.Lock()
+        self.files = None
+
+        self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
+
+    @property
+    def enabled(self):
+        return bool(self.source)
+
+    def setup(self):
+        self.logger.info(f"Staging {self.source} to {self.local_dir} on TPU workers...")
+
+        ok = run_per_worker("data", self._setup_worker, range(self.cfg.tpu.num_workers), self.logger)
+        if not ok:
+            self.logger.warning("Data staging completed with at least one worker failed.")
+        else:
+            self.logger.info("Data staging completed successfully on all workers.")
+        return ok
+
+    def list_files(self):
+        """[(relative path, url, size, checksum)] under `source`, sorted; listed once per job."""
+        with self.list_lock:
+            if self.files is None:
+                result = gcloud.run(
+                    ["gcloud", "storage", "objects", "list", f"{self.source}/**", "--format=json"],
+                    check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+                prefix = self.source.split("/", 3)[3] if self.source.count("/") >= 3 else ""
+                files = []
+                for obj in json.loads(result.stdout or "[]"):
+                    name = obj["name"]
+                    if name.endswith("/"):
+                        continue
+                    rel = name[len(prefix):].lstrip("/") if name.startswith(prefix) else name
+                    size = int(obj.get("size", 0))
+                    checksum = obj.get("crc32c_hash") or obj.get("md5_hash") or f"size:{size}"
+                    files.append((rel, f"gs://{obj['bucket']}/{name}", size, checksum))
+                self.files = sorted(files)
+                self.logger.info(f"Dataset {self.source}: {len(self.files)} files, {sum(f[2] for f in self.files) / 2**30:.1f} GiB")
+            return self.files
+
+    def shard_files(self, i):
+        files = self.list_files()
+        n = self.cfg.tpu.num_workers
+        if self.shard == "all":
+            return files
+        if self.shard == "contiguous":
+            per = math.ceil(len(files) / n)
+            return files[i * per:(i + 1) * per]
+        return files[i::n]
+
+    def fingerprint(self):
+        return fingerprint("data", self.source, self.local_dir, self.shard, self.cfg.tpu.num_workers, json.dumps(self.list_files()))
+
+    def _setup_worker(self, i):
+        files = self.shard_files(i)
+        self.logger.info(f"Worker {i}: Staging {len(files)} files to {self.local_dir}...")
+        log_file = Path(self.cfg.job.dir) / "logs" / f"data_worker_{i}.log"
+
+        env = f"CLOUDSDK_STORAGE_THREAD_COUNT={self.streams} " if self.streams else ""
+        script = STAGE_SCRIPT + f"\nmain({json.dumps(self.local_dir)}, {json.dumps([list(f) for f in files])})\n"
+        with open(log_file, "w") as f:
+            try:
+                result = self.remote.run(
+                    i, f"{env}python3 -", input=script, check=True, stdout=subprocess.PIPE, stderr=f, bounded=False,
+                )
+                f.write(result.stdout or "")
+            except Exception as e:
+                self.logger.error(f"Worker {i}: Data staging failed: {e}")
+                raise
+
+        for line in (result.stdout or "").splitlines():
+            parts = line.split()
+            if len(parts) == 5 and parts[0] == "JOBMAN_DATA":
+                total, skipped, copied, elapsed = int(parts[1]), int(parts[2]), int(parts[3]), float(parts[4])
+                rate = copied / 2**20 / max(elapsed, 1e-3)
+                self.logger.info(
+                    f"Worker {i}: staged {total - skipped} files ({copied / 2**30:.2f} GiB) in {elapsed:.0f}s "
+                    f"at {rate:.0f} MB/s, {skipped} already present"
+                )
+
+    def patch_command(self, cmd):
+        return f"export {self.env_var}={self.local_dir} && {cmd}"
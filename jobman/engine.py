@@ -0,0 +1,177 @@
+import os
+import signal
+import asyncio
+import threading
+import subprocess
+
+class Engine:
+    """
+    Process-wide executor for every subprocess jobman starts (gcloud, ssh, scp).
+
+    One asyncio loop in a background thread owns all child processes, so there
+    is no thread per call or per pipe. At most `max_concurrency` bounded calls
+    run at once, and at most `per_destination` against one destination (e.g. one
+    TPU worker); the rest wait their turn. Long-running calls such as the job
+    command pass `bounded=False` so every worker's process starts.
+    """
+
+    def __init__(self, max_concurrency=64, per_destination=4):
+        self.max_concurrency = max_concurrency
+        self.per_destination = per_destination
+        # Own process group per call: lets cancel kill the whole call, but Ctrl-C no longer reaches it
+        self.isolate = False
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.global_sem = None
+        self.dest_sems = {}
+        # task -> argv, and task -> live process
+        self.calls = {}
+        self.procs = {}
+        # Tasks whose process `terminate` killed
+        self.killed = set()
+
+    def configure(self, max_concurrency=None, per_destination=None):
+        """Change the limits; only takes effect before the first call."""
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+        if per_destination is not None:
+            self.per_destination = per_destination
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="jobman-engine", daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def call(self, coro, timeout=None):
+        """Run a coroutine on the engine loop and block until it returns."""
+        loop = self._ensure_loop()
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("Engine.call() must not be used from the engine loop; await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    def run(self, argv, check=False, **kwargs):
+        """Blocking `exec`; `check` raises `CalledProcessError` on a non-zero exit, like `subprocess.run`."""
+        result = self.call(self.exec(argv, **kwargs))
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+        return result
+
+    def _dest_sem(self, dest):
+        if dest not in self.dest_sems:
+            self.dest_sems[dest] = asyncio.Semaphore(self.per_destination)
+        return self.dest_sems[dest]
+
+    async def exec(self, argv, stdout=None, stderr=None, input=None, timeout=None, dest=None, bounded=True, on_line=None):
+        """
+        Run `argv` and return a text `CompletedProcess`.
+
+        `stdout`/`stderr` are None (inherit), a file object (written directly by
+        the child), `subprocess.PIPE` (captured) or `subprocess.DEVNULL`.
+        With `on_line`, stdout is read line by line and passed to it instead.
+        On timeout the call is killed and `subprocess.TimeoutExpired` raised;
+        a call cancelled by `terminate` returns exit code -SIGTERM.
+        """
+        argv = [str(x) for x in argv]
+        if self.global_sem is None:
+            self.global_sem = asyncio.Semaphore(self.max_concurrency)
+        task = asyncio.current_task()
+        self.calls[task] = argv
+        try:
+            sems = []
+            if bounded:
+                sems.append(self.global_sem)
+                if dest is not None:
+                    sems.append(self._dest_sem(dest))
+            for sem in sems:
+                await sem.acquire()
+            try:
+                return await self._exec(task, argv, stdout, stderr, input, timeout, on_line)
+            finally:
+                for sem in sems:
+                    sem.release()
+        except asyncio.CancelledError:
+            return subprocess.CompletedProcess(argv, -signal.SIGTERM)
+        finally:
+            self.calls.pop(task, None)
+
+    async def _exec(self, task, argv, stdout, stderr, input, timeout, on_line):
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=None if input is None else subprocess.PIPE,
+            stdout=subprocess.PIPE if on_line is not None else stdout,
+            stderr=stderr,
+            start_new_session=self.isolate,
+        )
+        self.procs[task] = proc
+        try:
+            if on_line is not None:
+                work = self._stream(proc, input, on_line)
+            else:
+                work = proc.communicate(None if input is None else input.encode())
+            try:
+                out, err = await asyncio.wait_for(work, timeout)
+            except asyncio.TimeoutError:
+                self._kill(proc)
+                await proc.wait()
+                raise subprocess.TimeoutExpired(argv, timeout)
+            except asyncio.CancelledError:
+                self._kill(proc)
+                await proc.wait()
+                raise
+        finally:
+            self.procs.pop(task, None)
+        # Whatever the process made of the signal (ssh exits 255), a terminated call reports -SIGTERM
+        returncode = -signal.SIGTERM if task in self.killed else proc.returncode
+        self.killed.discard(task)
+        return subprocess.CompletedProcess(
+            argv, returncode,
+            out.decode(errors="replace") if out is not None else None,
+            err.decode(errors="replace") if err is not None else None,
+        )
+
+    async def _stream(self, proc, input, on_line):
+        if input is not None:
+            proc.stdin.write(input.encode())
+            await proc.stdin.drain()
+            proc.stdin.close()
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            on_line(line.decode(errors="replace"))
+        await proc.wait()
+        return None, None
+
+    def _kill(self, proc):
+        try:
+            if self.isolate:
+                os.killpg(proc.pid, signal.SIGTERM)
+            else:
+                proc.terminate()
+        except ProcessLookupError:
+            pass
+
+    def terminate(self, *matches):
+        """Kill running calls and drop queued ones whose argv contains all of `matches`. Returns the count."""
+        if self.loop is None:
+            return 0
+
+        async def _terminate():
+            hits = [t for t, argv in self.calls.items() if all(any(m in a for a in argv) for m in matches)]
+            for t in hits:
+                proc = self.procs.get(t)
+                if proc is not None and proc.returncode is None:
+                    self.killed.add(t)
+                    self._kill(proc)
+                else:
+                    t.cancel()
+            return len(hits)
+
+        return self.call(_terminate())
+
+# Process-wide instance shared by gcloud and Remote
+engine = Engine()
@@ -1,5 +1,8 @@
 
 class ENV:
+
+    # Whether `warm_worker` must run after setup to start a long-lived runtime
+    persistent = False
     
     def __init__(self, cfg):
         pass
@@ -10,12 +13,30 @@ class ENV:
     def _setup_worker(self, i):
         return False
     
+    def setup_worker(self, i):
+        return self._setup_worker(i)
+    
+    def warm_worker(self, i):
+        pass
+    
     def check(self):
         pass
     
     def _check_worker(self, i):
         return False
     
+    def prebuild(self):
+        """Build shared artifacts from the submit host before the TPU exists; True if anything was built."""
+        return False
+
+    def boot_script(self):
+        """Bash run on the worker at boot (see Bootstrap) to set the env up; None if unsupported."""
+        return None
+
+    def fingerprint(self):
+        """Hash of what the env is built from; None disables skipping the stage."""
+        return None
+
     def patch_command(self, cmd):
         return cmd
 
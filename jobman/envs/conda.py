@@ -1,37 +1,54 @@
-import argparse
+import time
+import base64
+import shutil
+import platform
+import tempfile
+import threading
 import subprocess
-import concurrent.futures
 from pathlib import Path
 from omegaconf import OmegaConf
 
 from jobman.envs.base import ENV
+from jobman import gcloud
+from jobman.engine import engine
+from jobman.remote import Remote
+from jobman.dag import run_per_worker
+from jobman.fingerprint import fingerprint
 from jobman.utils import setup_logger
 
+# Installs Miniconda if missing and activates it
+MINICONDA_SETUP = """
+                    if [ ! -d ~/miniconda ]; then
+                        wget -q https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh -O miniconda.sh
+                        bash miniconda.sh -b -p ~/miniconda
+                    fi && \\
+                    source ~/miniconda/etc/profile.d/conda.sh
+                    conda tos accept --override-channels --channel https://repo.anaconda.com/pkgs/main || true
+                    conda tos accept --override-channels --channel https://repo.anaconda.com/pkgs/r || true
+"""
+
 class CONDA(ENV):
     
     def __init__(self, cfg):
         self.cfg = cfg
         self.env_name = cfg.conda.name
         self.config_file = Path(cfg.conda.config_file)
+        self.remote = Remote(cfg)
+        self.pack = cfg.conda.get("pack", False)
+        self.pack_lock = threading.Lock()
+        self.pack_built = None
 
         self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
 
     def setup(self):
         self.logger.info(f"Setting up Conda environment on TPU workers...")
 
-        any_failed = False
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg.tpu.num_workers) as executor:
-            futures = [executor.submit(self.setup_worker, i) for i in range(self.cfg.tpu.num_workers)]
-            for future in concurrent.futures.as_completed(futures):
-                if exc := future.exception():
-                    self.logger.error(f"Worker thread failed: {exc}")
-                    any_failed = True
-
-        if any_failed:
+        ok = run_per_worker("conda", self.setup_worker, range(self.cfg.tpu.num_workers), self.logger)
+        if not ok:
             self.logger.warning("Conda setup completed with at least one worker failed.")
         else:
             self.logger.info("Conda setup completed successfully on all workers.")
-        return not any_failed
+        return ok
 
     def setup_worker(self, i):
         if self._check_worker(i):
@@ -41,51 +58,148 @@ class CONDA(ENV):
         self.logger.info(f"Worker {i}: Setting up Conda...")
         log_file = Path(self.cfg.job.dir) / "logs" / f"conda_worker_{i}.log"
 
+        if self.pack:
+            # Built at most once (on worker 0); every worker then downloads and unpacks it
+            built_here = self.ensure_pack()
+            if built_here and i == 0:
+                self.logger.info(f"Worker {i}: Conda env was built here.")
+                return
+            with open(log_file, "w") as f:
+                try:
+                    self.remote.run(i, self._unpack_cmd(), check=True, stdout=f, stderr=f)
+                except Exception as e:
+                    self.logger.error(f"Worker {i} Conda unpack failed: {e}")
+                    raise
+            return
+
         remote_env_file = f"~/{self.config_file.name}"
 
         with open(log_file, "w") as f:
             try:
                 # Step 1: scp env file to remote worker
-                scp_cmd = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "scp",
-                    str(self.config_file),  # local path
-                    f"{self.cfg.tpu.name}:{remote_env_file}",  # remote path
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    f"--ssh-key-file={self.cfg.ssh.private_key}",
-                    "--quiet",
-                ]
-                subprocess.run(scp_cmd, check=True, stdout=f, stderr=f)
+                self.remote.copy(i, self.config_file, remote_env_file, check=True, stdout=f, stderr=f)
 
                 # Step 2: install Miniconda + create env
                 remote_cmd = f"""        
-                    if [ ! -d ~/miniconda ]; then
-                        wget -q https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh -O miniconda.sh
-                        bash miniconda.sh -b -p ~/miniconda
-                    fi && \
-                    source ~/miniconda/etc/profile.d/conda.sh
-                    conda tos accept --override-channels --channel https://repo.anaconda.com/pkgs/main 
-                    conda tos accept --override-channels --channel https://repo.anaconda.com/pkgs/r
+                    {MINICONDA_SETUP}
                     conda env create -n {self.env_name} -f {remote_env_file} --yes
                 """
 
-                ssh_cmd = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--command", remote_cmd,
-                    f"--ssh-key-file={self.cfg.ssh.private_key}",
-                    "--ssh-flag=-o ConnectTimeout=15",
-                    "--ssh-flag=-o StrictHostKeyChecking=no",
-                    "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-                    "--quiet",
-                ]
-                subprocess.run(ssh_cmd, check=True, stdout=f, stderr=f)
+                self.remote.run(i, remote_cmd, check=True, stdout=f, stderr=f)
 
             except Exception as e:
                 self.logger.error(f"Worker {i} Conda setup failed: {e}")
                 raise
-    
+
+    def pack_key(self):
+        # The env file plus the platform it is built for (arch + TPU VM image)
+        return fingerprint("conda-pack", self.config_file, "linux-64", self.cfg.tpu.version)
+
+    def pack_uri(self):
+        base = self.cfg.conda.get("pack_uri", None) or f"gs://{self.cfg.gcsfuse.bucket_name}/jobman/conda"
+        return f"{base.rstrip('/')}/{self.pack_key()}.tar.gz"
+
+    def ensure_pack(self):
+        """Make sure the packed env exists in GCS; returns True if this call built it on worker 0."""
+        with self.pack_lock:
+            if self.pack_built is None:
+                try:
+                    self.pack_built = self._ensure_pack()
+                except Exception as e:
+                    # Remembered so the other workers fail fast instead of rebuilding one by one
+                    self.pack_built = e
+            if isinstance(self.pack_built, Exception):
+                raise self.pack_built
+            return self.pack_built
+
+    def _ensure_pack(self):
+        uri = self.pack_uri()
+        if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            self.logger.info(f"Using packed Conda env {uri}")
+            return False
+
+        self.logger.info(f"Building Conda env on worker 0 and packing it to {uri}...")
+        log_file = Path(self.cfg.job.dir) / "logs" / "conda_pack.log"
+        remote_env_file = f"~/{self.config_file.name}"
+        tarball = f"/tmp/jobman-conda-{self.pack_key()}.tar.gz"
+        remote_cmd = f"""
+            set -e
+            {MINICONDA_SETUP}
+            conda env create -n {self.env_name} -f {remote_env_file} --yes
+            conda install -n base -y -c conda-forge conda-pack
+            conda pack -n {self.env_name} -o {tarball} --force
+            gcloud storage cp {tarball} {uri}
+            rm -f {tarball}
+        """
+        start = time.monotonic()
+        with open(log_file, "w") as f:
+            self.remote.copy(0, self.config_file, remote_env_file, check=True, stdout=f, stderr=f)
+            self.remote.run(0, remote_cmd, check=True, stdout=f, stderr=f)
+        self.logger.info(f"Packed Conda env in {time.monotonic() - start:.0f}s")
+        return True
+
+    def prebuild(self):
+        """Build and pack the env on this host if it is linux-64 with conda and conda-pack."""
+        if not self.pack or (platform.system(), platform.machine()) != ("Linux", "x86_64") or not shutil.which("conda"):
+            return False
+        # Holding the lock makes setup wait for this instead of building on worker 0 as well
+        with self.pack_lock:
+            if self.pack_built is not None:
+                return False
+            uri = self.pack_uri()
+            if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                self.pack_built = False
+                return False
+            self.logger.info(f"Building Conda env on this host and packing it to {uri}...")
+            with tempfile.TemporaryDirectory(prefix="jobman-conda-") as tmp:
+                cmd = f"""
+                    set -e
+                    conda pack --help >/dev/null 2>&1 || {{ echo "conda-pack is not installed" >&2; exit 1; }}
+                    conda env create -p {tmp}/env -f {self.config_file.expanduser()} --yes
+                    conda pack -p {tmp}/env -o {tmp}/env.tar.gz
+                    gcloud storage cp {tmp}/env.tar.gz {uri}
+                """
+                with open(Path(self.cfg.job.dir) / "logs" / "conda_prebuild.log", "w") as f:
+                    # A local build, not a gcloud call
+                    engine.run(["bash", "-c", cmd], check=True, stdout=f, stderr=f, bounded=False)
+            self.pack_built = False
+            return True
+
+    def _unpack_cmd(self):
+        return f"""
+            set -e
+            {MINICONDA_SETUP}
+            D=~/miniconda/envs/{self.env_name}
+            rm -rf $D && mkdir -p $D
+            gcloud storage cp {self.pack_uri()} - | tar -xzf - -C $D
+            $D/bin/conda-unpack
+        """
+
+    def boot_script(self):
+        remote_env_file = f"~/{self.config_file.name}"
+        create = f"""
+                {MINICONDA_SETUP}
+                conda env create -n {self.env_name} -f {remote_env_file} --yes
+        """
+        if self.pack:
+            # Unpack if the env was packed before, else build it like a plain setup
+            create = f"""
+                if gcloud storage ls {self.pack_uri()} >/dev/null 2>&1; then
+                    {self._unpack_cmd()}
+                else
+                    {create}
+                fi
+            """
+        data = base64.b64encode(self.config_file.expanduser().read_bytes()).decode()
+        return f"""
+            set -e
+            echo {data} | base64 -d > {remote_env_file}
+            {create}
+        """
+
+    def fingerprint(self):
+        return fingerprint("conda", self.env_name, self.config_file)
+
     def _check_worker(self, i):
         self.logger.info(f"Worker {i}: Checking Conda setup...")
         return False
@@ -1,38 +1,82 @@
+import time
+import shlex
+import shutil
+import threading
 import subprocess
-import concurrent.futures
 from pathlib import Path
+from textwrap import dedent
 
 from jobman.envs.base import ENV
+from jobman import gcloud
+from jobman.engine import engine
+from jobman.remote import Remote
+from jobman.dag import run_per_worker
+from jobman.code import remote_code_dir
+from jobman.command import LAUNCH_DIR
+from jobman.fingerprint import fingerprint
 from jobman.utils import setup_logger
 
+# Checked against /etc/group: a session's own groups do not update after usermod.
+# Docker is only restarted the first time, so a running mirror registry is not interrupted.
+DOCKER_GROUP_SETUP = 'getent group docker | grep -qw "$USER" || (sudo usermod -aG docker $USER && sudo systemctl restart docker)'
+
+# exec.sh <container> <command...>: a persistent container's command runs under containerd,
+# outside the remote call's process group (see remote.KILL_SCRIPT). It gets its own group
+# in the container, whose id is kept there, and a SIGTERM on the host is forwarded to it.
+EXEC_SCRIPT = dedent("""
+    C=$1; shift
+    trap 'sudo docker exec $C bash -c "kill -TERM -- -\\$(cat /tmp/jobman-exec/$$)" 2>/dev/null; exit 143' TERM
+    sudo docker exec $C bash -c 'set -m; mkdir -p /tmp/jobman-exec; "${@:2}" & set +m; echo $! > /tmp/jobman-exec/$1; wait $!; rc=$?; rm -f /tmp/jobman-exec/$1; exit $rc' _ $$ "$@" &
+    wait $!
+""")
+
+MIRROR_NAME = "jobman-registry"
+MIRROR_PORT = 5000
+
 class DOCKER(ENV):
     
     def __init__(self, cfg):
         self.cfg = cfg
         self.image = cfg.docker.image
         self.env_vars = cfg.docker.get('env_vars', [])
-        self.mount_dirs = cfg.docker.get('mount_dirs', [])
-        self.workdir = cfg.docker.get('work_dir', None)
+        self.mount_dirs = list(cfg.docker.get('mount_dirs', []))
+        # Pre-staged data (see DATA) is read inside the container at the same path
+        data_dir = (cfg.get('data', None) or {}).get('local_dir', '/tmp/jobman-data')
+        if (cfg.get('data', None) or {}).get('source', None) and data_dir not in self.mount_dirs:
+            self.mount_dirs.append(data_dir)
+        # ... and so is the code snapshot (see CODE)
+        if cfg.job.get('code_dir', None) and remote_code_dir(cfg) not in self.mount_dirs:
+            self.mount_dirs.append(remote_code_dir(cfg))
+        # ... and the synchronized launch barrier (see COMMAND.trigger_launch)
+        if cfg.command.get('sync_start', False) and LAUNCH_DIR not in self.mount_dirs:
+            self.mount_dirs.append(LAUNCH_DIR)
+        self.workdir = cfg.docker.get('workdir', cfg.docker.get('work_dir', None))
         self.flags = cfg.docker.get('flags', None)
+        self.remote = Remote(cfg)
+        # pull: every worker pulls from the registry; mirror: worker 0 pulls and serves the rest;
+        # tarball: the image is saved once to GCS and every worker streams it into `docker load`
+        self.distribution = cfg.docker.get('distribution', 'pull')
+        if self.distribution not in {"pull", "mirror", "tarball"}:
+            raise ValueError(f"Invalid docker distribution {self.distribution}, expected pull, mirror or tarball")
+        # One long-lived container per worker; commands run in it through `docker exec`
+        self.persistent = cfg.docker.get('persistent', False)
+        self.container = cfg.docker.get('container_name', 'jobman-env')
+        self.source_lock = threading.Lock()
+        self.source_state = None
+        self.digest_lock = threading.Lock()
+        self.resolved = None
         
         self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
         
     def setup(self):
         self.logger.info(f"Setting up Docker on TPU workers...")
         
-        any_failed = False
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg.tpu.num_workers) as executor:
-            futures = [executor.submit(self._setup_worker, i) for i in range(self.cfg.tpu.num_workers)]
-            for future in concurrent.futures.as_completed(futures):
-                if exc := future.exception():
-                    self.logger.error(f"Worker thread failed: {exc}")
-                    any_failed = True
-
-        if any_failed:
-            self.logger.warning("GCSFuse setup completed with at least one worker failed.")
+        ok = run_per_worker("docker", self._setup_worker, range(self.cfg.tpu.num_workers), self.logger)
+        if not ok:
+            self.logger.warning("Docker setup completed with at least one worker failed.")
         else:
-            self.logger.info("GCSFuse setup completed successfully on all workers.")
-        return not any_failed
+            self.logger.info("Docker setup completed successfully on all workers.")
+        return ok
     
     def _setup_worker(self, i):
         if self._check_worker(i):
@@ -44,53 +88,194 @@ class DOCKER(ENV):
 
         with open(log_file, "w") as f:
             try:
-                cmd1 = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--command", "sudo usermod -aG docker $USER && sudo systemctl restart docker",
-                    f"--ssh-key-file={self.cfg.ssh.private_key}",
-                    "--ssh-flag=-o ConnectTimeout=15",
-                    "--ssh-flag=-o StrictHostKeyChecking=no",
-                    "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-                    "--quiet",
-                ]
-                subprocess.run(cmd1, check=True, stdout=f, stderr=f)
-
-                cmd2 = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--command", f"docker pull {self.image}",
-                    f"--ssh-key-file={self.cfg.ssh.private_key}",
-                    "--ssh-flag=-o ConnectTimeout=15",
-                    "--ssh-flag=-o StrictHostKeyChecking=no",
-                    "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-                    "--quiet",
-                ]
-                subprocess.run(cmd2, check=True, stdout=f, stderr=f)
+                self.remote.run(i, DOCKER_GROUP_SETUP, check=True, stdout=f, stderr=f)
+
+                # sudo: a multiplexed SSH session keeps the groups it logged in with
+                start = time.monotonic()
+                if self.distribution == "pull":
+                    cmd = f"sudo docker pull {self.image}"
+                elif self.ensure_source() and i == 0:
+                    # Worker 0 pulled the image itself to serve it
+                    cmd = "true"
+                elif self.distribution == "mirror":
+                    cmd = self._mirror_pull_cmd()
+                else:
+                    cmd = f"gcloud storage cp {self.tarball_uri()} - | gunzip | sudo docker load"
+                if self.pinned():
+                    cmd += f" && sudo docker tag {self.image} {self.pinned()}"
+                result = self.remote.run(
+                    i, f"set -eo pipefail; {cmd}; echo JOBMAN_IMAGE_SIZE $(sudo docker image inspect -f '{{{{.Size}}}}' {self.image})",
+                    check=True, stdout=subprocess.PIPE, stderr=f,
+                )
+                f.write(result.stdout or "")
+                self._report(i, result.stdout, time.monotonic() - start)
             except Exception as e:
                 self.logger.error(f"Worker {i} setup failed: {e}")
                 raise        
-            
+
+    def _report(self, i, stdout, elapsed):
+        size = None
+        for line in (stdout or "").splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == "JOBMAN_IMAGE_SIZE" and parts[1].isdigit():
+                size = int(parts[1])
+        rate = f", {size / 2**20 / max(elapsed, 1e-3):.0f} MB/s" if size else ""
+        self.logger.info(f"Worker {i}: image ready via {self.distribution} in {elapsed:.0f}s{rate}")
+
+    def tarball_uri(self):
+        base = self.cfg.docker.get("tarball_uri", None) or f"gs://{self.cfg.gcsfuse.bucket_name}/jobman/images"
+        return f"{base.rstrip('/')}/{self.fingerprint()}.tar.gz"
+
+    def ensure_source(self):
+        """
+        Prepare the image source once per job: worker 0 pulls the image and
+        serves it from a local registry (mirror), or saves it to GCS (tarball,
+        skipped if already there). Returns True if worker 0 pulled the image.
+        """
+        with self.source_lock:
+            if self.source_state is None:
+                try:
+                    self.source_state = self._ensure_source()
+                except Exception as e:
+                    # Remembered so the other workers fail fast
+                    self.source_state = e
+            if isinstance(self.source_state, Exception):
+                raise self.source_state
+            return self.source_state
+
+    def _ensure_source(self):
+        if self.distribution == "tarball":
+            uri = self.tarball_uri()
+            if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                self.logger.info(f"Using image tarball {uri}")
+                return False
+            self.logger.info(f"Saving {self.image} from worker 0 to {uri}...")
+            cmd = f"sudo docker pull {self.image} && sudo docker save {self.image} | gzip -1 | gcloud storage cp - {uri}"
+        else:
+            self.logger.info(f"Serving {self.image} from a registry mirror on worker 0...")
+            mirror = f"localhost:{MIRROR_PORT}/{self._mirror_tag()}"
+            cmd = (
+                f"sudo docker pull {self.image} && "
+                f"(sudo docker inspect {MIRROR_NAME} >/dev/null 2>&1 || "
+                f"sudo docker run -d --restart=always -p {MIRROR_PORT}:5000 --name {MIRROR_NAME} registry:2) && "
+                f"sudo docker tag {self.image} {mirror} && sudo docker push {mirror}"
+            )
+
+        start = time.monotonic()
+        with open(Path(self.cfg.job.dir) / "logs" / "docker_source.log", "w") as f:
+            self.remote.run(0, f"set -eo pipefail; {DOCKER_GROUP_SETUP}; {cmd}", check=True, stdout=f, stderr=f)
+        self.logger.info(f"Image source ready in {time.monotonic() - start:.0f}s")
+        return True
+
+    def prebuild(self):
+        """Save the image to GCS from this host (tarball mode), so no worker has to pull it from the registry."""
+        if self.distribution != "tarball" or not shutil.which("docker"):
+            return False
+        # Holding the lock makes setup wait for this instead of building on worker 0 as well
+        with self.source_lock:
+            if self.source_state is not None:
+                return False
+            uri = self.tarball_uri()
+            if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                self.source_state = False
+                return False
+            self.logger.info(f"Saving {self.image} from this host to {uri}...")
+            cmd = (
+                f"set -eo pipefail; docker pull --platform linux/amd64 {self.image} && "
+                f"docker save {self.image} | gzip -1 | gcloud storage cp - {uri}"
+            )
+            with open(Path(self.cfg.job.dir) / "logs" / "docker_prebuild.log", "w") as f:
+                # A local build, not a gcloud call
+                engine.run(["bash", "-c", cmd], check=True, stdout=f, stderr=f, bounded=False)
+            self.source_state = False
+            return True
+
+    def _mirror_tag(self):
+        return f"jobman-mirror:{self.fingerprint()}"
+
+    def _mirror_pull_cmd(self):
+        ip0 = next(ip["internal_ip"] for ip in self.cfg.tpu.ips if ip["worker"] == 0)
+        registry = f"{ip0}:{MIRROR_PORT}"
+        # Plain-HTTP registry inside the VPC: allow it in daemon.json (merged, docker restarted only on change)
+        allow = (
+            "import json, os; p = '/etc/docker/daemon.json'; "
+            "d = json.load(open(p)) if os.path.exists(p) else {}; r = d.setdefault('insecure-registries', []); "
+            f"changed = '{registry}' not in r; r.append('{registry}') if changed else None; "
+            "json.dump(d, open(p, 'w')) if changed else None; print('changed' if changed else '')"
+        )
+        return (
+            f'if [ "$(sudo python3 -c "{allow}")" = changed ]; then sudo systemctl restart docker; fi; '
+            f"sudo docker pull {registry}/{self._mirror_tag()} && sudo docker tag {registry}/{self._mirror_tag()} {self.image}"
+        )
+
+    def boot_script(self):
+        if self.distribution == "tarball":
+            get = f"gcloud storage cp {self.tarball_uri()} - | gunzip | sudo docker load || sudo docker pull {self.image}"
+        else:
+            # The mirror on worker 0 only exists once setup runs; at boot every worker pulls directly
+            get = f"sudo docker pull {self.image}"
+        if self.pinned():
+            get = f"{{ {get}; }} && sudo docker tag {self.image} {self.pinned()}"
+        return f"""
+            set -eo pipefail
+            {DOCKER_GROUP_SETUP}
+            {self._present_cmd()} || {{ {get}; }}
+        """
+
+    def digest(self):
+        """
+        The registry digest `image` points to, resolved once per job from this
+        host: a mutable tag such as :latest that moved gets pulled again.
+        None if it cannot be resolved (then only the reference is compared).
+        """
+        with self.digest_lock:
+            if self.resolved is None:
+                self.resolved = self._resolve_digest() or ""
+            return self.resolved or None
+
+    def _resolve_digest(self):
+        if "@sha256:" in self.image:
+            return self.image.split("@", 1)[1]
+        candidates = []
+        if shutil.which("docker"):
+            candidates.append(["docker", "buildx", "imagetools", "inspect", self.image, "--format", "{{.Manifest.Digest}}"])
+        if ".pkg.dev/" in self.image:
+            candidates.append(["gcloud", "artifacts", "docker", "images", "describe", self.image, "--format=value(image_summary.digest)"])
+        for argv in candidates:
+            try:
+                run = gcloud.run if argv[0] == "gcloud" else engine.run
+                result = run(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+            except subprocess.TimeoutExpired:
+                continue
+            digest = (result.stdout or "").strip()
+            if result.returncode == 0 and digest.startswith("sha256:"):
+                self.logger.info(f"Docker image {self.image} is {digest}")
+                return digest
+        self.logger.warning(f"Could not resolve the digest of {self.image}; workers that have it will not pull it again if the tag moved")
+        return None
+
+    def pinned(self):
+        """Local tag recording which digest a worker's copy of the image came from."""
+        digest = self.digest()
+        return f"jobman-pinned:{digest.split(':', 1)[1][:16]}" if digest else None
+
+    def _present_cmd(self):
+        """Shell test for the image being on the worker (at the resolved digest, if known)."""
+        if self.pinned() is None:
+            return f"sudo docker image inspect {self.image} >/dev/null 2>&1"
+        image_id = lambda ref: f"$(sudo docker image inspect -f '{{{{.Id}}}}' {ref} 2>/dev/null)"
+        return f'[ -n "{image_id(self.image)}" ] && [ "{image_id(self.image)}" = "{image_id(self.pinned())}" ]'
+
+    def fingerprint(self):
+        return fingerprint("docker", self.image, self.digest() or "")
+
     def _check_worker(self, i):
         self.logger.info(f"Worker {i}: Checking Docker image...")
         log_file = Path(self.cfg.job.dir) / "logs" / f"docker_worker_{i}.log"
         
         with open(log_file, "w") as f:
             try:
-                check_cmd = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--command", f"docker image inspect {self.image}",
-                    f"--ssh-key-file={self.cfg.ssh.private_key}",
-                    "--ssh-flag=-o ConnectTimeout=15",
-                    "--ssh-flag=-o StrictHostKeyChecking=no",
-                    "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-                    "--quiet",
-                ]
-                if subprocess.run(check_cmd, check=True, stdout=f, stderr=f).returncode == 0:
+                if self.remote.run(i, self._present_cmd(), check=True, stdout=f, stderr=f).returncode == 0:
                     return True
                 else:   
                     self.logger.warning(f"Worker {i}: Docker image {self.image} not found")
@@ -99,8 +284,8 @@ class DOCKER(ENV):
                 # self.logger.error(f"Worker {i}: Error checking Docker image: {e}")
                 return False
         
-    def patch_command(self, cmd):
-
+    def run_flags(self):
+        """`docker run` flags shared by one-off and persistent containers."""
         var_flags = []
         volume_flags = []
         for e in self.env_vars:
@@ -119,8 +304,38 @@ class DOCKER(ENV):
         volume_flags_str = " ".join(volume_flags)
         workdir_flag = f"-w {self.workdir}" if self.workdir else ""
         flags_str = " ".join(self.flags or [])
+        return f"{flags_str} {var_flags_str} {volume_flags_str} {workdir_flag}"
 
-        docker_cmd = f"sudo docker run {flags_str} {var_flags_str} {volume_flags_str} {workdir_flag} {self.image} bash -c \"{cmd}\""
+    def warm_worker(self, i):
+        """
+        Make sure worker i runs the persistent container for this config. It is
+        reused when running with the same image ID and run flags, else recreated.
+        """
+        log_file = Path(self.cfg.job.dir) / "logs" / f"container_worker_{i}.log"
+        config = fingerprint("container", self.image, self.run_flags())
+        # The launch dir is written over SSH as this user; docker would create it (and recreate
+        # it when restarting the container after a reboot) owned by root
+        launch_dir = f"mkdir -p {LAUNCH_DIR} && sudo chown $(id -u):$(id -g) {LAUNCH_DIR}" if LAUNCH_DIR in self.mount_dirs else ""
+        cmd = f"""
+            set -e
+            {launch_dir}
+            WANT="{config}-$(sudo docker image inspect -f '{{{{.Id}}}}' {self.image})"
+            HAVE="$(sudo docker inspect -f '{{{{.State.Running}}}} {{{{index .Config.Labels "jobman.config"}}}}' {self.container} 2>/dev/null || true)"
+            if [ "$HAVE" = "true $WANT" ]; then
+                echo "JOBMAN_CONTAINER reused"
+            else
+                sudo docker rm -f {self.container} >/dev/null 2>&1 || true
+                sudo docker run -d --restart unless-stopped --name {self.container} --label jobman.config="$WANT" {self.run_flags()} {self.image} sleep infinity
+                echo "JOBMAN_CONTAINER created"
+            fi
+        """
+        with open(log_file, "w") as f:
+            result = self.remote.run(i, cmd, check=True, stdout=subprocess.PIPE, stderr=f)
+            f.write(result.stdout or "")
+        state = "reused" if "JOBMAN_CONTAINER reused" in (result.stdout or "") else "created"
+        self.logger.info(f"Worker {i}: container {self.container} {state}")
 
-        return docker_cmd
-        
+    def patch_command(self, cmd):
+        if self.persistent:
+            return f"bash -c {shlex.quote(EXEC_SCRIPT)} jobman-exec {self.container} bash -c \"{cmd}\""
+        return f"sudo docker run {self.run_flags()} {self.image} bash -c \"{cmd}\""
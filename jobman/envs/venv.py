@@ -1,9 +1,41 @@
+import time
+import shlex
+import base64
+import tempfile
+import threading
 import subprocess
-import concurrent.futures
 from pathlib import Path
 
 from jobman.envs.base import ENV
-from jobman.utils import setup_logger
+from jobman import gcloud
+from jobman.engine import engine
+from jobman.remote import Remote
+from jobman.dag import run_per_worker
+from jobman.fingerprint import fingerprint
+from jobman.utils import APT_GET, setup_logger
+
+# Turns a `pip install --dry-run --report` into one exact requirement per resolved
+# distribution, so the download step fetches them without resolving again
+PIN_SCRIPT = """
+import json, sys
+for item in json.load(open(sys.argv[1]))["install"]:
+    name, info = item["metadata"]["name"], item["download_info"]
+    if "vcs_info" in info:
+        vcs = info["vcs_info"]
+        print(f"{name} @ {vcs['vcs']}+{info['url']}@{vcs['commit_id']}")
+    elif item.get("is_direct"):
+        print(f"{name} @ {info['url']}")
+    else:
+        print(f"{name}=={item['metadata']['version']}")
+"""
+
+def timings(stdout):
+    """"step 3s, step 5s" from the `JOBMAN_TIMING <step> <seconds> ...` line of a remote script."""
+    for line in (stdout or "").splitlines():
+        if line.startswith("JOBMAN_TIMING"):
+            parts = line.split()[1:]
+            return ", ".join(f"{k} {v}s" for k, v in zip(parts[::2], parts[1::2]))
+    return None
 
 class VENV(ENV):
     
@@ -12,25 +44,23 @@ class VENV(ENV):
         self.env_name = cfg.venv.name
         self.requirements_file = cfg.venv.requirements_file
         self.python = cfg.venv.get('python', 'python3.10')
+        self.path = f"~/venv/{self.env_name}"
+        self.remote = Remote(cfg)
+        self.wheelhouse = cfg.venv.get("wheelhouse", False)
+        self.wheelhouse_lock = threading.Lock()
+        self.wheelhouse_state = None
         
         self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
         
     def setup(self):
         self.logger.info(f"Setting up Venv environment on TPU workers...")
 
-        any_failed = False
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg.tpu.num_workers) as executor:
-            futures = [executor.submit(self.setup_worker, i) for i in range(self.cfg.tpu.num_workers)]
-            for future in concurrent.futures.as_completed(futures):
-                if exc := future.exception():
-                    self.logger.error(f"Worker thread failed: {exc}")
-                    any_failed = True
-
-        if any_failed:
+        ok = run_per_worker("venv", self.setup_worker, range(self.cfg.tpu.num_workers), self.logger)
+        if not ok:
             self.logger.warning("Venv setup completed with at least one worker failed.")
         else:
             self.logger.info("Venv setup completed successfully on all workers.")
-        return not any_failed
+        return ok
     
     def setup_worker(self, i):
         if self._check_worker(i):
@@ -43,43 +73,199 @@ class VENV(ENV):
         remote_req_file = f"~/requirements_{self.env_name}.txt"
         local_req_file = self.requirements_file
 
+        if self.wheelhouse:
+            # Wheels are resolved and built at most once (on worker 0); workers install offline
+            self.ensure_wheelhouse()
+
         with open(log_file, "w") as f:
             try:
                 # Step 1: Copy requirements.txt to remote
-                scp_cmd = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "scp",
-                    str(local_req_file),
-                    f"{self.cfg.tpu.name}:{remote_req_file}",
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--ssh-key-file", str(self.cfg.ssh.private_key),
-                    "--quiet",
-                ]
-                subprocess.run(scp_cmd, check=True, stdout=f, stderr=f)
+                self.remote.copy(i, local_req_file, remote_req_file, check=True, stdout=f, stderr=f)
+
+                if self.wheelhouse:
+                    start = time.monotonic()
+                    result = self.remote.run(i, self._install_cmd(remote_req_file), check=True, stdout=subprocess.PIPE, stderr=f)
+                    f.write(result.stdout or "")
+                    self.logger.info(f"Worker {i}: installed from wheelhouse in {time.monotonic() - start:.0f}s ({timings(result.stdout)})")
+                    return
 
                 # Step 2: Create virtualenv and install requirements
                 remote_cmd = f"""
-                    sudo apt install {self.python}-venv -y
+                    {APT_GET} install -y {self.python}-venv
                     mkdir -p ~/venv
                     {self.python} -m venv {remote_venv_dir} || true && \
                     source {remote_venv_dir}/bin/activate && \
                     pip install --upgrade pip && \
                     pip install -r {remote_req_file}
                 """
-                ssh_cmd = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--command", remote_cmd,
-                    "--ssh-key-file", str(self.cfg.ssh.private_key),
-                    "--quiet",
-                ]
-                subprocess.run(ssh_cmd, check=True, stdout=f, stderr=f)
+                self.remote.run(i, remote_cmd, check=True, stdout=f, stderr=f)
 
             except Exception as e:
                 self.logger.error(f"Worker {i} venv setup failed: {e}")
                 raise
       
+    def worker_glibc(self):
+        """glibc of the workers' image as a manylinux tag part ("2_35"), or None if unknown."""
+        glibc = self.cfg.venv.get("glibc", None)
+        if glibc:
+            return str(glibc).replace(".", "_")
+        version = self.cfg.tpu.get("version", "")
+        if "ubuntu2204" in version or version.startswith("v2-alpha-tpuv"):
+            return "2_35"
+        if "ubuntu2004" in version or version.startswith("tpu-vm-"):
+            return "2_31"
+        return None
+
+    def wheelhouse_key(self):
+        # Requirements, interpreter and platform (arch + TPU VM image and its glibc) determine the wheels
+        return fingerprint("wheelhouse", Path(self.requirements_file), self.python, "x86_64", self.cfg.tpu.version, self.worker_glibc())
+
+    def wheelhouse_uri(self):
+        base = self.cfg.venv.get("wheelhouse_uri", None) or f"gs://{self.cfg.gcsfuse.bucket_name}/jobman/wheels"
+        return f"{base.rstrip('/')}/{self.wheelhouse_key()}.tar.gz"
+
+    def _venv_cmd(self):
+        return f"""
+            {APT_GET} install -y {self.python}-venv
+            mkdir -p ~/venv
+            {self.python} -m venv {self.path} || true
+            {self.path}/bin/pip install --upgrade pip
+        """
+
+    def ensure_wheelhouse(self):
+        """Make sure the wheelhouse exists in GCS, building it on worker 0 if needed."""
+        with self.wheelhouse_lock:
+            if self.wheelhouse_state is None:
+                try:
+                    self.wheelhouse_state = self._ensure_wheelhouse()
+                except Exception as e:
+                    # Remembered so the other workers fail fast instead of rebuilding one by one
+                    self.wheelhouse_state = e
+            if isinstance(self.wheelhouse_state, Exception):
+                raise self.wheelhouse_state
+            return self.wheelhouse_state
+
+    def _ensure_wheelhouse(self):
+        uri = self.wheelhouse_uri()
+        if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            self.logger.info(f"Using wheelhouse {uri}")
+            return False
+
+        self.logger.info(f"Building wheelhouse on worker 0 and uploading it to {uri}...")
+        log_file = Path(self.cfg.job.dir) / "logs" / "venv_wheelhouse.log"
+        remote_req_file = f"~/requirements_{self.env_name}.txt"
+        w = f"/tmp/jobman-wheels-{self.wheelhouse_key()}"
+        # Resolve once into exact pins (pip's dry-run report), fetch exactly those
+        # (sdists included), then `pip wheel` compiles the sdists once
+        remote_cmd = f"""
+            set -e
+            {self._venv_cmd()}
+            PIP={self.path}/bin/pip
+            rm -rf {w} && mkdir -p {w}
+            t0=$(date +%s)
+            $PIP install --dry-run --ignore-installed --quiet --report {w}.json -r {remote_req_file}
+            {self.path}/bin/python -c {shlex.quote(PIN_SCRIPT)} {w}.json > {w}.txt
+            t1=$(date +%s)
+            $PIP download --no-deps -r {w}.txt -d {w}
+            $PIP download --no-deps pip -d {w}
+            t2=$(date +%s)
+            $PIP wheel --no-deps -r {w}.txt -w {w} --no-index --find-links {w}
+            t3=$(date +%s)
+            tar -czf {w}.tar.gz -C {w} .
+            gcloud storage cp {w}.tar.gz {uri}
+            t4=$(date +%s)
+            rm -rf {w} {w}.tar.gz {w}.json {w}.txt
+            echo "JOBMAN_TIMING resolve $((t1-t0)) download $((t2-t1)) build $((t3-t2)) upload $((t4-t3))"
+        """
+        with open(log_file, "w") as f:
+            self.remote.copy(0, self.requirements_file, remote_req_file, check=True, stdout=f, stderr=f)
+            result = self.remote.run(0, remote_cmd, check=True, stdout=subprocess.PIPE, stderr=f)
+            f.write(result.stdout or "")
+        self.logger.info(f"Wheelhouse built: {timings(result.stdout)}")
+        return True
+
+    def prebuild(self):
+        """
+        Fill the wheelhouse from this host with binary wheels for the workers'
+        platform. Fails (and is left to worker 0) if a requirement is sdist-only.
+        """
+        if not self.wheelhouse:
+            return False
+        # Holding the lock makes setup wait for this instead of building on worker 0 as well
+        with self.wheelhouse_lock:
+            if self.wheelhouse_state is not None:
+                return False
+            uri = self.wheelhouse_uri()
+            if gcloud.run(["gcloud", "storage", "ls", uri], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                self.wheelhouse_state = False
+                return False
+            glibc = self.worker_glibc()
+            if glibc is None:
+                self.logger.info(f"glibc of TPU image {self.cfg.tpu.get('version', '')} unknown (set venv.glibc); the wheelhouse is built on worker 0")
+                return False
+            self.logger.info(f"Downloading wheels on this host to {uri}...")
+            version = self.python.replace("python", "")
+            # Every manylinux tag the workers' glibc can load, newest first
+            minor = int(glibc.split("_")[1])
+            tags = [f"manylinux_2_{m}_x86_64" for m in range(minor, 16, -1)] + ["manylinux2014_x86_64", "linux_x86_64"]
+            platforms = " ".join(f"--platform {p}" for p in tags)
+            with tempfile.TemporaryDirectory(prefix="jobman-wheels-") as w:
+                cmd = f"""
+                    set -e
+                    python3 -m pip download -r {Path(self.requirements_file).expanduser()} pip -d {w}/wheels \
+                        --only-binary=:all: {platforms} --python-version {version} --implementation cp
+                    tar -czf {w}/wheels.tar.gz -C {w}/wheels .
+                    gcloud storage cp {w}/wheels.tar.gz {uri}
+                """
+                with open(Path(self.cfg.job.dir) / "logs" / "venv_prebuild.log", "w") as f:
+                    # A local build, not a gcloud call
+                    engine.run(["bash", "-c", cmd], check=True, stdout=f, stderr=f, bounded=False)
+            self.wheelhouse_state = False
+            return True
+
+    def _install_cmd(self, remote_req_file):
+        """Offline install: neither apt nor PyPI, pip itself comes from the wheelhouse too."""
+        w = f"/tmp/jobman-wheels-{self.wheelhouse_key()}"
+        return f"""
+            set -e
+            rm -rf {w} && mkdir -p {w}
+            t0=$(date +%s)
+            gcloud storage cp {self.wheelhouse_uri()} - | tar -xzf - -C {w}
+            t1=$(date +%s)
+            mkdir -p ~/venv
+            [ -x {self.path}/bin/python ] || {self.python} -m venv --without-pip {self.path}
+            [ -x {self.path}/bin/pip ] || {self.path}/bin/python $(ls {w}/pip-*.whl | head -n 1)/pip install --no-index --find-links {w} pip
+            {self.path}/bin/pip install --no-index --find-links {w} -r {remote_req_file}
+            t2=$(date +%s)
+            rm -rf {w}
+            echo "JOBMAN_TIMING fetch $((t1-t0)) install $((t2-t1))"
+        """
+
+    def boot_script(self):
+        remote_req_file = f"~/requirements_{self.env_name}.txt"
+        install = f"""
+                {self._venv_cmd()}
+                {self.path}/bin/pip install -r {remote_req_file}
+        """
+        if self.wheelhouse:
+            # Install offline if the wheelhouse was built before, else from the index
+            install = f"""
+                if gcloud storage ls {self.wheelhouse_uri()} >/dev/null 2>&1; then
+                    {self._install_cmd(remote_req_file)}
+                else
+                    {install}
+                fi
+            """
+        data = base64.b64encode(Path(self.requirements_file).expanduser().read_bytes()).decode()
+        return f"""
+            set -e
+            echo {data} | base64 -d > {remote_req_file}
+            {install}
+        """
+
+    def fingerprint(self):
+        return fingerprint("venv", self.env_name, self.python, Path(self.requirements_file))
+
     def check(self):
         pass      
         
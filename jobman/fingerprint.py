@@ -0,0 +1,62 @@
+import hashlib
+import asyncio
+import subprocess
+from pathlib import Path
+
+from jobman.engine import engine
+
+# Markers of stages whose result survives a reboot (packages, envs, images) ...
+DISK_DIR = "~/.jobman/stages"
+# ... and of stages whose result does not (mounts): tmpfs, cleared on reboot
+MEM_DIR = "/dev/shm/jobman-stages"
+
+def fingerprint(*parts):
+    """Hash strings and files (Path objects are hashed by content) into a short hex digest."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, Path):
+            h.update(part.expanduser().read_bytes())
+        else:
+            h.update(str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+class StageMarkers:
+    """
+    Per-worker record of setup stages that completed, keyed by fingerprint.
+
+    A stage writes `<dir>/<stage name>` containing its fingerprint when it
+    succeeds; `read_all` fetches every marker of a worker in one call.
+    """
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    async def _read(self, i):
+        cmd = (
+            f'for d in {DISK_DIR} {MEM_DIR}; do for f in "$d"/*; do '
+            f'[ -f "$f" ] && echo "$d $(basename "$f") $(cat "$f")"; done; done; true'
+        )
+        result = await self.remote.arun(i, cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        markers = {}
+        for line in (result.stdout or "").splitlines() if result.returncode == 0 else []:
+            parts = line.split()
+            if len(parts) == 3:
+                volatile = parts[0] == MEM_DIR
+                markers[(parts[1], volatile)] = parts[2]
+        return markers
+
+    def read_all(self, workers):
+        """{worker: {(stage name, volatile): fingerprint}} for every worker."""
+        async def _read_all():
+            workers_ = list(workers)
+            results = await asyncio.gather(*[self._read(i) for i in workers_], return_exceptions=True)
+            return {i: {} if isinstance(r, Exception) else r for i, r in zip(workers_, results)}
+        return engine.call(_read_all())
+
+    def write(self, i, name, fp, volatile=False):
+        d = MEM_DIR if volatile else DISK_DIR
+        return self.remote.run(
+            i, f"mkdir -p {d} && echo {fp} > {d}/{name}",
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ).returncode == 0
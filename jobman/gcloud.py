@@ -0,0 +1,231 @@
+import sys
+import json
+import time
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+from jobman.engine import engine
+
+# gcloud verbs whose output only depends on control-plane state
+READ_VERBS = {"describe", "list"}
+# gcloud verbs that change control-plane state and invalidate cached reads
+WRITE_VERBS = {"create", "delete", "start", "stop", "update", "reset"}
+
+def command_verb(argv):
+    """Return the gcloud verb of `argv`, i.e. the last positional token before any flag."""
+    verb = None
+    for token in argv[1:]:
+        if token.startswith("-"):
+            break
+        if token in READ_VERBS or token in WRITE_VERBS:
+            verb = token
+    return verb
+
+def _write_to(stream, data):
+    if not data or stream is subprocess.PIPE or stream is subprocess.DEVNULL:
+        return
+    (stream or sys.stdout).write(data)
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class GCloud:
+    """
+    Shared execution layer for gcloud invocations.
+
+    - identical in-flight read calls (describe/list) are coalesced into one subprocess
+    - successful read results are cached for `ttl` seconds
+    - any create/delete/... call through this layer drops the read cache
+    - every call is appended to the ledger files (argv, duration, exit code, source)
+    - subprocesses run on the shared engine (jobman.engine), which bounds concurrency
+    """
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.ledger_lock = threading.Lock()
+        self.cache = {}
+        self.inflight = {}
+        # match token (None = every call) -> ledger file
+        self.ledger_files = {}
+
+    def set_ledger_file(self, path, match=None):
+        """Append calls whose argv contains `match` (all calls if None) to `path`."""
+        with self.ledger_lock:
+            if path is None:
+                self.ledger_files.pop(match, None)
+                return
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.ledger_files[match] = path
+
+    @property
+    def isolate(self):
+        """Run each call in its own process group (no controlling terminal, e.g. in the daemon)."""
+        return engine.isolate
+
+    @isolate.setter
+    def isolate(self, value):
+        engine.isolate = value
+
+    def invalidate(self):
+        with self.lock:
+            self.cache.clear()
+
+    def run(self, argv, stdout=None, stderr=None, check=False, timeout=None, max_age=None, input=None, dest=None, bounded=True):
+        """
+        Drop-in replacement for `subprocess.run(argv, ...)` on gcloud command lines.
+        Reads accept a cached result no older than `max_age` seconds (default: the TTL).
+        `input` is written to the call's stdin; `dest` and `bounded` go to the engine's limits.
+        """
+        argv = [str(x) for x in argv]
+        verb = command_verb(argv)
+
+        if verb in READ_VERBS:
+            result = self._run_read(argv, timeout, self.ttl if max_age is None else max_age)
+            _write_to(stdout, result.stdout)
+            _write_to(stderr, result.stderr)
+        else:
+            if verb in WRITE_VERBS:
+                self.invalidate()
+            try:
+                result = self._exec(argv, stdout, stderr, timeout, input, dest, bounded)
+            finally:
+                if verb in WRITE_VERBS:
+                    self.invalidate()
+
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, argv, result.stdout, result.stderr)
+        return result
+
+    async def arun(self, argv, stdout=None, stderr=None, check=False, timeout=None, input=None, dest=None, bounded=True, on_line=None):
+        """`run` for coroutines on the engine loop (ssh/scp/write calls; reads are not cached here)."""
+        argv = [str(x) for x in argv]
+        verb = command_verb(argv)
+        if verb in WRITE_VERBS:
+            self.invalidate()
+        try:
+            result = await self._aexec(argv, stdout, stderr, timeout, input, dest, bounded, on_line)
+        finally:
+            if verb in WRITE_VERBS:
+                self.invalidate()
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, argv, result.stdout, result.stderr)
+        return result
+
+    def _run_read(self, argv, timeout, max_age):
+        key = tuple(argv)
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit is not None and time.monotonic() - hit[0] <= min(max_age, self.ttl):
+                self._record(argv, 0.0, hit[1].returncode, "cache")
+                return hit[1]
+            call = self.inflight.get(key)
+            owner = call is None
+            if owner:
+                call = self.inflight[key] = _InFlight()
+
+        if not owner:
+            start = time.monotonic()
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            self._record(argv, time.monotonic() - start, call.result.returncode, "coalesced")
+            return call.result
+
+        try:
+            call.result = self._exec(argv, subprocess.PIPE, subprocess.PIPE, timeout)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+                if call.result is not None and call.result.returncode == 0:
+                    self.cache[key] = (time.monotonic(), call.result)
+            call.event.set()
+
+    def _exec(self, argv, stdout, stderr, timeout, input=None, dest=None, bounded=True):
+        return engine.call(self._aexec(argv, stdout, stderr, timeout, input, dest, bounded))
+
+    async def _aexec(self, argv, stdout, stderr, timeout, input=None, dest=None, bounded=True, on_line=None):
+        start = time.monotonic()
+        returncode = None
+        try:
+            result = await engine.exec(
+                argv, stdout=stdout, stderr=stderr, input=input, timeout=timeout,
+                dest=dest, bounded=bounded, on_line=on_line,
+            )
+            returncode = result.returncode
+            return result
+        finally:
+            self._record(argv, time.monotonic() - start, returncode, "exec")
+
+    def stream(self, argv, on_line, stderr=None, input=None, dest=None, bounded=True):
+        """Run `argv` and call `on_line` with each stdout line as it arrives."""
+        argv = [str(x) for x in argv]
+        return engine.call(self._aexec(argv, None, stderr, None, input, dest, bounded, on_line))
+
+    def terminate(self, *matches):
+        """Terminate every live call whose argv contains all of `matches` (e.g. a TPU name and zone)."""
+        return engine.terminate(*matches)
+
+    def _record(self, argv, duration, returncode, source):
+        entry = {
+            "argv": [a if len(a) <= 200 else a[:200] + "..." for a in argv],
+            "verb": command_verb(argv),
+            "started_at": datetime.now().isoformat(),
+            "duration": round(duration, 4),
+            "returncode": returncode,
+            "source": source,
+        }
+        with self.ledger_lock:
+            for match, path in self.ledger_files.items():
+                if match is None or any(match in a for a in argv):
+                    with open(path, "a") as f:
+                        f.write(json.dumps(entry) + "\n")
+
+def summarize_ledger(path):
+    """Aggregate a ledger file into rows of (command, calls, exec, cached, coalesced, failed, total s, max s)."""
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            argv = entry["argv"]
+            # Group by the positional command path, e.g. "compute tpus tpu-vm describe"
+            positional = []
+            for token in argv[1:]:
+                if token.startswith("-"):
+                    break
+                positional.append(token)
+                if token == entry.get("verb") or token in {"ssh", "scp"}:
+                    break
+            # Direct ssh/scp calls (no gcloud) are grouped by the program name
+            name = " ".join(positional) if argv[0] == "gcloud" else argv[0]
+            s = stats.setdefault(name, {"calls": 0, "exec": 0, "cache": 0, "coalesced": 0, "failed": 0, "total": 0.0, "max": 0.0})
+            s["calls"] += 1
+            s[entry["source"]] += 1
+            if entry["source"] == "exec":
+                s["total"] += entry["duration"]
+                s["max"] = max(s["max"], entry["duration"])
+                if entry["returncode"] != 0:
+                    s["failed"] += 1
+    return [
+        [name, s["calls"], s["exec"], s["cache"], s["coalesced"], s["failed"], round(s["total"], 2), round(s["max"], 2)]
+        for name, s in sorted(stats.items(), key=lambda kv: -kv[1]["total"])
+    ]
+
+# Process-wide instance shared by every component
+gcloud = GCloud()
+
+def run(argv, **kwargs):
+    return gcloud.run(argv, **kwargs)
+
+def stream(argv, on_line, **kwargs):
+    return gcloud.stream(argv, on_line, **kwargs)
@@ -1,14 +1,131 @@
+import json
+import time
+import asyncio
 import subprocess
-import concurrent.futures
 from pathlib import Path
 from textwrap import dedent
-from jobman.utils import setup_logger
+from omegaconf import OmegaConf
+from jobman.engine import engine
+from jobman.remote import Remote
+from jobman.dag import run_per_worker
+from jobman.fingerprint import fingerprint
+from jobman.utils import APT_GET, setup_logger
+
+BASE_OPTIONS = "--implicit-dirs --dir-mode=777 --file-mode=777 --o allow_other"
+
+# Mount profiles: extra gcsfuse flags ({cache_dir} and {cache_size_mb} are filled
+# in from the config) and the kernel read-ahead set on the mount, in KiB
+PROFILES = {
+    "default": {"options": [], "read_ahead_kb": None},
+    # Large, immutable training data read front to back: cache whole files on
+    # local disk with parallel chunked downloads, and never revalidate metadata
+    "dataset-streaming": {
+        "options": [
+            "--cache-dir={cache_dir}", "--file-cache-max-size-mb={cache_size_mb}",
+            "--file-cache-cache-file-for-range-read", "--file-cache-enable-parallel-downloads",
+            "--metadata-cache-ttl-secs=-1", "--stat-cache-max-size-mb=-1", "--type-cache-max-size-mb=-1",
+        ],
+        "read_ahead_kb": 1024,
+    },
+    # Checkpoints: stream writes to GCS instead of staging whole files locally,
+    # allow directory renames (atomic checkpoint commits) and restore with parallel downloads
+    "checkpoint-write": {
+        "options": [
+            "--enable-streaming-writes", "--rename-dir-limit=200000",
+            "--cache-dir={cache_dir}", "--file-cache-max-size-mb={cache_size_mb}",
+            "--file-cache-enable-parallel-downloads", "--metadata-cache-ttl-secs=60",
+        ],
+        "read_ahead_kb": 1024,
+    },
+    # Many small files (tokenizers, configs, sharded indexes): cache metadata and listings
+    "small-file-metadata": {
+        "options": [
+            "--cache-dir={cache_dir}", "--file-cache-max-size-mb={cache_size_mb}",
+            "--metadata-cache-ttl-secs=600", "--stat-cache-max-size-mb=-1", "--type-cache-max-size-mb=-1",
+            "--kernel-list-cache-ttl-secs=600",
+        ],
+        "read_ahead_kb": None,
+    },
+}
+
+# Run on a worker with python3: times write, cold/warm sequential read, random read
+# and metadata ops under <mount>/.jobman-bench/w<i>, then prints one JSON line
+BENCH_SCRIPT = dedent("""
+    import os, sys, json, time, random, shutil, subprocess
+    root, size_mb, files = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    os.makedirs(root, exist_ok=True)
+    path, mb = os.path.join(root, "seq"), 1 << 20
+
+    def drop_caches():
+        subprocess.run("sync; echo 3 | sudo tee /proc/sys/vm/drop_caches", shell=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def read_all():
+        start = time.monotonic()
+        with open(path, "rb", buffering=0) as f:
+            while f.read(mb):
+                pass
+        return size_mb / (time.monotonic() - start)
+
+    res = {}
+    block = os.urandom(mb)
+    start = time.monotonic()
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+    res["write_mbps"] = size_mb / (time.monotonic() - start)
+
+    drop_caches()
+    res["seq_read_mbps"] = read_all()
+    drop_caches()
+    res["warm_read_mbps"] = read_all()
+
+    drop_caches()
+    reads, size = 256, 64 << 10
+    start = time.monotonic()
+    with open(path, "rb", buffering=0) as f:
+        for _ in range(reads):
+            f.seek(random.randrange(0, size_mb * mb - size))
+            f.read(size)
+    res["rand_read_iops"] = reads / (time.monotonic() - start)
+
+    meta = os.path.join(root, "meta")
+    os.makedirs(meta, exist_ok=True)
+    start = time.monotonic()
+    for k in range(files):
+        with open(os.path.join(meta, str(k)), "w") as f:
+            f.write("x")
+    for _ in range(2):
+        for name in os.listdir(meta):
+            os.stat(os.path.join(meta, name))
+    res["meta_ops"] = files * 3 / (time.monotonic() - start)
+
+    shutil.rmtree(root, ignore_errors=True)
+    print("JOBMAN_BENCH " + json.dumps(res))
+""")
 
 class GCSFUSE:
     def __init__(self, cfg):
         self.cfg = cfg
         self.bucket = cfg.gcsfuse.bucket_name
         self.mount_path = cfg.gcsfuse.mount_path
+        self.remote = Remote(cfg)
+
+        profiles = dict(PROFILES)
+        profiles.update(OmegaConf.to_container(cfg.gcsfuse.get("profiles", None) or OmegaConf.create({})))
+        self.profile = cfg.gcsfuse.get("profile", "default")
+        if self.profile not in profiles:
+            raise ValueError(f"Invalid gcsfuse profile {self.profile}, expected one of {', '.join(profiles)}")
+        profile = profiles[self.profile]
+        self.cache_dir = cfg.gcsfuse.get("cache_dir", "/tmp/jobman-gcsfuse-cache")
+        options = [
+            o.format(cache_dir=self.cache_dir, cache_size_mb=cfg.gcsfuse.get("cache_size_mb", 32768))
+            for o in list(profile.get("options", [])) + list(cfg.gcsfuse.get("options", []))
+        ]
+        self.mount_options = " ".join([BASE_OPTIONS] + options)
+        self.read_ahead_kb = profile.get("read_ahead_kb", None)
+        # Fingerprint of the mount a worker has (tmpfs, like the mount), so a changed profile remounts
+        self.state_file = f"/dev/shm/jobman-gcsfuse-{fingerprint(self.mount_path)}"
 
         self.logger = setup_logger(log_file=Path(cfg.job.dir) / "logs" / "job.log")
         
@@ -19,19 +136,12 @@ class GCSFUSE:
             self.logger.error("GCSFuse config missing `bucket_name` or `mount_path`.")
             return False
         
-        any_failed = False
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg.tpu.num_workers) as executor:
-            futures = [executor.submit(self._setup_worker, i) for i in range(self.cfg.tpu.num_workers)]
-            for future in concurrent.futures.as_completed(futures):
-                if exc := future.exception():
-                    self.logger.error(f"Worker thread failed: {exc}")
-                    any_failed = True
-
-        if any_failed:
+        ok = run_per_worker("gcsfuse", self._setup_worker, range(self.cfg.tpu.num_workers), self.logger)
+        if not ok:
             self.logger.warning("GCSFuse setup completed with at least one worker failed.")
         else:
             self.logger.info("GCSFuse setup completed successfully on all workers.")
-        return not any_failed
+        return ok
 
     def _setup_worker(self, i):
         if self._check_worker(i):
@@ -41,7 +151,17 @@ class GCSFUSE:
         self.logger.info(f"Worker {i}: Setting up GCSFuse...")
         log_file = Path(self.cfg.job.dir) / "logs" / f"gcsfuse_worker_{i}.log"
 
-        gcsfuse_script = dedent(f"""
+        with open(log_file, "w") as f:
+            try:
+                self.remote.run(i, self.mount_script(), check=True, stdout=f, stderr=f)
+                self.logger.info(f"Worker {i}: GCSFuse setup complete.")
+            except subprocess.CalledProcessError as e:
+                self.logger.error(f"Worker {i}: GCSFuse setup failed: {e}")
+                raise
+
+    def mount_script(self):
+        """Installs gcsfuse and mounts the bucket; safe to rerun."""
+        return dedent(f"""
             set -e
             GCSFUSE_REPO=gcsfuse-$(lsb_release -c -s)
             echo '[INFO] Adding gcsfuse repo...'
@@ -50,18 +170,8 @@ class GCSFUSE:
             echo '[INFO] Downloading GPG key...'
             sudo curl -s https://packages.cloud.google.com/apt/doc/apt-key.gpg | sudo tee /usr/share/keyrings/cloud.google.asc >/dev/null
 
-            if sudo fuser /var/lib/dpkg/lock-frontend >/dev/null 2>&1; then
-                LOCK_PID=$(sudo lsof -t /var/lib/dpkg/lock-frontend || true)
-                if [ -n "$LOCK_PID" ]; then
-                    echo "[WARN] Killing process $LOCK_PID holding dpkg lock"
-                    sudo kill -9 $LOCK_PID
-                    sleep 2
-                fi
-            fi
-            # This is needed because sometimes the lock is occupied and installation fails
-
             echo '[INFO] Updating packages and installing gcsfuse...'
-            sudo apt-get update -y && sudo apt-get install -y gcsfuse
+            {APT_GET} update -y && {APT_GET} install -y gcsfuse
 
             if ! command -v gcsfuse &> /dev/null; then
                 echo '[ERROR] gcsfuse install failed!'
@@ -71,50 +181,78 @@ class GCSFUSE:
             echo '[INFO] Creating mount path...'
             sudo mkdir -p {self.mount_path}
 
-            echo '[INFO] Mounting bucket...'
-            mountpoint -q {self.mount_path} || sudo gcsfuse --implicit-dirs --dir-mode=777 --file-mode=777 --o allow_other {self.bucket} {self.mount_path}
+            if mountpoint -q {self.mount_path} && [ "$(cat {self.state_file} 2>/dev/null)" != "{self.fingerprint()}" ]; then
+                echo '[INFO] Mount options changed, unmounting...'
+                sudo umount {self.mount_path}
+            fi
+
+            echo '[INFO] Mounting bucket with profile {self.profile}...'
+            sudo mkdir -p {self.cache_dir}
+            mountpoint -q {self.mount_path} || sudo gcsfuse {self.mount_options} {self.bucket} {self.mount_path}
+            {self._read_ahead_cmd()}
+            echo {self.fingerprint()} > {self.state_file}
 
             echo '[INFO] Listing contents...'
             ls -la {self.mount_path}
         """)
 
-        ssh_cmd = [
-            "gcloud", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-            f"--worker={i}",
-            f"--zone={self.cfg.tpu.zone}",
-            f"--ssh-key-file={self.cfg.ssh.private_key}",
-            "--ssh-flag=-o ConnectTimeout=15",
-            "--ssh-flag=-o StrictHostKeyChecking=no",
-            "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-            "--command", gcsfuse_script,
-            "--quiet",
-        ]
+    def boot_script(self):
+        return self.mount_script()
+
+    def _read_ahead_cmd(self):
+        if not self.read_ahead_kb:
+            return ""
+        # The mount's backing device, as in the gcsfuse performance docs
+        return f'echo {self.read_ahead_kb} | sudo tee /sys/class/bdi/0:$(stat -c "%d" {self.mount_path})/read_ahead_kb'
 
+    def fingerprint(self):
+        return fingerprint("gcsfuse", self.bucket, self.mount_path, self.mount_options, self.read_ahead_kb)
+
+    def bench(self, size_mb=1024, files=500, workers=None):
+        """
+        Benchmark the mount on every worker in parallel. Returns one dict per
+        worker (throughputs in MB/s, random reads and metadata ops per second),
+        also appended to logs/gcsfuse_bench.jsonl to compare profiles across runs.
+        """
+        workers = list(range(self.cfg.tpu.num_workers)) if workers is None else list(workers)
+        self.logger.info(f"Benchmarking GCSFuse profile {self.profile} on {len(workers)} workers ({size_mb} MB file, {files} small files)...")
+
+        async def _run():
+            return await asyncio.gather(*[self._bench_worker(i, size_mb, files) for i in workers])
+        results = engine.call(_run())
+
+        with open(Path(self.cfg.job.dir) / "logs" / "gcsfuse_bench.jsonl", "a") as f:
+            for res in results:
+                f.write(json.dumps(res) + "\n")
+        return results
+
+    async def _bench_worker(self, i, size_mb, files):
+        log_file = Path(self.cfg.job.dir) / "logs" / f"gcsfuse_bench_worker_{i}.log"
+        root = f"{self.mount_path}/.jobman-bench/w{i}"
+        res = {"worker": i, "profile": self.profile, "time": time.time()}
         with open(log_file, "w") as f:
-            try:
-                subprocess.run(ssh_cmd, check=True, stdout=f, stderr=f)
-                self.logger.info(f"Worker {i}: GCSFuse setup complete.")
-            except subprocess.CalledProcessError as e:
-                self.logger.error(f"Worker {i}: GCSFuse setup failed: {e}")
+            result = await self.remote.arun(
+                i, f"python3 - {root} {size_mb} {files}", input=BENCH_SCRIPT,
+                stdout=subprocess.PIPE, stderr=f, bounded=False,
+            )
+            f.write(result.stdout or "")
+        for line in (result.stdout or "").splitlines():
+            if line.startswith("JOBMAN_BENCH "):
+                res.update(json.loads(line[len("JOBMAN_BENCH "):]))
+        if "write_mbps" not in res:
+            self.logger.error(f"Worker {i}: GCSFuse benchmark failed, see {log_file}")
+        return res
 
     def _check_worker(self, i):
         self.logger.info(f"Worker {i}: Checking GCSFuse...")
         log_file = Path(self.cfg.job.dir) / "logs" / f"gcsfuse_worker_{i}.log"
-        cmd = f"which gcsfuse && mount | grep {self.mount_path} && test -n \"$(sudo ls -A {self.mount_path} 2>/dev/null)\""
+        cmd = (
+            f"which gcsfuse && mount | grep {self.mount_path} && test -n \"$(sudo ls -A {self.mount_path} 2>/dev/null)\" "
+            f"&& [ \"$(cat {self.state_file} 2>/dev/null)\" = \"{self.fingerprint()}\" ]"
+        )
         with open(log_file, "w") as f:
             try:
-                check_cmd = [
-                    "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-                    "--zone", self.cfg.tpu.zone,
-                    f"--worker={i}",
-                    "--command", cmd,
-                    f"--ssh-key-file={self.cfg.ssh.private_key}",
-                    "--ssh-flag=-o ConnectTimeout=15",
-                    "--ssh-flag=-o StrictHostKeyChecking=no",
-                    "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-                    "--quiet",
-                ]
-                if subprocess.run(check_cmd, check=True, stdout=f, stderr=f).returncode == 0:
+                if self.remote.run(i, cmd, check=True, stdout=f, stderr=f).returncode == 0:
                     return True
                 else:   
                     return False
@@ -2,6 +2,7 @@ import os
 import json
 import time
 import logging
+import threading
 import subprocess
 from pathlib import Path
 from omegaconf import OmegaConf
@@ -9,11 +10,19 @@ from omegaconf import OmegaConf
 from jobman.tpu import TPU
 from jobman.ssh import SSH
 from jobman.gcsfuse import GCSFUSE 
+from jobman.data import DATA
+from jobman.code import CODE
 from jobman.envs.docker import DOCKER
 from jobman.envs.conda import CONDA 
 from jobman.envs.venv import VENV
 from jobman.command import COMMAND
+from jobman.pool import WarmPool
+from jobman.dag import Stage, SetupDAG
+from jobman.remote import Remote
+from jobman.fingerprint import StageMarkers
+from jobman.bootstrap import Bootstrap
 
+from jobman import gcloud
 from jobman.utils import setup_logger
 
 class Job:
@@ -28,9 +37,15 @@ class Job:
         self.loop = cfg.job.get('loop', False)
        
         self.tpu = TPU(cfg)
+        # Shared with TPU so waits and retries stop promptly on cancel
+        self.cancelled = self.tpu.cancelled
         self.ssh = SSH(cfg)
         self.gcsfuse = GCSFUSE(cfg)
+        self.data = DATA(cfg)
+        self.code = CODE(cfg)
         self.command = COMMAND(cfg)
+        self.remote = Remote(cfg)
+        self.markers = StageMarkers(self.remote)
         
         self.env_type = cfg.job.env_type
         if self.env_type == 'docker':
@@ -40,10 +55,18 @@ class Job:
         elif self.env_type == 'venv':
             self.env = VENV(cfg)
         else:
-            raise ValueError(f"Invalid env type {env_type}")
+            raise ValueError(f"Invalid env type {self.env_type}")
         
         self.log_file = Path(self.dir) / 'logs' / 'job.log'
         self.logger = setup_logger(log_file=self.log_file)
+        # Workers set themselves up at boot; True once this run created a TPU that does
+        self.bootstrap = cfg.job.get('bootstrap', False)
+        self.booting = False
+        # Artifacts built while the TPU is allocated: [(name, start, end)], and when it became ready
+        self.prebuild_enabled = cfg.job.get('prebuild', False)
+        self.prebuilt = []
+        self.tpu_ready_at = None
+        gcloud.gcloud.set_ledger_file(Path(self.dir) / 'logs' / 'gcloud_ledger.jsonl', match=self.tpu.name)
 
     def request(self):
         self.logger.info("Checking TPU status...")
@@ -51,32 +74,180 @@ class Job:
         if ready:
             return True
          
+        if self.bootstrap:
+            try:
+                self.boot().render()
+            except Exception as e:
+                self.logger.warning(f"Cannot render boot-time setup, setting up over SSH: {e}")
+                (Path(self.dir) / "bootstrap.sh").unlink(missing_ok=True)
+
+        if self.prebuild_enabled:
+            threading.Thread(target=self.prebuild, name="jobman-prebuild", daemon=True).start()
+
         self.logger.info("Requesting TPU...")
         success = self.tpu.request()
+        self.tpu_ready_at = time.monotonic()
         if not success:
             self.logger.error("TPU allocation failed.")
             return False
         
+        self.booting = self.bootstrap and (Path(self.dir) / "bootstrap.sh").exists()
         self.cfg.tpu.ips = self.tpu.get_ips()
-        OmegaConf.save(cfg, Path(self.dir) / "config.yaml")
+        # The allocation may have landed on a different candidate zone/accelerator
+        self.command.workers = self.command.infer_workers()
+        OmegaConf.save(self.cfg, Path(self.dir) / "config.yaml")
         return True
 
+    def setup_stages(self):
+        """Per-worker setup graph: gcsfuse and the env only need SSH, not each other (their apt calls share APT_GET's lock)."""
+        stages = [
+            Stage("ssh", self.ssh._setup_worker, fingerprint=self.ssh.fingerprint),
+            Stage("gcsfuse", self.gcsfuse._setup_worker, after=["ssh"], fingerprint=self.gcsfuse.fingerprint, volatile=True),
+            Stage(self.env_type, self.env.setup_worker, after=["ssh"], fingerprint=self.env.fingerprint),
+        ]
+        if self.code.enabled:
+            stages.append(Stage("code", self.code._setup_worker, after=["ssh"], fingerprint=self.code.fingerprint))
+        if self.data.enabled:
+            stages.append(Stage("data", self.data._setup_worker, after=["ssh"], fingerprint=self.data.fingerprint, volatile=self.data.volatile))
+        if self.env.persistent:
+            # Not fingerprinted: a cheap health check that runs every time. Waits for every
+            # bind mount source, else docker creates the missing ones owned by root
+            after = [self.env_type, "gcsfuse"] + [s.name for s in stages if s.name in ("code", "data")]
+            stages.append(Stage("container", self.env.warm_worker, after=after))
+        return stages
+
+    def prebuild(self):
+        """Build what does not need the TPU (env artifacts, code snapshot, dataset listing) while it is allocated."""
+        tasks = [(self.env_type, self.env.prebuild)]
+        if self.data.enabled:
+            tasks.append(("data listing", self.data.list_files))
+        if self.code.enabled:
+            tasks.append(("code snapshot", self.code.ensure_snapshot))
+
+        def run(name, fn):
+            start = time.monotonic()
+            try:
+                if fn():
+                    self.prebuilt.append((name, start, time.monotonic()))
+            except Exception as e:
+                self.logger.warning(f"Prebuilding {name} failed, it is built during setup instead: {e}")
+
+        threads = [threading.Thread(target=run, args=task) for task in tasks]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def report_prebuild(self):
+        """Log how much setup work ran while waiting for the TPU instead of after it."""
+        if not self.prebuilt or self.tpu_ready_at is None:
+            return
+        report = {
+            name: {"seconds": round(end - start, 1), "while_waiting": round(max(0.0, min(end, self.tpu_ready_at) - start), 1)}
+            for name, start, end in self.prebuilt
+        }
+        saved = sum(r["while_waiting"] for r in report.values())
+        self.logger.info(
+            "Prebuilt while waiting for the TPU: " + ", ".join(f"{n} {r['seconds']:.0f}s" for n, r in report.items())
+            + f"; {saved:.0f}s of setup work taken off the critical path"
+        )
+        with open(Path(self.dir) / "logs" / "prebuild.json", "w") as f:
+            json.dump({"artifacts": report, "saved_seconds": round(saved, 1)}, f, indent=2)
+        self.prebuilt = []
+
+    def boot(self):
+        """Boot-time variant of the setup stages that can run without the submit host."""
+        fps = self.stage_fingerprints(self.setup_stages())
+        stages = []
+        for component, name, volatile in [(self.gcsfuse, "gcsfuse", True), (self.env, self.env_type, False)]:
+            script = component.boot_script()
+            if script and fps.get(name):
+                stages.append((name, fps[name], volatile, script))
+        return Bootstrap(self.cfg, stages, self.remote.user)
+
+    def stage_fingerprints(self, stages):
+        fps = {}
+        for stage in stages:
+            try:
+                fps[stage.name] = stage.fingerprint() if stage.fingerprint else None
+            except Exception as e:
+                self.logger.warning(f"Cannot fingerprint stage {stage.name}, it will always run: {e}")
+                fps[stage.name] = None
+        return fps
+    
     def setup(self):
-        if not self.ssh.setup():
-            return False
-        if not self.gcsfuse.setup():
-            return False
-        if not self.env.setup():
+        self.logger.info("Setting up TPU workers...")
+        # One persistent SSH connection per worker, reused by every setup stage and the command
+        self.remote.open_all()
+
+        if self.booting:
+            # Whatever did not finish at boot is done over SSH below
+            self.boot().wait(
+                range(self.cfg.tpu.num_workers), timeout=self.cfg.job.get('bootstrap_timeout', 1800), cancelled=self.cancelled,
+            )
+            self.booting = False
+
+        stages = self.setup_stages()
+        workers = range(self.cfg.tpu.num_workers)
+        fps = self.stage_fingerprints(stages) if self.cfg.job.get("setup_cache", True) else {}
+        # Stages whose marker on the worker matches the current fingerprint are skipped
+        markers = self.markers.read_all(workers) if any(fps.values()) else {}
+        cached = {
+            (i, s.name) for i in workers for s in stages
+            if fps.get(s.name) and markers.get(i, {}).get((s.name, s.volatile)) == fps[s.name]
+        }
+        if cached:
+            self.logger.info(f"Skipping {len(cached)} worker stage(s) already done with the same fingerprint")
+
+        def on_done(i, stage):
+            if fps.get(stage.name) is None:
+                return
+            try:
+                if self.markers.write(i, stage.name, fps[stage.name], stage.volatile):
+                    return
+            except Exception:
+                pass
+            self.logger.warning(f"Worker {i}: failed to record {stage.name} marker; it will rerun next time")
+
+        dag = SetupDAG(
+            stages,
+            workers=workers,
+            logger=self.logger,
+            timings_file=Path(self.dir) / "logs" / "setup_timings.json",
+            cached=cached,
+            on_done=on_done,
+        )
+        ok = dag.run()
+        self.report_prebuild()
+        if not ok:
+            self.logger.warning("Setup completed with at least one worker stage failed.")
             return False
         
+        self.logger.info("Setup completed successfully on all workers.")
         return True
     
     def execute(self):
-        self.command.full_cmd = self.env.patch_command(self.command.base_cmd)
+        cmd = self.command.base_cmd
+        if self.command.sync_start:
+            cmd = self.command.barrier(cmd)
+        if self.data.enabled:
+            cmd = self.data.patch_command(cmd)
+        if self.code.enabled:
+            cmd = self.code.patch_command(cmd)
+        self.command.full_cmd = self.env.patch_command(cmd)
         return self.command.run()
     
+    def cancel(self):
+        self.cancelled.set()
+        
     def run(self):
-        while True:
+        try:
+            return self._run()
+        finally:
+            self.remote.close_all()
+
+    def _run(self):
+        while not self.cancelled.is_set():
             try:
                 if not self.request():
                     if not self.loop:
@@ -96,6 +267,10 @@ class Job:
                     continue  # try again
 
                 self.logger.info(f"Job {self.id} finished successfully.")
+                if not self.loop:
+                    if (self.cfg.tpu.get("pool", None) or {}).get("release", False):
+                        WarmPool().release(self.cfg)
+                    return True
 
             except KeyboardInterrupt:
                 self.logger.warning("Job interrupted by user")
@@ -104,9 +279,12 @@ class Job:
             except Exception as e:
                 self.logger.exception(f"Job failed with error: {e}")
             
-            if not self.loop:
+            if not self.loop or self.cancelled.is_set():
                 return False
             self.logger.info("Retrying job due to error...")
+        
+        self.logger.warning(f"Job {self.id} cancelled.")
+        return False
             
     def delete(self):
         self.logger = setup_logger(stdout=True)
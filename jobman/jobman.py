@@ -1,8 +1,4 @@
-import re
 import os
-import math
-import json
-import fcntl
 import shutil
 import logging
 import subprocess
@@ -10,102 +6,63 @@ from pathlib import Path
 from datetime import datetime 
 from tabulate import tabulate
 from omegaconf import OmegaConf
-from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from jobman.job import Job
-from jobman.utils import setup_logger
-
-jobs_dir = Path("jobs") 
-jobman_dir = jobs_dir / ".jobman"
-
-def infer_num_workers(accelerator: str) -> int:
-    """
-    Infer number of workers based on accelerator type.
-    Examples:
-        v4-256 -> 32 workers (256 // 8)
-        v5e-32 -> 8 workers (32 // 4)
-    """
-    match = re.search(r"v(\d+)[a-z]*-(\d+)", accelerator.lower())
-    if not match:
-        raise ValueError(f"Invalid accelerator format: {accelerator}")
-    
-    version, chips = int(match.group(1)), int(match.group(2))
-    if version in [2, 3, 4]:
-        return math.ceil(chips / 8)
-    elif version in [5, 6]:
-        return math.ceil(chips / 4)
-    else:
-        raise ValueError(f"Unknown TPU version in accelerator: {accelerator}")
+from jobman.tpu import list_tpu_vm_states, list_queued_resource_states, resolve_candidates
+from jobman.store import JobStore
+from jobman.daemon import DaemonClient
+from jobman.pool import WarmPool
+from jobman.utils import setup_logger, infer_num_workers, jobs_dir, jobman_dir
 
 class JobMan:
 
     def __init__(self):
         jobman_dir.mkdir(parents=True, exist_ok=True)
         self.meta_file = jobman_dir / "meta.json"
-        self.lock_file = jobman_dir / "lock"
         self.cntr_file = jobman_dir / "next_job_id.txt"
+        self.store = JobStore(jobman_dir / "jobs.db")
+        self.daemon = DaemonClient(jobman_dir / "daemon.sock")
+        self.pool = WarmPool(self.store)
         self.logger = setup_logger(stdout=True)
         
-    @contextmanager
-    def with_meta_lock(self):
-        with open(self.lock_file, "w") as lock_fp:
-            fcntl.flock(lock_fp, fcntl.LOCK_EX)
-            try:
-                if self.meta_file.exists():
-                    meta = json.loads(self.meta_file.read_text())
-                else:
-                    meta = {}
-                yield meta
-                # Write back updated meta
-                self.meta_file.write_text(json.dumps(meta, indent=2))
-            finally:
-                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+        if self.store.migrate_legacy(self.meta_file, self.cntr_file):
+            self.logger.info(f"Migrated legacy job metadata into {self.store.db_path}")
             
     def create_job(self, config_path):
-        job_id = self.get_next_job_id()
         user = os.environ['USER']
-        job_dir = Path(f"jobs/{user}/{job_id}")
+        job_id, meta = self.store.create_job(lambda job_id: {
+            "user": user,
+            "job_dir": str(jobs_dir / user / job_id),
+            "created_at": datetime.now().isoformat()
+        })
+        job_dir = Path(meta["job_dir"])
         job_dir.mkdir(parents=True, exist_ok=True)
         
-        with self.with_meta_lock() as meta:
-            meta[f"job_{job_id}"] = {
-                "job_id": job_id,
-                "user": user,
-                "job_dir": str(job_dir),
-                "created_at": datetime.now().isoformat()
-            }
-        
         cfg = OmegaConf.load(config_path)
         cfg.job.id = job_id
         cfg.job.user = user
         cfg.job.dir = str(job_dir)
         cfg.tpu.num_workers = infer_num_workers(cfg.tpu.accelerator)
+        if cfg.tpu.get("candidates"):
+            # Embed candidate configs so the job dir is self-contained
+            cfg.tpu.candidates = resolve_candidates(cfg.tpu.candidates)
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         cfg.job.name = f"{cfg.job.name}_{ts}"
         cfg.tpu.name = f"{cfg.tpu.name}_{ts}"
+        
+        if (cfg.tpu.get("pool", None) or {}).get("adopt", False):
+            self.pool.reap_in_background()
+            self.pool.adopt(cfg, job_id)
         OmegaConf.save(cfg, job_dir / "config.yaml")
         
         self.logger.info(f"Created job {job_id}. See info at {job_dir}")
         
         return job_id
     
-    def get_next_job_id(self):
-        if not self.cntr_file.exists():
-            self.cntr_file.write_text("0")
-
-        with open(self.lock_file, "w") as lock_fp:
-            fcntl.flock(lock_fp, fcntl.LOCK_EX)
-            current = int(self.cntr_file.read_text())
-            next_id = current + 1
-            self.cntr_file.write_text(str(next_id))
-            fcntl.flock(lock_fp, fcntl.LOCK_UN)
-            return f"{next_id:06d}"
-    
     def start_job(self, job_id):
         
-        with self.with_meta_lock() as meta:
-            meta_data = meta.get(f"job_{job_id}")
+        meta_data = self.get_job_meta(job_id)
         job_dir = Path(meta_data.get("job_dir"))
         session_name = f"job_{job_id}"
         
@@ -113,7 +70,18 @@ class JobMan:
         logs_dir.mkdir(parents=True, exist_ok=True)
         log_file = logs_dir / "job.log"
         
+        # A resumed job may have released its TPU to the warm pool in the meantime
         config_path = job_dir / "config.yaml"
+        cfg = OmegaConf.load(config_path)
+        if self.pool.reclaim(cfg, job_id):
+            OmegaConf.save(cfg, config_path)
+        
+        # Hand the job to the supervisor daemon if one is running, else fall back to tmux
+        if self.daemon.is_alive():
+            self.daemon.request("start", job_id=job_id)
+            self.logger.info(f"Job {job_id} started by daemon. See logs at {logs_dir}/job.log.")
+            return
+        
         run_cmd = f"jobman run {job_id}"
 
         tmux_cmd = f'tmux new-session -d -s {session_name} "{run_cmd} | tee -a {log_file}"'
@@ -137,14 +105,14 @@ class JobMan:
         ).returncode == 0
     
     def cancel_job(self, job_id):
-        key = f"job_{job_id}"
-        
-        with self.with_meta_lock() as meta:
-            job_meta = meta.get(key)
+        job_meta = self.get_job_meta(job_id)
 
         if not job_meta:
             self.logger.warning(f"No metadata found for job {job_id}")
             return False
+        
+        if job_meta.get("backend") == "daemon":
+            return self.cancel_daemon_job(job_id)
 
         session_name = job_meta.get("session_name")
         if not session_name:
@@ -172,6 +140,25 @@ class JobMan:
             self.logger.error(f"Failed to kill tmux session {session_name}: {e}")
             return False
             
+    def cancel_daemon_job(self, job_id):
+        if self.daemon.is_alive():
+            try:
+                self.daemon.request("cancel", job_id=job_id)
+                self.logger.info(f"Cancelled job {job_id} via daemon")
+                return True
+            except (RuntimeError, ValueError) as e:
+                self.logger.warning(f"Daemon could not cancel job {job_id}: {e}")
+                return False
+            except OSError as e:
+                self.logger.warning(f"Daemon unreachable while cancelling job {job_id}: {e}")
+        if (self.get_job_meta(job_id) or {}).get("status") != "RUNNING":
+            self.logger.warning(f"Daemon is not running and job {job_id} is not running. Nothing to cancel.")
+            return False
+        # Nothing drives the job now, but a RUNNING daemon job would be adopted (restarted) by the next daemon
+        self.update_job_meta(job_id, status="CANCELLED", ended_at=datetime.now().isoformat())
+        self.logger.info(f"Daemon is not running; marked job {job_id} as cancelled")
+        return True
+            
     def delete_job(self, job_id):
         self.logger.info(f"Deleting job {job_id}...")
     
@@ -181,15 +168,18 @@ class JobMan:
         except Exception as e:
             self.logger.warning(f"Failed to cancel job {job_id} before deletion: {e}")
 
-        with self.with_meta_lock() as meta:
-            meta_data = meta.get(f"job_{job_id}")
+        meta_data = self.get_job_meta(job_id)
         job_dir = Path(meta_data.get("job_dir"))
         config_path = job_dir / "config.yaml"
         if config_path.exists():
             try:
                 cfg = OmegaConf.load(config_path)
-                job = Job(cfg)
-                job.delete()
+                if self.pool.owns(job_id, cfg.tpu.name, cfg.tpu.zone):
+                    job = Job(cfg)
+                    job.delete()
+                    self.pool.forget(cfg.tpu.name, cfg.tpu.zone)
+                else:
+                    self.logger.info(f"TPU {cfg.tpu.name} belongs to the warm pool or another job. Not deleting it.")
             except Exception as e:
                 self.logger.exception(f"Failed to delete job {job_id}: {e}")
         else:
@@ -206,23 +196,61 @@ class JobMan:
         return True
     
     def list_jobs(self):
-        rows = []
-
-        with self.with_meta_lock() as meta:
-            with ThreadPoolExecutor(max_workers=8) as executor:
-                futures = {
-                    executor.submit(self.fetch_job_info, metadata): job_key
-                    for job_key, metadata in meta.items()
-                }
-
-                for future in as_completed(futures):
-                    rows.append(future.result())
+        # Snapshot read: other jobman commands are not blocked while we query gcloud
+        jobs = self.store.list_jobs()
+        cfgs = {meta.get("job_id"): self.load_job_cfg(meta) for meta in jobs}
+        
+        zones = {}
+        for cfg in cfgs.values():
+            if cfg is not None:
+                zones.setdefault(cfg.tpu.zone, set()).add(cfg.tpu.get("allocation_mode", "tpu-vm"))
+        zone_states = self.fetch_zone_states(zones)
+        daemon_running = set(self.daemon.request("list")["running"]) if self.daemon.is_alive() else set()
+        slices = {(s["name"], s["zone"]): s["owner"] for s in self.store.list_slices()}
+        self.pool.reap_in_background()
 
+        rows = [self.fetch_job_info(meta, cfgs[meta.get("job_id")], zone_states, daemon_running, slices) for meta in jobs]
         rows.sort(key=lambda x: x[0])
         headers = ["Job ID", "User", "Name", "Accelerator", "Zone", "Host0 IP", "Status"]
         print(tabulate(rows, headers=headers, tablefmt="github"))
+        
+    def load_job_cfg(self, meta):
+        config_path = Path(meta.get("job_dir", "")) / "config.yaml"
+        try:
+            return OmegaConf.load(config_path) if config_path.exists() else None
+        except Exception as e:
+            self.logger.warning(f"Failed to load config {config_path}: {e}")
+            return None
+        
+    def fetch_zone_states(self, zones):
+        """
+        Resolve TPU states with one list call per zone (plus one queued-resources
+        list for zones that have queued-resource jobs), querying zones in parallel.
+        Returns {zone: {name: state}}, or {zone: None} if the zone lookup failed.
+        """
+        def fetch(zone, modes):
+            states = {}
+            if "queued-resources" in modes:
+                states.update(list_queued_resource_states(zone))
+            # VM state takes precedence over the queued resource state
+            states.update(list_tpu_vm_states(zone))
+            return states
+        
+        zone_states = {}
+        if not zones:
+            return zone_states
+        with ThreadPoolExecutor(max_workers=len(zones)) as executor:
+            futures = {executor.submit(fetch, zone, modes): zone for zone, modes in zones.items()}
+            for future in as_completed(futures):
+                zone = futures[future]
+                try:
+                    zone_states[zone] = future.result()
+                except Exception as e:
+                    self.logger.warning(f"Failed to list TPUs in zone {zone}: {e}")
+                    zone_states[zone] = None
+        return zone_states
             
-    def fetch_job_info(self, meta):
+    def fetch_job_info(self, meta, cfg, zone_states, daemon_running=(), slices=None):
         try:
             job_id = meta.get("job_id")
             user = meta.get("user")
@@ -230,9 +258,7 @@ class JobMan:
             # started = meta.get("started_at", meta.get("created_at", "N/A"))
             session_name = meta.get("session_name", f"job_{job_id}")
 
-            config_path = Path(meta.get("job_dir")) / "config.yaml"
-            if config_path.exists():
-                cfg = OmegaConf.load(config_path)
+            if cfg is not None:
                 job_name = cfg.job.name
                 accelerator = cfg.tpu.accelerator
                 zone = cfg.tpu.zone
@@ -242,44 +268,34 @@ class JobMan:
                     host0_ip = "N/A"
             else:
                 job_name = accelerator = zone = host0_ip = "N/A"
-                cfg = None
             
-            try:
-                gcloud_state = subprocess.run(
-                    [
-                        "gcloud", "alpha", "compute", "tpus", "tpu-vm", "describe",
-                        cfg.tpu.name, "--zone", cfg.tpu.zone, "--format=value(state)"
-                    ],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-                )
-                gcloud_state = gcloud_state.stdout.strip()
-                if self.check_tmux_session(session_name):
+            states = zone_states.get(zone) if cfg is not None else None
+            pool_owner = (slices or {}).get((cfg.tpu.name, zone), job_id) if cfg is not None else job_id
+            if pool_owner != job_id:
+                status = "RELEASED"
+            elif states is None:
+                status = "UNKNOWN"
+            else:
+                gcloud_state = states.get(cfg.tpu.name, "")
+                if meta.get("backend") == "daemon":
+                    alive = job_id in daemon_running
+                else:
+                    alive = self.check_tmux_session(session_name)
+                if alive:
                     status = "RUNNING" if gcloud_state in {"READY", "ACTIVE"} else "QUEUEING"
-                elif cfg:
-                    status = "IDLE" if gcloud_state in {"READY", "ACTIVE"} else "DEAD"
                 else:
-                    status = "UNKNOWN"
-            except:
-                status = "UNKNOWN"
+                    status = "IDLE" if gcloud_state in {"READY", "ACTIVE"} else "DEAD"
 
             return [job_id, user, job_name, accelerator, zone, host0_ip, status]
         except Exception as e:
             return [job_id, "ERROR", "ERROR", "ERROR", "ERROR", "ERROR", f"ERROR: {e}"]
         
     def get_job_meta(self, job_id):
-        with self.with_meta_lock() as meta:
-            return meta.get(f"job_{job_id}", None)
+        return self.store.get_job(job_id)
 
     def update_job_meta(self, job_id, **kwargs):
-        with self.with_meta_lock() as meta:
-            key = f"job_{job_id}"
-            if key not in meta:
-                meta[key] = {"job_id": job_id}
-            meta[key].update(kwargs)
-            meta[key]["last_seen"] = datetime.now().isoformat()
+        kwargs["last_seen"] = datetime.now().isoformat()
+        return self.store.update_job(job_id, **kwargs)
 
     def remove_job_meta(self, job_id):
-        with self.with_meta_lock() as meta:
-            key = f"job_{job_id}"
-            if key in meta:
-                del meta[key]
\ No newline at end of file
+        return self.store.remove_job(job_id)
\ No newline at end of file
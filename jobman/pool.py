@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import subprocess
+from omegaconf import OmegaConf
+
+from jobman.tpu import TPU, resolve_candidates
+from jobman.store import JobStore
+from jobman.utils import setup_logger, infer_num_workers, jobman_dir
+
+# Fields copied between a job config and a pooled slice
+SLICE_KEYS = ("zone", "accelerator", "version", "pricing", "allocation_mode")
+
+class WarmPool:
+    """
+    Registry of READY TPU slices released by finished jobs.
+
+    A released slice is idle until a new job with the same accelerator, zone,
+    runtime version and pricing adopts it, or until its TTL expires and the
+    reaper deletes it. While a slice is in the pool or leased to another job,
+    the job that created it no longer deletes it.
+    """
+
+    def __init__(self, store: JobStore = None):
+        self.store = store or JobStore(jobman_dir / "jobs.db")
+        self.logger = setup_logger(stdout=True)
+
+    def _slice_cfg(self, s):
+        return OmegaConf.create({
+            "job": {"dir": str(jobman_dir / "pool")},
+            "tpu": {"name": s["name"], "tags": None, "metadata": None, **{k: s.get(k) for k in SLICE_KEYS}},
+        })
+
+    def release(self, cfg, ttl=None):
+        """Put the job's READY slice into the pool."""
+        pool_cfg = cfg.tpu.get("pool", None) or {}
+        ttl = ttl if ttl is not None else pool_cfg.get("ttl", 1800)
+        ips = cfg.tpu.get("ips", None) or []
+        self.store.put_slice(
+            cfg.tpu.name, cfg.tpu.zone, cfg.tpu.accelerator, cfg.tpu.version, cfg.tpu.pricing,
+            owner=None,
+            expires_at=time.time() + ttl,
+            allocation_mode=cfg.tpu.allocation_mode,
+            ips=OmegaConf.to_container(ips) if OmegaConf.is_config(ips) else list(ips),
+            released_by=str(cfg.job.id),
+        )
+        self.logger.info(f"Released TPU {cfg.tpu.name} ({cfg.tpu.accelerator}@{cfg.tpu.zone}) to the warm pool for {ttl}s")
+
+    def adopt(self, cfg, job_id):
+        """
+        Point `cfg.tpu` at a matching idle slice, if any. The slice is verified
+        READY first; slices that are not are expired so the reaper removes them.
+        """
+        keys = [{k: cfg.tpu.get(k) for k in SLICE_KEYS}]
+        for c in resolve_candidates(cfg.tpu.get("candidates", None)):
+            keys.append({**keys[0], **c})
+
+        while True:
+            s = self.store.lease_slice(keys, owner=str(job_id), now=time.time())
+            if s is None:
+                return False
+
+            status = TPU(self._slice_cfg(s))._check_tpu_vm_status()
+            if status in {"READY", "ACTIVE"}:
+                break
+            self.logger.warning(f"Pooled TPU {s['name']} is {status}; dropping it from the pool.")
+            self.store.set_slice_owner(s["name"], s["zone"], None, expires_at=0)
+
+        cfg.tpu.name = s["name"]
+        for k in SLICE_KEYS:
+            cfg.tpu[k] = s[k]
+        cfg.tpu.ips = s.get("ips", [])
+        cfg.tpu.num_workers = infer_num_workers(s["accelerator"])
+        self.logger.info(f"Job {job_id} adopted warm TPU {s['name']} ({s['accelerator']}@{s['zone']})")
+        return True
+
+    def owns(self, job_id, name, zone):
+        """Whether job `job_id` may delete TPU (name, zone)."""
+        s = self.store.get_slice(name, zone)
+        return s is None or s["owner"] == str(job_id)
+
+    def reclaim(self, cfg, job_id):
+        """
+        Called before a job (re)starts: take its slice back from the pool if it
+        is idle there; if another job has adopted it, the job gets a new TPU name.
+        Returns True if the job's config changed.
+        """
+        # One transaction, like `adopt`'s lease: a job leasing the slice meanwhile wins
+        s, taken = self.store.reclaim_slice(cfg.tpu.name, cfg.tpu.zone, str(job_id), now=time.time())
+        if s is None:
+            return False
+        if taken:
+            if s["owner"] is None:
+                self.logger.info(f"Job {job_id} reclaimed its TPU {s['name']} from the warm pool")
+            return False
+
+        cfg.tpu.name = f"{cfg.tpu.name}-j{job_id}"
+        cfg.tpu.ips = []
+        self.logger.info(f"TPU of job {job_id} is owned by the pool or another job; using new name {cfg.tpu.name}")
+        return True
+
+    def forget(self, name, zone):
+        self.store.remove_slice(name, zone)
+
+    def expired(self):
+        now = time.time()
+        return [s for s in self.store.list_slices() if s["owner"] is None and (s["expires_at"] or 0) <= now]
+
+    def reap(self):
+        """Delete every idle slice whose TTL has expired."""
+        slices = self.store.claim_expired_slices(owner=f"reaper:{os.getpid()}", now=time.time())
+        for s in slices:
+            self.logger.info(f"Reaping idle TPU {s['name']} in {s['zone']}")
+            try:
+                TPU(self._slice_cfg(s)).delete()
+                self.store.remove_slice(s["name"], s["zone"])
+            except Exception as e:
+                self.logger.error(f"Failed to reap TPU {s['name']}: {e}")
+                self.store.set_slice_owner(s["name"], s["zone"], None, expires_at=0)
+        return len(slices)
+
+    def reap_in_background(self):
+        """Spawn a detached `jobman pool --reap` if any slice has expired."""
+        if not self.expired():
+            return False
+        subprocess.Popen(
+            [sys.executable, "-m", "jobman.cli", "pool", "--reap"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        return True
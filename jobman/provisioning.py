@@ -0,0 +1,89 @@
+import re
+import time
+import random
+import threading
+
+# (pattern in gcloud stderr, error kind); first match wins
+ERROR_PATTERNS = [
+    (r"429|RATE_LIMIT|rateLimitExceeded|Too Many Requests", "rate_limit"),
+    (r"QUOTA|[Qq]uota", "quota"),
+    (r"no more capacity|RESOURCE_EXHAUSTED|[Ss]tockout|insufficient capacity|not enough resources", "stockout"),
+]
+
+# error kind -> (base delay, max delay) in seconds
+BACKOFF = {
+    "stockout": (30, 600),
+    "quota": (60, 900),
+    "rate_limit": (10, 300),
+    "other": (10, 120),
+}
+
+# TPU VM / queued resource states that usually resolve within seconds to minutes
+FAST_STATES = {"CREATING", "PROVISIONING", "ACCEPTED", "STARTING", "RESTARTING", "REPAIRING"}
+# States that can last hours
+SLOW_STATES = {"WAITING_FOR_RESOURCES", "SUSPENDED"}
+
+def classify_error(stderr):
+    for pattern, kind in ERROR_PATTERNS:
+        if re.search(pattern, stderr or ""):
+            return kind
+    return "other"
+
+def backoff_delay(attempt, kind):
+    """Exponential backoff with equal jitter for the given retry attempt (1-based)."""
+    base, cap = BACKOFF.get(kind, BACKOFF["other"])
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def poll_interval_for(vm_state, qr_state, fast=5, default=30, slow=60):
+    """Pick the next poll interval from the last observed states."""
+    if vm_state in FAST_STATES or (vm_state is None and qr_state in FAST_STATES):
+        return fast
+    if vm_state is None and qr_state in SLOW_STATES | {None}:
+        return slow
+    return default
+
+class ZoneStatePoller:
+    """
+    Process-wide snapshot of every TPU VM and queued resource in a zone.
+
+    Every TPU waiting in the zone reads from the same snapshot; it is refreshed
+    with one list call (per resource kind) once it is older than the caller's
+    `max_age`, and concurrent refreshes are serialized into one.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_zone(cls, zone):
+        with cls._instances_lock:
+            if zone not in cls._instances:
+                cls._instances[zone] = cls(zone)
+            return cls._instances[zone]
+
+    def __init__(self, zone):
+        self.zone = zone
+        self.lock = threading.Lock()
+        self.vm_states = {}
+        self.qr_states = {}
+        self.include_queued = False
+        self.fetched_at = 0.0
+
+    def _refresh(self, max_age):
+        # Imported here: tpu.py imports this module
+        from jobman.tpu import list_tpu_vm_states, list_queued_resource_states
+        if self.include_queued:
+            self.qr_states = list_queued_resource_states(self.zone, max_age=max_age)
+        self.vm_states = list_tpu_vm_states(self.zone, max_age=max_age)
+        self.fetched_at = time.monotonic()
+
+    def states(self, name, max_age, queued=False):
+        """Return (vm_state, queued_resource_state) for `name`; None when absent."""
+        with self.lock:
+            if queued and not self.include_queued:
+                self.include_queued = True
+                self.fetched_at = 0.0
+            if time.monotonic() - self.fetched_at > max_age:
+                self._refresh(max_age)
+            return self.vm_states.get(name), self.qr_states.get(name)
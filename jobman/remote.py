@@ -0,0 +1,476 @@
+import os
+import sys
+import math
+import shlex
+import asyncio
+import getpass
+import hashlib
+import secrets
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+from jobman import gcloud
+from jobman.engine import engine
+
+# What ssh logs when it could not connect or log in, i.e. before the remote command
+# started. Lines about a stale control socket are not failures: ssh connects anyway.
+CONNECT_ERRORS = (
+    "ssh: connect to host", "Could not resolve hostname", "Connection refused", "Connection timed out",
+    "No route to host", "Network is unreachable", "Connection closed by", "Connection reset by",
+    "kex_exchange_identification", "banner exchange", "Permission denied (", "Host key verification failed",
+)
+
+# Every remote command runs in its own process group, whose id is kept under CALLS_DIR
+# by a per-call token while it runs: without a tty the command outlives a killed ssh
+# client, so a cancelled or timed-out call is killed on the worker with KILL_SCRIPT
+CALLS_DIR = "/tmp/jobman-calls"
+WRAP_SCRIPT = "mkdir -p {dir}; setsid bash -c {command} <&0 & echo $! > {dir}/{token}; wait $!; rc=$?; rm -f {dir}/{token}; exit $rc"
+KILL_SCRIPT = "P=$(cat {dir}/{token} 2>/dev/null) && kill -TERM -- -$P 2>/dev/null; rm -f {dir}/{token}"
+
+# Marks the end of one worker's output in a relayed run: "<worker>|__jobman_exit__ <code>"
+EXIT_MARK = "__jobman_exit__"
+
+# Runs on a relay worker: executes CMD on itself and, over the internal network,
+# on every other worker of its group; each output line is prefixed with "<worker>|"
+# (awk emits whole lines only, so workers never interleave within a line)
+RELAY_SSH_OPTS = "-n -T -o BatchMode=yes -o ConnectTimeout=15 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
+RELAY_SCRIPT = """\
+CMD=$(cat <<'__JOBMAN_CMD__'
+{command}
+__JOBMAN_CMD__
+)
+WRAPPED=$(cat <<'__JOBMAN_CMD__'
+{wrapped}
+__JOBMAN_CMD__
+)
+SSH_OPTS="{ssh_opts}"
+run() {{
+    if [ "$2" = local ]; then bash -c "$CMD" </dev/null 2>&1; else ssh $SSH_OPTS "$2" "$WRAPPED" 2>&1; fi | awk -v p="$1|" '{{ print p $0; fflush() }}'
+    echo "$1|{mark} ${{PIPESTATUS[0]}}"
+}}
+{runs}
+wait
+"""
+
+class GCloudTransport:
+    """`gcloud compute tpus tpu-vm ssh/scp`: resolves the worker through the API on every call."""
+
+    name = "gcloud"
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def available(self, i):
+        return True
+
+    def ssh_cmd(self, i, command, log=None):
+        r = self.remote
+        return [
+            "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", r.name,
+            "--zone", r.zone,
+            f"--worker={i}",
+            "--command", command,
+            "--ssh-key-file", str(r.private_key),
+            *[f"--ssh-flag={o}" for o in r.ssh_options(i)],
+            *([f"--ssh-flag=-E {log}"] if log else []),
+            "--quiet",
+        ]
+
+    def scp_cmd(self, i, src, dst):
+        r = self.remote
+        return [
+            "gcloud", "alpha", "compute", "tpus", "tpu-vm", "scp", str(src), f"{r.name}:{dst}",
+            "--zone", r.zone,
+            f"--worker={i}",
+            "--ssh-key-file", str(r.private_key),
+            *[f"--scp-flag={o}" for o in r.ssh_options(i)],
+            "--quiet",
+        ]
+
+class DirectTransport:
+    """
+    Plain `ssh`/`scp` to the worker IPs cached in `cfg.tpu.ips`, through a
+    generated ssh_config with one host alias per worker. No API call per command.
+    """
+
+    name = "direct"
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.config_file = Path(remote.cfg.job.dir) / "ssh_config"
+        self.lock = threading.Lock()
+        self.written = None
+
+    def alias(self, i):
+        # Contains the TPU name so ledger matching and cancellation still apply
+        return f"{self.remote.name}-w{i}"
+
+    def host(self, i):
+        use_internal = self.remote.cfg.ssh.get("internal_ip", False)
+        for ip in self.remote.cfg.tpu.get("ips", None) or []:
+            if ip["worker"] != i:
+                continue
+            host = ip["internal_ip"] if use_internal else ip["external_ip"]
+            return None if host in {None, "", "-"} else host
+        return None
+
+    def available(self, i):
+        return self.host(i) is not None
+
+    def render(self):
+        r = self.remote
+        blocks = []
+        for i in range(r.cfg.tpu.num_workers):
+            host = self.host(i)
+            if host is None:
+                continue
+            lines = [
+                f"Host {self.alias(i)}",
+                f"  HostName {host}",
+                f"  User {r.user}",
+                f"  IdentityFile {r.private_key}",
+                "  IdentitiesOnly yes",
+            ] + ["  " + o[len("-o "):].replace("=", " ", 1) for o in r.ssh_options(i)]
+            blocks.append("\n".join(lines))
+        return "\n\n".join(blocks) + "\n"
+
+    def ensure_config(self):
+        """(Re)write the ssh_config when the cached IPs changed."""
+        text = self.render()
+        with self.lock:
+            if text != self.written:
+                self.config_file.parent.mkdir(parents=True, exist_ok=True)
+                self.config_file.write_text(text)
+                self.written = text
+        return self.config_file
+
+    def ssh_cmd(self, i, command, log=None):
+        return ["ssh", "-F", str(self.ensure_config()), *(["-E", str(log)] if log else []), "-T", self.alias(i), command]
+
+    def scp_cmd(self, i, src, dst):
+        # scp paths are relative to the remote home; "~" is not expanded by every scp/sftp server
+        if dst.startswith("~/"):
+            dst = dst[2:]
+        return ["scp", "-F", str(self.ensure_config()), "-q", str(src), f"{self.alias(i)}:{dst}"]
+
+TRANSPORTS = {t.name: t for t in (GCloudTransport, DirectTransport)}
+
+class Remote:
+    """
+    Runs commands and copies files on TPU workers.
+
+    `ssh.transport` selects how: `gcloud` (default) or `direct`, which talks
+    to the cached worker IPs with plain ssh/scp and falls back to gcloud when
+    a worker has no known IP or cannot be reached (gcloud also propagates the
+    SSH key to the TPU metadata).
+
+    With `ssh.relays` > 0, `run_all` connects only to that many relay workers,
+    which fan the command out to the rest of the slice over internal IPs.
+
+    With `ssh.multiplex` (default on) every ssh/scp to worker i shares one
+    persistent ControlMaster connection, so only the first call per worker
+    pays for the SSH handshake.
+
+    A call that fails because ssh itself could not connect (exit 255 with one
+    of CONNECT_ERRORS in ssh's own log, kept apart from the command's stderr
+    with `-E`) drops the master and is retried once. A remote command that
+    exits 255 by itself is not rerun.
+
+    Commands run in their own process group on the worker (see WRAP_SCRIPT);
+    when a call is cancelled or times out, that group is killed over ssh too.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.multiplex = cfg.ssh.get("multiplex", True)
+        self.persist = cfg.ssh.get("persist", 600)
+        self.relays = cfg.ssh.get("relays", 0)
+        # Default per-call timeout in seconds (None = wait forever)
+        self.timeout = cfg.ssh.get("timeout", None)
+        # Same user name gcloud derives from the local account when it adds the key
+        self.user = cfg.ssh.get("user", None) or getpass.getuser()
+        # Short directory: unix socket paths are limited to ~104 bytes
+        self.control_dir = Path(f"/tmp/jobman-{os.getuid()}")
+
+        transport = cfg.ssh.get("transport", "gcloud")
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown ssh transport {transport}, expected one of {list(TRANSPORTS)}")
+        self.fallback = GCloudTransport(self)
+        self.transport = self.fallback if transport == "gcloud" else TRANSPORTS[transport](self)
+
+    @property
+    def name(self):
+        return self.cfg.tpu.name
+
+    @property
+    def zone(self):
+        return self.cfg.tpu.zone
+
+    @property
+    def private_key(self):
+        return Path(self.cfg.ssh.private_key).expanduser()
+
+    def control_path(self, i):
+        digest = hashlib.sha1(f"{self.name}/{self.zone}".encode()).hexdigest()[:12]
+        return self.control_dir / f"{digest}-{i}"
+
+    def ssh_options(self, i):
+        opts = [
+            "-o ConnectTimeout=15",
+            "-o StrictHostKeyChecking=no",
+            "-o UserKnownHostsFile=/dev/null",
+        ]
+        if self.multiplex:
+            self.control_dir.mkdir(mode=0o700, exist_ok=True)
+            opts += [
+                "-o ControlMaster=auto",
+                f"-o ControlPath={self.control_path(i)}",
+                f"-o ControlPersist={self.persist}",
+            ]
+        return opts
+
+    def transport_for(self, i):
+        return self.transport if self.transport.available(i) else self.fallback
+
+    def ssh_cmd(self, i, command, log=None):
+        return self.transport_for(i).ssh_cmd(i, command, log)
+
+    def scp_cmd(self, i, src, dst):
+        return self.transport_for(i).scp_cmd(i, src, dst)
+
+    def dest(self, i):
+        return f"{self.name}/{i}"
+
+    def _error_log(self, i):
+        """A fresh file for ssh's own messages (`ssh -E`)."""
+        self.control_dir.mkdir(mode=0o700, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=f"ssh-{i}-", suffix=".log", dir=self.control_dir)
+        os.close(fd)
+        return Path(path)
+
+    @staticmethod
+    def _connect_failed(log):
+        """Whether ssh logged that it never got to start the remote command."""
+        try:
+            lines = log.read_text(errors="replace").splitlines()
+        except OSError:
+            return False
+        return any(
+            any(e in line for e in CONNECT_ERRORS)
+            for line in lines if "Control socket" not in line and "client_loop" not in line
+        )
+
+    @staticmethod
+    def _forward_log(log, stderr, result):
+        """Pass ssh's own messages on to where its stderr would have gone."""
+        try:
+            text = log.read_text(errors="replace")
+        except OSError:
+            return
+        if not text:
+            return
+        if stderr is subprocess.PIPE:
+            result.stderr = (result.stderr or "") + text
+        elif stderr is None:
+            sys.stderr.write(text)
+        elif hasattr(stderr, "write"):
+            stderr.write(text)
+            stderr.flush()
+
+    async def _acall(self, i, build, stdout, stderr, check, timeout, input=None, bounded=True, on_line=None, idempotent=False, kill=None):
+        received = []
+        def _on_line(line):
+            received.append(True)
+            on_line(line)
+
+        kwargs = dict(
+            stdout=stdout, stderr=stderr, input=input, dest=self.dest(i), bounded=bounded,
+            # The default timeout is for setup calls, not the unbounded long-running job command
+            timeout=self.timeout if timeout is None and bounded else timeout,
+            on_line=None if on_line is None else _on_line,
+        )
+        transport = self.transport_for(i)
+        log = self._error_log(i)
+        try:
+            argv = build(transport, log)
+            result = await self._exec(i, argv, kill, kwargs)
+            # 255 is also what a remote command may exit with: only retry when ssh says it never
+            # started the command (copies are safe to repeat), and never the unbounded job command.
+            # A stale master is dropped first, and a failed direct route goes through gcloud
+            # (changed IP or key not yet propagated). Streamed calls are only retried if nothing was delivered yet.
+            failed = result.returncode == 255 and bounded and not received and (idempotent or self._connect_failed(log))
+            if failed and (self.multiplex or transport is not self.fallback):
+                await self.aclose(i)
+                argv = build(self.fallback, log)
+                result = await self._exec(i, argv, kill, kwargs)
+            if result.returncode != 0:
+                self._forward_log(log, stderr, result)
+        finally:
+            log.unlink(missing_ok=True)
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, argv, result.stdout, result.stderr)
+        return result
+
+    async def _exec(self, i, argv, kill, kwargs):
+        try:
+            result = await gcloud.gcloud.arun(argv, **kwargs)
+        except subprocess.TimeoutExpired:
+            await self._kill_remote(i, kill)
+            raise
+        # Killed locally (cancelled): the remote command is still running
+        if result.returncode < 0:
+            await self._kill_remote(i, kill)
+        return result
+
+    async def _kill_remote(self, i, kill):
+        if kill is None:
+            return
+        try:
+            await gcloud.gcloud.arun(
+                self.ssh_cmd(i, kill), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=60, dest=self.dest(i), bounded=False,
+            )
+        except subprocess.TimeoutExpired:
+            pass
+
+    async def arun(self, i, command, stdout=None, stderr=None, check=False, timeout=None, input=None, bounded=True, on_line=None):
+        return await self._arun(i, command, secrets.token_hex(8), stdout, stderr, check, timeout, input, bounded, on_line)
+
+    async def _arun(self, i, command, token, stdout=None, stderr=None, check=False, timeout=None, input=None, bounded=True, on_line=None, peers=()):
+        """`arun` under a given call token; `peers` are the internal IPs a relayed command also runs on."""
+        wrapped = WRAP_SCRIPT.format(dir=CALLS_DIR, token=token, command=shlex.quote(command))
+        kill = KILL_SCRIPT.format(dir=CALLS_DIR, token=token)
+        if peers:
+            kill += f"; for h in {' '.join(peers)}; do ssh {RELAY_SSH_OPTS} $h {shlex.quote(kill)} & done; wait"
+        return await self._acall(i, lambda t, log: t.ssh_cmd(i, wrapped, log), stdout, stderr, check, timeout, input, bounded, on_line, kill=kill)
+
+    async def acopy(self, i, src, dst, stdout=None, stderr=None, check=False, timeout=None):
+        return await self._acall(i, lambda t, log: t.scp_cmd(i, src, dst), stdout, stderr, check, timeout, idempotent=True)
+
+    def run(self, i, command, stdout=None, stderr=None, check=False, timeout=None, input=None, bounded=True):
+        """Run a shell command on worker i, optionally feeding `input` to its stdin."""
+        return engine.call(self.arun(i, command, stdout, stderr, check, timeout, input, bounded))
+
+    def copy(self, i, src, dst, stdout=None, stderr=None, check=False, timeout=None):
+        """Copy a local file to `dst` on worker i."""
+        return engine.call(self.acopy(i, src, dst, stdout, stderr, check, timeout))
+
+    def stream(self, i, command, on_line, stderr=None, input=None, bounded=True):
+        """Run a shell command on worker i, calling `on_line` with each stdout line."""
+        return engine.call(self.arun(i, command, None, stderr, False, None, input, bounded, on_line))
+
+    def relay_groups(self, workers):
+        """Split `workers` into one group per relay (its first worker), or None to connect to each directly."""
+        workers = list(workers)
+        ips = {ip["worker"]: ip["internal_ip"] for ip in self.cfg.tpu.get("ips", None) or []}
+        if self.relays <= 0 or len(workers) <= 1 or any(ips.get(i) in {None, "", "-"} for i in workers):
+            return None
+        size = math.ceil(len(workers) / min(self.relays, len(workers)))
+        return [workers[k:k + size] for k in range(0, len(workers), size)]
+
+    def run_all(self, workers, command, outputs, timeout=None, bounded=True):
+        """
+        Run one command on many workers; `outputs[i]` is the open file receiving
+        worker i's stdout and stderr. Returns {worker: exit code}.
+        """
+        return engine.call(self.arun_all(workers, command, outputs, timeout, bounded))
+
+    async def arun_all(self, workers, command, outputs, timeout=None, bounded=True):
+        workers = list(workers)
+        groups = self.relay_groups(workers)
+        if groups is None:
+            results = await asyncio.gather(*[
+                self.arun(i, command, stdout=outputs[i], stderr=outputs[i], timeout=timeout, bounded=bounded)
+                for i in workers
+            ], return_exceptions=True)
+            # A worker that timed out (or could not be started) has no exit code
+            return {i: None if isinstance(r, Exception) else r.returncode for i, r in zip(workers, results)}
+
+        codes = {}
+        results = await asyncio.gather(*[self._arun_relayed(g, command, outputs, timeout, bounded) for g in groups], return_exceptions=True)
+        for group, group_codes in zip(groups, results):
+            codes.update({j: None for j in group} if isinstance(group_codes, Exception) else group_codes)
+        return codes
+
+    async def _arun_relayed(self, group, command, outputs, timeout, bounded):
+        relay = group[0]
+        ips = {ip["worker"]: ip["internal_ip"] for ip in self.cfg.tpu.ips}
+        token = secrets.token_hex(8)
+        script = RELAY_SCRIPT.format(
+            command=command,
+            # Same token on every worker of the group, so one kill reaches them all
+            wrapped=WRAP_SCRIPT.format(dir=CALLS_DIR, token=token, command=shlex.quote(command)),
+            ssh_opts=RELAY_SSH_OPTS,
+            mark=EXIT_MARK,
+            runs="\n".join(f"run {j} {'local' if j == relay else ips[j]} &" for j in group),
+        )
+
+        codes = {}
+        def on_line(line):
+            worker, sep, rest = line.partition("|")
+            if not sep or not worker.isdigit() or int(worker) not in outputs:
+                outputs[relay].write(line)
+                return
+            j = int(worker)
+            if rest.startswith(f"{EXIT_MARK} "):
+                codes[j] = int(rest.split()[1])
+                return
+            outputs[j].write(rest)
+            outputs[j].flush()
+
+        # The script goes over stdin: no argv size limit, and the relay's ssh calls use -n
+        result = await self._arun(
+            relay, 'S=$(mktemp) && cat > "$S" && bash "$S"; rc=$?; rm -f "$S"; exit $rc', token,
+            stderr=outputs[relay], input=script, timeout=timeout, bounded=bounded, on_line=on_line,
+            peers=[ips[j] for j in group if j != relay],
+        )
+        for j in group:
+            codes.setdefault(j, result.returncode or 255)
+        return codes
+
+    async def _control(self, i, op):
+        path = self.control_path(i)
+        if not path.exists():
+            return False
+        result = await engine.exec(
+            ["ssh", "-o", f"ControlPath={path}", "-O", op, "jobman"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, dest=self.dest(i),
+        )
+        return result.returncode == 0
+
+    async def aopen(self, i):
+        if not self.multiplex or await self._control(i, "check"):
+            return True
+        self.control_path(i).unlink(missing_ok=True)
+        result = await self.arun(i, "true", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    async def aclose(self, i):
+        await self._control(i, "exit")
+        self.control_path(i).unlink(missing_ok=True)
+
+    def is_open(self, i):
+        return engine.call(self._control(i, "check"))
+
+    def open(self, i):
+        """Ensure worker i has a live master connection."""
+        return engine.call(self.aopen(i))
+
+    def close(self, i):
+        return engine.call(self.aclose(i))
+
+    async def _gather(self, fn, workers):
+        workers = list(workers)
+        return dict(zip(workers, await asyncio.gather(*[fn(i) for i in workers])))
+
+    def open_all(self, workers=None):
+        if not self.multiplex:
+            return {}
+        return engine.call(self._gather(self.aopen, workers if workers is not None else range(self.cfg.tpu.num_workers)))
+
+    def close_all(self, workers=None):
+        if not self.multiplex:
+            return {}
+        return engine.call(self._gather(self.aclose, workers if workers is not None else range(self.cfg.tpu.num_workers)))
@@ -1,11 +1,34 @@
-import os
+import io
+import time
+import base64
+import hashlib
+import tarfile
+import threading
 import subprocess
-import concurrent.futures
 from pathlib import Path
 from textwrap import dedent
 
+from jobman.remote import Remote
+from jobman.dag import run_per_worker
 from jobman.utils import setup_logger
 
+# Run on the worker from the unpacked bundle dir ($1); replaces each file atomically
+INSTALLER = dedent("""
+    #!/bin/bash
+    set -e
+    src="$1"; hash="$2"
+    for f in "$src"/keys/*; do
+        [ -e "$f" ] || continue
+        name=$(basename "$f")
+        cp -p "$f" ~/.ssh/."$name".tmp && mv -f ~/.ssh/."$name".tmp ~/.ssh/"$name"
+    done
+    if [ -f "$src/config" ]; then
+        cp -p "$src/config" ~/.ssh/.config.tmp && mv -f ~/.ssh/.config.tmp ~/.ssh/config
+    fi
+    echo "$hash" > ~/.ssh/.jobman_identity
+    echo "jobman-ssh-identity $hash"
+""").lstrip()
+
 class SSH:
     
     def __init__(self, cfg):
@@ -13,102 +36,84 @@ class SSH:
         self.cfg = cfg
         self.private_key = Path(self.cfg.ssh.private_key).expanduser()
         self.identities = self.cfg.ssh.identities
+        self.remote = Remote(cfg)
+        self.lock = threading.Lock()
+        self._bundle = None
         
         self.logger = setup_logger(log_file=Path(cfg.job.dir) / 'logs' / 'job.log')
         
     def setup(self):
         self.logger.info(f"Copying SSH keys to TPU workers...")
 
-        any_failed = False
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg.tpu.num_workers) as executor:
-            futures = [executor.submit(self._setup_worker, i) for i in range(self.cfg.tpu.num_workers)]
-            for future in concurrent.futures.as_completed(futures):
-                if exc := future.exception():
-                    self.logger.error(f"Worker SSH thread failed: {exc}")
-                    any_failed = True
-
-        if any_failed:
+        ok = run_per_worker("ssh", self._setup_worker, range(self.cfg.tpu.num_workers), self.logger)
+        if not ok:
             self.logger.warning("SSH setup completed with at least one worker failed.")
         else:
             self.logger.info("SSH setup completed successfully on all workers.")
-        return not any_failed
+        return ok
         
+    def bundle(self):
+        """The job's identity bundle (base64 tar.gz) and its content hash, built once."""
+        with self.lock:
+            if self._bundle is None:
+                self._bundle = self._build_bundle()
+            return self._bundle
+
+    def _build_bundle(self):
+        files = {}
+        combined_config = ""
+        for entry in self.identities:
+            priv = Path(entry.private_key).expanduser()
+            pub = Path(entry.public_key).expanduser()
+            if not priv.exists() or not pub.exists():
+                self.logger.error(f"SSH key not found: {priv} or {pub}")
+                continue
+            files[f"keys/{priv.name}"] = (priv.read_bytes(), 0o600)
+            files[f"keys/{pub.name}"] = (pub.read_bytes(), 0o644)
+            combined_config += dedent(entry.config_entry).strip() + "\n\n"
+        if combined_config:
+            files["config"] = (combined_config.strip().encode() + b"\n", 0o600)
+
+        digest = hashlib.sha256()
+        for name in sorted(files):
+            data, mode = files[name]
+            digest.update(f"{name}:{mode:o}:{len(data)}\n".encode() + data)
+        files["install.sh"] = (INSTALLER.encode(), 0o755)
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            for name in sorted(files):
+                data, mode = files[name]
+                info = tarfile.TarInfo(name)
+                info.size, info.mode, info.mtime = len(data), mode, int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+        return base64.b64encode(buf.getvalue()).decode(), digest.hexdigest()[:16]
+
+    def fingerprint(self):
+        return self.bundle()[1]
+
     def _setup_worker(self, i):
+        """Stream the bundle to worker i and install it in one round trip."""
         self.logger.info(f"Worker {i}: Setting up SSH")
         log_file = Path(self.cfg.job.dir) / "logs" / f"ssh_worker_{i}.log"
-        ssh_setup_cmds = [
-            "mkdir -p ~/.ssh",
-            "chmod 700 ~/.ssh"
-        ]
-        combined_config = ""
-        
-        with open(log_file, "w") as f:
-            for entry in self.identities:
-                priv = Path(entry.private_key).expanduser()
-                pub = Path(entry.public_key).expanduser()
-                config_entry = dedent(entry.config_entry).strip()
+        data, digest = self.bundle()
 
-                if not priv.exists() or not pub.exists():
-                    self.logger.error(f"SSH key not found: {priv} or {pub}")
-                    continue
+        # Already-configured workers only compare the hash; otherwise unpack to a temp dir and install
+        cmd = dedent(f"""
+            H={digest}
+            if [ "$(cat ~/.ssh/.jobman_identity 2>/dev/null)" = "$H" ]; then cat >/dev/null; echo "jobman-ssh-identity $H"; exit 0; fi
+            mkdir -p ~/.ssh && chmod 700 ~/.ssh && T=$(mktemp -d ~/.ssh/.bundle.XXXXXX) || exit 1
+            base64 -d | tar -xzpf - -C "$T" && bash "$T/install.sh" "$T" "$H"; rc=$?
+            rm -rf "$T"; exit $rc
+        """).strip()
 
-                self._copy_key_to_worker(i, priv, f)
-                self._copy_key_to_worker(i, pub, f)
-
-                ssh_setup_cmds += [
-                    f"chmod 600 ~/.ssh/{priv.name}",
-                    f"chmod 644 ~/.ssh/{pub.name}",
-                ]
-                
-                combined_config += config_entry + "\n\n"
-            
-            if combined_config:
-                escaped_config = combined_config.strip().replace('"', '\\"').replace('\n', '\\n')
-                ssh_setup_cmds += [
-                    f'sudo printf "{escaped_config}\\n" > ~/.ssh/config',
-                    'chmod 600 ~/.ssh/config'
-                ]
+        with open(log_file, "w") as f:
+            result = self.remote.run(i, cmd, input=data, stdout=subprocess.PIPE, stderr=f)
+            f.write(result.stdout or "")
+        if result.returncode != 0 or f"jobman-ssh-identity {digest}" not in (result.stdout or ""):
+            raise RuntimeError(f"Worker {i}: SSH identity install failed (exit {result.returncode}), see {log_file}")
+        self.logger.debug(f"Worker {i}: SSH identities at {digest}")
 
-            cmd = " && ".join(ssh_setup_cmds)
-            self.logger.debug(f"Worker {i}: Running SSH config cmd: {cmd}")
-            self._configure_remote_ssh(i, cmd, f)
-        
-    def _copy_key_to_worker(self, i, key_file, f):
-        target_path = f"{self.cfg.tpu.name}:~/.ssh/{key_file.name}"
-        scp_cmd = [
-            "gcloud", "compute", "tpus", "tpu-vm", "scp", str(key_file), target_path,
-            "--worker", str(i), "--zone", self.cfg.tpu.zone,
-            "--ssh-key-file", str(self.private_key),
-            "--scp-flag=-o ConnectTimeout=15",
-            "--scp-flag=-o StrictHostKeyChecking=no",
-            "--scp-flag=-o UserKnownHostsFile=/dev/null",
-            "--quiet",
-        ]
-        self.logger.debug("Using scp command:")
-        self.logger.debug(" ".join(scp_cmd))
-        try:
-            subprocess.run(scp_cmd, check=True, stdout=f, stderr=f)
-            self.logger.debug(f"Worker {i}: Copied {key_file.name}")
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Worker {i}: Failed to copy {key_file.name}: {e}")
-            
-    def _configure_remote_ssh(self, i, cmd, f):
-        ssh_cmd = [
-            "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", self.cfg.tpu.name,
-            "--worker", str(i), "--zone", self.cfg.tpu.zone,
-            "--command", cmd,
-            "--ssh-key-file", str(self.private_key),
-            "--ssh-flag=-o ConnectTimeout=15",
-            "--ssh-flag=-o StrictHostKeyChecking=no",
-            "--ssh-flag=-o UserKnownHostsFile=/dev/null",
-            "--quiet",
-        ]
-        try:
-            subprocess.run(ssh_cmd, check=True, stdout=f, stderr=f)
-            self.logger.debug(f"Worker {i}: Remote SSH configured")
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Worker {i}: Remote SSH config failed: {e}")
-            
     def _check_worker(self, i):
         raise NotImplementedError
 
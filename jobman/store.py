@@ -0,0 +1,239 @@
+import json
+import sqlite3
+from pathlib import Path
+from contextlib import contextmanager
+
+class JobStore:
+    """
+    Transactional job metadata store backed by SQLite in WAL mode.
+
+    Each job is one row holding its metadata as JSON, so updates touch a
+    single row and readers get a consistent snapshot without blocking writers.
+    Job ID allocation happens in the same transaction as the row insert.
+    """
+
+    def __init__(self, db_path: Path, busy_timeout: float = 30.0):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.busy_timeout = busy_timeout
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, "
+                "meta TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "name TEXT PRIMARY KEY, "
+                "value INTEGER NOT NULL)"
+            )
+            # Warm pool: READY slices released by finished jobs, keyed by (name, zone)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS slices ("
+                "name TEXT NOT NULL, "
+                "zone TEXT NOT NULL, "
+                "accelerator TEXT, "
+                "version TEXT, "
+                "pricing TEXT, "
+                "owner TEXT, "
+                "expires_at REAL, "
+                "meta TEXT NOT NULL, "
+                "PRIMARY KEY (name, zone))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+        try:
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; BEGIN IMMEDIATE takes the write lock up front."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _next_job_id(self, conn):
+        row = conn.execute("SELECT value FROM counters WHERE name = 'job_id'").fetchone()
+        next_id = (row[0] if row else 0) + 1
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES ('job_id', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (next_id,)
+        )
+        return f"{next_id:06d}"
+
+    def create_job(self, build_meta):
+        """Allocate the next job ID and insert its row atomically.
+
+        `build_meta` is called with the new job ID and returns the metadata dict.
+        """
+        with self._transaction() as conn:
+            job_id = self._next_job_id(conn)
+            meta = {"job_id": job_id, **build_meta(job_id)}
+            conn.execute(
+                "INSERT INTO jobs (job_id, meta) VALUES (?, ?)",
+                (job_id, json.dumps(meta))
+            )
+        return job_id, meta
+
+    def get_job(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT meta FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_jobs(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT meta FROM jobs ORDER BY job_id").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def update_job(self, job_id, **kwargs):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT meta FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            meta = json.loads(row[0]) if row else {"job_id": job_id}
+            meta.update(kwargs)
+            conn.execute(
+                "INSERT INTO jobs (job_id, meta) VALUES (?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET meta = excluded.meta",
+                (job_id, json.dumps(meta))
+            )
+        return meta
+
+    def remove_job(self, job_id):
+        with self._transaction() as conn:
+            cur = conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        return cur.rowcount > 0
+
+    @staticmethod
+    def _slice_row(row):
+        name, zone, accelerator, version, pricing, owner, expires_at, meta = row
+        return {
+            "name": name, "zone": zone, "accelerator": accelerator, "version": version,
+            "pricing": pricing, "owner": owner, "expires_at": expires_at, **json.loads(meta)
+        }
+
+    _SLICE_COLUMNS = "name, zone, accelerator, version, pricing, owner, expires_at, meta"
+
+    def put_slice(self, name, zone, accelerator, version, pricing, owner=None, expires_at=None, **meta):
+        with self._transaction() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO slices ({self._SLICE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, zone, accelerator, version, pricing, owner, expires_at, json.dumps(meta))
+            )
+
+    def get_slice(self, name, zone):
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {self._SLICE_COLUMNS} FROM slices WHERE name = ? AND zone = ?", (name, zone)
+            ).fetchone()
+        return self._slice_row(row) if row else None
+
+    def list_slices(self):
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {self._SLICE_COLUMNS} FROM slices ORDER BY expires_at").fetchall()
+        return [self._slice_row(row) for row in rows]
+
+    def set_slice_owner(self, name, zone, owner, expires_at=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE slices SET owner = ?, expires_at = ? WHERE name = ? AND zone = ?",
+                (owner, expires_at, name, zone)
+            )
+
+    def remove_slice(self, name, zone):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slices WHERE name = ? AND zone = ?", (name, zone))
+
+    def lease_slice(self, keys, owner, now):
+        """
+        Atomically hand the most recently released idle slice matching any of `keys`
+        (dicts of zone/accelerator/version/pricing) to `owner`.
+        """
+        with self._transaction() as conn:
+            for key in keys:
+                row = conn.execute(
+                    f"SELECT {self._SLICE_COLUMNS} FROM slices "
+                    "WHERE owner IS NULL AND expires_at > ? "
+                    "AND zone = ? AND accelerator = ? AND version = ? AND pricing = ? "
+                    "ORDER BY expires_at DESC LIMIT 1",
+                    (now, key["zone"], key["accelerator"], key["version"], key["pricing"])
+                ).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE slices SET owner = ?, expires_at = NULL WHERE name = ? AND zone = ?",
+                        (owner, row[0], row[1])
+                    )
+                    return {**self._slice_row(row), "owner": owner, "expires_at": None}
+        return None
+
+    def reclaim_slice(self, name, zone, owner, now):
+        """
+        Atomically hand slice (name, zone) to `owner` if it is idle and unexpired
+        (or already theirs). Returns the row as it was before, or None if the slice
+        is not in the pool, and whether `owner` now holds it.
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"SELECT {self._SLICE_COLUMNS} FROM slices WHERE name = ? AND zone = ?", (name, zone)
+            ).fetchone()
+            if row is None:
+                return None, False
+            cur = conn.execute(
+                "UPDATE slices SET owner = ?, expires_at = NULL WHERE name = ? AND zone = ? "
+                "AND (owner = ? OR (owner IS NULL AND expires_at > ?))",
+                (owner, name, zone, owner, now)
+            )
+        return self._slice_row(row), cur.rowcount == 1
+
+    def claim_expired_slices(self, owner, now):
+        """Atomically hand every expired idle slice to `owner` (the reaper)."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"SELECT {self._SLICE_COLUMNS} FROM slices WHERE owner IS NULL AND expires_at <= ?", (now,)
+            ).fetchall()
+            for row in rows:
+                conn.execute("UPDATE slices SET owner = ? WHERE name = ? AND zone = ?", (owner, row[0], row[1]))
+        return [{**self._slice_row(row), "owner": owner} for row in rows]
+
+    def migrate_legacy(self, meta_file: Path, cntr_file: Path):
+        """One-shot import of the old meta.json / next_job_id.txt files.
+
+        The legacy files are renamed with a `.migrated` suffix afterwards so
+        the import never runs twice.
+        """
+        meta_file, cntr_file = Path(meta_file), Path(cntr_file)
+        if not meta_file.exists() and not cntr_file.exists():
+            return False
+
+        with self._transaction() as conn:
+            if meta_file.exists():
+                legacy = json.loads(meta_file.read_text() or "{}")
+                for key, meta in legacy.items():
+                    job_id = meta.get("job_id") or key.split("job_", 1)[-1]
+                    conn.execute(
+                        "INSERT OR IGNORE INTO jobs (job_id, meta) VALUES (?, ?)",
+                        (job_id, json.dumps(meta))
+                    )
+            if cntr_file.exists():
+                counter = int(cntr_file.read_text().strip() or 0)
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES ('job_id', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (counter,)
+                )
+            # Renamed under the write lock so concurrent migrations serialize
+            for f in (meta_file, cntr_file):
+                if f.exists():
+                    f.rename(f.with_name(f.name + ".migrated"))
+        return True
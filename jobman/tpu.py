@@ -1,15 +1,61 @@
 import time
 import json
 import logging
+import threading
 import subprocess
 from pathlib import Path
 from datetime import datetime
+from omegaconf import OmegaConf
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from jobman.utils import setup_logger
+from jobman import gcloud
+from jobman.provisioning import ZoneStatePoller, classify_error, backoff_delay, poll_interval_for
+from jobman.utils import setup_logger, infer_num_workers
+
+# tpu fields a race candidate may override
+CANDIDATE_KEYS = ("zone", "accelerator", "allocation_mode", "version", "pricing")
+
+def _list_zone(cmd, max_age=None):
+    result = gcloud.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, max_age=max_age)
+    return json.loads(result.stdout or "[]")
+
+def list_tpu_vm_states(zone, max_age=None):
+    """Map TPU VM name -> state for every node in a zone with a single gcloud call."""
+    nodes = _list_zone([
+        "gcloud", "alpha", "compute", "tpus", "tpu-vm", "list",
+        "--zone", zone, "--format=json"
+    ], max_age=max_age)
+    return {n["name"].split("/")[-1]: n.get("state", "") for n in nodes}
+
+def list_queued_resource_states(zone, max_age=None):
+    """Map queued resource name -> state for every queued resource in a zone."""
+    resources = _list_zone([
+        "gcloud", "compute", "tpus", "queued-resources", "list",
+        "--zone", zone, "--format=json"
+    ], max_age=max_age)
+    return {r["name"].split("/")[-1]: r.get("state", {}).get("state", "") for r in resources}
+
+def resolve_candidates(candidates):
+    """
+    Normalize `tpu.candidates` into a list of override dicts.
+    Entries are either dicts of CANDIDATE_KEYS or paths to configs whose `tpu` section is used.
+    """
+    resolved = []
+    for c in candidates or []:
+        if isinstance(c, str):
+            c = OmegaConf.load(c).tpu
+        c = OmegaConf.to_container(c, resolve=True) if OmegaConf.is_config(c) else dict(c)
+        resolved.append({k: c[k] for k in CANDIDATE_KEYS if c.get(k) is not None})
+    
+    zones = [c.get("zone") for c in resolved]
+    if len(set(zones)) != len(zones):
+        raise ValueError(f"TPU candidates must be in distinct zones: {zones}")
+    return resolved
 
 class TPU:
     
-    def __init__(self, cfg):
+    def __init__(self, cfg, log_file=None):
+        self.cfg = cfg
         self.name = cfg.tpu.name
         self.zone = cfg.tpu.zone
         self.accelerator = cfg.tpu.accelerator
@@ -20,7 +66,13 @@ class TPU:
         self.startup_script = cfg.tpu.get("startup_script", None)
         
         self.mode = cfg.tpu.allocation_mode
-        self.log_file = Path(cfg.job.dir) / "logs" / "tpu.log"
+        poll = cfg.tpu.get("poll", None) or {}
+        self.poll_fast = poll.get("fast", 5)
+        self.poll_default = poll.get("default", 30)
+        self.poll_slow = poll.get("slow", 60)
+        self.candidates = resolve_candidates(cfg.tpu.get("candidates", None))
+        self.cancelled = threading.Event()
+        self.log_file = Path(log_file or Path(cfg.job.dir) / "logs" / "tpu.log")
         self.logger = setup_logger(log_file=self.log_file)
         
     def check_tpu_status(self):
@@ -32,14 +84,13 @@ class TPU:
     
     def _check_tpu_vm_status(self):
         try:
-            result = subprocess.run(
+            result = gcloud.run(
                 [
                     "gcloud", "alpha", "compute", "tpus", "tpu-vm", "describe",
                     self.name, "--zone", self.zone, "--format=value(state)"
                 ],
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                stderr=subprocess.PIPE
             )
             return result.stdout.strip() or "NOT FOUND"
         except Exception as e:
@@ -48,14 +99,13 @@ class TPU:
     
     def _check_queued_resource_status(self):
         try:
-            result = subprocess.run(
+            result = gcloud.run(
                 [
                     "gcloud", "compute", "tpus", "queued-resources", "describe",
                     self.name, "--zone", self.zone, "--format=value(state)"
                 ],
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                stderr=subprocess.PIPE
             )
             result = result.stdout.strip().replace("state=", "")
             return result if result else "NOT FOUND"
@@ -87,6 +137,8 @@ class TPU:
         return False
         
     def request(self):
+        if self.candidates:
+            return self._request_race()
         
         base_cmd = [
             "gcloud", "alpha" if self.mode == "tpu-vm" else "", "compute", "tpus",
@@ -105,7 +157,13 @@ class TPU:
         elif self.pricing == "spot":
             base_cmd += ["--spot"]
 
-        if self.startup_script:
+        boot_file = Path(self.cfg.job.dir) / "bootstrap.sh"
+        if self.cfg.job.get("bootstrap", False) and boot_file.exists():
+            # Rendered by Job (see Bootstrap); it also runs `startup_script`
+            base_cmd += ["--metadata-from-file", f"startup-script={boot_file}"]
+            if self.metadata:
+                base_cmd += ["--metadata", ",".join(f"{k}={v}" for k, v in self.metadata.items())]
+        elif self.startup_script:
             base_cmd += ["--metadata", f"startup-script={self.startup_script}"]
         elif self.metadata:
             meta_str = ",".join(f"{k}={v}" for k, v in self.metadata.items())
@@ -125,53 +183,161 @@ class TPU:
         else:
             return self._request_queued_resources(cmd)
         
+    def _candidate_tpus(self):
+        tpus = []
+        for c in self.candidates:
+            cand_cfg = OmegaConf.merge(self.cfg, {"tpu": {**c, "candidates": None}})
+            tpus.append(TPU(cand_cfg, log_file=Path(self.cfg.job.dir) / "logs" / f"tpu_{cand_cfg.tpu.zone}.log"))
+        return tpus
+    
+    def _request_race(self):
+        """Submit to every candidate at once; keep the first to reach READY and tear down the rest."""
+        racers = self._candidate_tpus()
+        self.logger.info("Racing TPU candidates: " + ", ".join(f"{r.accelerator}@{r.zone}" for r in racers))
+
+        executor = ThreadPoolExecutor(max_workers=len(racers))
+        futures = {executor.submit(r.request): r for r in racers}
+        pending = set(futures)
+        winner = None
+        try:
+            while pending and winner is None and not self.cancelled.is_set():
+                done, pending = wait(pending, timeout=5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    racer = futures[future]
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        self.logger.error(f"Candidate {racer.accelerator}@{racer.zone} failed: {e}")
+                        ok = False
+                    if ok and winner is None:
+                        winner = racer
+                    elif not ok:
+                        self.logger.warning(f"Candidate {racer.accelerator}@{racer.zone} gave up.")
+        finally:
+            losers = [r for r in racers if r is not winner]
+            for r in losers:
+                r.cancelled.set()
+                gcloud.gcloud.terminate(r.name, r.zone)
+            # Losers are deleted in the background so the winner can proceed to setup
+            threading.Thread(target=self._teardown, args=(futures, losers), name="tpu-teardown").start()
+            executor.shutdown(wait=False)
+
+        if winner is None:
+            self.logger.error("No TPU candidate became READY.")
+            return False
+
+        self.logger.info(f"Candidate {winner.accelerator}@{winner.zone} won the race.")
+        self.adopt(winner)
+        return True
+    
+    def _teardown(self, futures, losers):
+        for future, racer in futures.items():
+            if racer in losers:
+                wait([future])
+                try:
+                    racer.delete()
+                except Exception as e:
+                    self.logger.warning(f"Failed to delete losing candidate in {racer.zone}: {e}")
+    
+    def adopt(self, other):
+        """Point this TPU (and the job config) at another candidate's allocation."""
+        self.zone = other.zone
+        self.accelerator = other.accelerator
+        self.mode = other.mode
+        self.version = other.version
+        self.pricing = other.pricing
+        
+        self.cfg.tpu.zone = self.zone
+        self.cfg.tpu.accelerator = self.accelerator
+        self.cfg.tpu.allocation_mode = self.mode
+        self.cfg.tpu.version = self.version
+        self.cfg.tpu.pricing = self.pricing
+        self.cfg.tpu.num_workers = infer_num_workers(self.accelerator)
+        
+    def _create(self, cmd):
+        """Run a create command, appending its output to the TPU log; returns (ok, error kind)."""
+        with open(self.log_file, "a") as f:
+            result = gcloud.run(cmd, stdout=f, stderr=subprocess.PIPE)
+            f.write(result.stderr or "")
+        if result.returncode == 0:
+            return True, None
+        return False, classify_error(result.stderr)
+        
     def _request_tpu_vm(self, cmd):
         attempt = 1
-        while True:
+        while not self.cancelled.is_set():
             self.logger.info(f"Attempt {attempt}: Creating TPU VM...")
-            with open(self.log_file, "a") as f:
-                result = subprocess.run(cmd, stdout=f, stderr=f)
-            if result.returncode == 0:
+            ok, kind = self._create(cmd)
+            if ok:
                 self.logger.info("TPU VM created successfully.")
                 return True
-            self.logger.error("Failed. Retrying immediately...")
+            delay = backoff_delay(attempt, kind)
+            self.logger.error(f"Failed ({kind}). Retrying in {delay:.0f}s...")
+            self.cancelled.wait(delay)
             attempt += 1
+        return False
     
     def _request_queued_resources(self, cmd):
-        with open(self.log_file, "a") as f:
-            result = subprocess.run(cmd, stdout=f, stderr=f)
-
-        if result.returncode != 0:
-            self.logger.error("Failed to submit queued resource.")
+        attempt = 1
+        while not self.cancelled.is_set():
+            ok, kind = self._create(cmd)
+            if ok:
+                break
+            if kind != "rate_limit":
+                self.logger.error(f"Failed to submit queued resource ({kind}).")
+                return False
+            delay = backoff_delay(attempt, kind)
+            self.logger.warning(f"Queued resource submission rate limited. Retrying in {delay:.0f}s...")
+            self.cancelled.wait(delay)
+            attempt += 1
+        else:
             return False
 
         self.logger.info("Queued resource submitted. Polling until READY...")
 
         return self.wait_tpu_vm_until_ready()
     
-    def wait_tpu_vm_until_ready(self, poll_interval=30):
-        while True:
-            status = self._check_tpu_vm_status()
-            self.logger.info(f"Current status: {status}")
+    def wait_tpu_vm_until_ready(self, poll_interval=None):
+        """
+        Poll the shared zone snapshot until the TPU is READY. The interval adapts
+        to the observed state unless `poll_interval` is given.
+        """
+        poller = ZoneStatePoller.for_zone(self.zone)
+        queued = self.mode == "queued-resources"
+        interval = poll_interval or self.poll_fast
+        last = None
+        while not self.cancelled.is_set():
+            try:
+                vm_state, qr_state = poller.states(self.name, max_age=interval / 2, queued=queued)
+            except Exception as e:
+                self.logger.warning(f"Failed to poll zone {self.zone}: {e}")
+                vm_state = qr_state = "UNKNOWN"
+            status = vm_state or "NOT FOUND"
+            if (status, qr_state) != last:
+                self.logger.info(f"Current status: {status}" + (f" (queued resource: {qr_state})" if queued else ""))
+                last = (status, qr_state)
             if status in {"READY", "ACTIVE"}:
                 self.logger.info("TPU is READY!")
                 return True
-            elif status in {"FAILED", "DELETING", "UNSPECIFIED"}:
-                self.logger.error(f"TPU failed or disappeared: {status}")
+            elif status in {"FAILED", "DELETING", "UNSPECIFIED"} or qr_state in {"FAILED", "SUSPENDED"}:
+                self.logger.error(f"TPU failed or disappeared: {status} / {qr_state}")
                 return False
-            time.sleep(poll_interval)
+            interval = poll_interval or poll_interval_for(
+                vm_state, qr_state, fast=self.poll_fast, default=self.poll_default, slow=self.poll_slow
+            )
+            self.cancelled.wait(interval)
+        return False
     
     def get_ips(self):
         """Get internal and external IPs of all TPU workers."""
         try:
-            result = subprocess.run(
+            result = gcloud.run(
                 [
                     "gcloud", "alpha", "compute", "tpus", "tpu-vm", "describe",
                     self.name, "--zone", self.zone, "--format=json"
                 ],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True,
                 check=True
             )
             data = json.loads(result.stdout)
@@ -209,7 +375,7 @@ class TPU:
             ]
             try:
                 self.logger.debug(f"Running command: {' '.join(cmd)}")
-                subprocess.run(cmd, check=True)
+                gcloud.run(cmd, check=True)
                 self.logger.info("TPU VM deleted successfully.")
             except:
                 self.logger.info("No TPU VM to delete or deletion failed (possibly already gone).")
@@ -225,11 +391,16 @@ class TPU:
                 ]
                 try:
                     self.logger.debug(f"Running command: {' '.join(cmd)}")
-                    subprocess.run(cmd, check=True)
+                    gcloud.run(cmd, check=True)
                     self.logger.info("Queued resources deleted.")
                 except:
                     self.logger.warning("No Queued resources to delete or deletion failed (possibly already gone).")
             else:
                 self.logger.info("Queued resources not found. Skipping deletion.")
+        
+        # Leftovers from an interrupted race live in the other candidate zones
+        for racer in self._candidate_tpus():
+            if racer.zone != self.zone:
+                racer.delete()
             
 
@@ -1,11 +1,28 @@
+import re
 import sys
+import math
 import logging
 from pathlib import Path
 
+jobs_dir = Path("jobs") 
+jobman_dir = jobs_dir / ".jobman"
+
+# apt-get for setup scripts. Stages run in parallel on a worker, so jobman's own
+# apt calls take turns on one lock, and wait for other holders of the dpkg lock
+# (e.g. unattended-upgrades) instead of failing or killing them.
+APT_GET = "sudo flock /var/lock/jobman-apt apt-get -o DPkg::Lock::Timeout=600"
+
 def setup_logger(log_file: Path = None, level=logging.DEBUG, stdout=False):
-    """Configure global logging to stdout and/or a log file."""
-    # Get root logger
-    logger = logging.getLogger()
+    """Configure logging to stdout and/or a log file.
+
+    Loggers with a log file are keyed by that file and do not propagate, so
+    several jobs can log to their own files from a single process.
+    """
+    if log_file is not None:
+        logger = logging.getLogger(f"jobman.{Path(log_file).resolve()}")
+        logger.propagate = False
+    else:
+        logger = logging.getLogger()
     logger.setLevel(level)
 
     # Prevent duplicate handlers if setup_logger is called more than once
@@ -29,4 +46,23 @@ def setup_logger(log_file: Path = None, level=logging.DEBUG, stdout=False):
         file_handler.setFormatter(formatter)
         logger.addHandler(file_handler)
         
-    return logger
\ No newline at end of file
+    return logger
+
+def infer_num_workers(accelerator: str) -> int:
+    """
+    Infer number of workers based on accelerator type.
+    Examples:
+        v4-256 -> 32 workers (256 // 8)
+        v5e-32 -> 8 workers (32 // 4)
+    """
+    match = re.search(r"v(\d+)[a-z]*-(\d+)", accelerator.lower())
+    if not match:
+        raise ValueError(f"Invalid accelerator format: {accelerator}")
+    
+    version, chips = int(match.group(1)), int(match.group(2))
+    if version in [2, 3, 4]:
+        return math.ceil(chips / 8)
+    elif version in [5, 6]:
+        return math.ceil(chips / 4)
+    else:
+        raise ValueError(f"Unknown TPU version in accelerator: {accelerator}")
@@ -0,0 +1,18 @@
+import pytest
+from omegaconf import OmegaConf
+
+@pytest.fixture
+def make_cfg(tmp_path):
+    """Minimal job config in `tmp_path`; keyword arguments override or add sections."""
+    def make(**sections):
+        cfg = {
+            "job": {"dir": str(tmp_path / "job"), "id": "j1", "name": "test"},
+            "tpu": {"name": "tpu-test", "zone": "us-central2-b", "accelerator": "v4-16", "num_workers": 2, "version": "tpu-ubuntu2204-base"},
+            "ssh": {"private_key": str(tmp_path / "id")},
+            "gcsfuse": {"bucket_name": "bucket", "mount_path": "/mnt/bucket"},
+            "command": {"cmd": "true"},
+        }
+        for name, value in sections.items():
+            cfg[name] = {**cfg.get(name, {}), **value}
+        return OmegaConf.create(cfg)
+    return make
@@ -0,0 +1,86 @@
+import io
+import os
+import time
+import tarfile
+import subprocess
+
+import pytest
+
+from jobman.code import CODE, tree_files, remote_path
+
+def git(root, *args):
+    subprocess.run(["git", "-C", str(root), "-c", "user.name=t", "-c", "user.email=t@t", *args], check=True, stdout=subprocess.DEVNULL)
+
+def make_tree(root):
+    (root / "pkg").mkdir(parents=True)
+    (root / "pkg" / "train.py").write_text("print('train')\n")
+    (root / "README.md").write_text("readme\n")
+    (root / "run.sh").write_text("#!/bin/bash\n")
+    (root / "run.sh").chmod(0o755)
+    os.symlink("pkg/train.py", root / "main.py")
+
+def make_code(make_cfg, root):
+    return CODE(make_cfg(job={"code_dir": str(root)}))
+
+def test_remote_path():
+    assert remote_path("~/code/x") == "$HOME/code/x"
+    assert remote_path("/opt/code") == "/opt/code"
+
+def test_tree_files_without_git(tmp_path):
+    root = tmp_path / "src"
+    make_tree(root)
+    # A stray .git directory that is not a repo is still skipped
+    (root / ".git").mkdir()
+    (root / ".git" / "junk").write_text("")
+    assert tree_files(root) == ["README.md", "main.py", "pkg/train.py", "run.sh"]
+
+def test_tree_files_follows_git(tmp_path):
+    root = tmp_path / "src"
+    make_tree(root)
+    (root / ".gitignore").write_text("*.log\n")
+    (root / "out.log").write_text("noise\n")
+    git(root, "init", "-q")
+    git(root, "add", "-A")
+    git(root, "commit", "-q", "-m", "init")
+    # Untracked files are shipped, deleted tracked ones and ignored ones are not
+    (root / "new.py").write_text("")
+    (root / "README.md").unlink()
+    assert tree_files(root) == [".gitignore", "main.py", "new.py", "pkg/train.py", "run.sh"]
+
+def test_snapshot_is_reproducible(make_cfg, tmp_path):
+    root = tmp_path / "src"
+    make_tree(root)
+    first = make_code(make_cfg, root)
+    packed = io.BytesIO()
+    first._pack(packed)
+
+    # Same content, new mtimes: same digest and same bytes
+    time.sleep(0.01)
+    for p in (root / "README.md", root / "pkg" / "train.py"):
+        p.write_text(p.read_text())
+    second = make_code(make_cfg, root)
+    again = io.BytesIO()
+    second._pack(again)
+    assert second.snapshot_digest() == first.snapshot_digest()
+    assert again.getvalue() == packed.getvalue()
+    assert first.uri().endswith(f"/jobman/code/{first.snapshot_digest()}.tar.gz")
+
+    with tarfile.open(fileobj=io.BytesIO(packed.getvalue()), mode="r:gz") as tar:
+        members = {m.name: m for m in tar.getmembers()}
+    assert list(members) == ["README.md", "main.py", "pkg/train.py", "run.sh"]
+    assert members["main.py"].issym() and members["main.py"].linkname == "pkg/train.py"
+    assert members["run.sh"].mode & 0o111
+    assert all(m.mtime == 0 and m.uid == 0 for m in members.values())
+
+@pytest.mark.parametrize("change", ["content", "mode", "rename"])
+def test_snapshot_digest_tracks_changes(make_cfg, tmp_path, change):
+    root = tmp_path / "src"
+    make_tree(root)
+    before = make_code(make_cfg, root).snapshot_digest()
+    if change == "content":
+        (root / "README.md").write_text("changed\n")
+    elif change == "mode":
+        (root / "README.md").chmod(0o755)
+    else:
+        (root / "README.md").rename(root / "README.txt")
+    assert make_code(make_cfg, root).snapshot_digest() != before
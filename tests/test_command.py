@@ -0,0 +1,85 @@
+import time
+import asyncio
+import subprocess
+
+from jobman import command as command_module
+from jobman.command import COMMAND, BARRIER
+
+class LocalHosts:
+    """Stands in for Remote: worker i runs commands with bash here, its launch dir under host<i>/."""
+
+    def __init__(self, root, fail=()):
+        self.root = root
+        self.fail = set(fail)
+
+    def local(self, i, command):
+        return command.replace(command_module.LAUNCH_DIR, f"{self.root}/host{i}/launch")
+
+    def relay_groups(self, workers):
+        return None
+
+    def open_all(self, workers=None):
+        return {}
+
+    async def arun(self, i, command, stdout=None, stderr=None, input=None):
+        if i in self.fail:
+            raise RuntimeError("unreachable")
+        proc = await asyncio.create_subprocess_exec("bash", "-c", self.local(i, command), stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+        out, _ = await proc.communicate(input.encode() if input else None)
+        return subprocess.CompletedProcess(command, proc.returncode, out.decode() if out else None)
+
+    def run_all(self, workers, command, outputs, timeout=None, bounded=True):
+        procs = {i: subprocess.Popen(["bash", "-c", self.local(i, command)], stdout=outputs[i], stderr=subprocess.STDOUT) for i in workers}
+        return {i: p.wait(timeout) for i, p in procs.items()}
+
+def make_command(make_cfg, tmp_path, monkeypatch, fail=()):
+    monkeypatch.setattr(command_module, "LAUNCH_DIR", "/jobman-launch")
+    (tmp_path / "job" / "logs").mkdir(parents=True)
+    cmd = COMMAND(make_cfg(command={"sync_start": True, "launch_lead": 0.2, "launch_timeout": 10}))
+    cmd.remote = LocalHosts(tmp_path, fail)
+    return cmd
+
+def test_barrier_prefix_is_per_launch(make_cfg, tmp_path, monkeypatch):
+    cmd = make_command(make_cfg, tmp_path, monkeypatch)
+    first = cmd.barrier("python train.py")
+    token = cmd.token
+    assert first == f"bash /jobman-launch/{token}/barrier.sh && python train.py"
+    assert cmd.launch_dir() == f"/jobman-launch/{token}"
+    cmd.barrier("python train.py")
+    assert cmd.token != token
+
+def test_barrier_script_waits_for_the_start_time(tmp_path):
+    d = tmp_path / "launch"
+    d.mkdir()
+    (d / "barrier.sh").write_text(BARRIER)
+    proc = subprocess.Popen(["bash", str(d / "barrier.sh")])
+    deadline = time.monotonic() + 5
+    while not (d / "ready").exists():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    time.sleep(0.2)
+    assert proc.poll() is None and not (d / "start").exists()
+
+    go = time.time_ns() + 300_000_000
+    (d / "go").write_text(f"{go}\n")
+    assert proc.wait(5) == 0
+    assert int((d / "start").read_text()) >= go
+
+def test_synchronized_launch(make_cfg, tmp_path, monkeypatch):
+    cmd = make_command(make_cfg, tmp_path, monkeypatch)
+    cmd.full_cmd = cmd.barrier("echo started")
+    token = cmd.token
+    # Left behind by another job's launch on the same hosts
+    (tmp_path / "host0" / "launch" / "other").mkdir(parents=True)
+    assert cmd.run()
+    for i in (0, 1):
+        assert (tmp_path / "job" / "logs" / f"main_command_worker_{i}.log").read_text() == "started\n"
+        assert not (tmp_path / f"host{i}" / "launch" / token).exists()
+    assert (tmp_path / "host0" / "launch" / "other").exists()
+    assert cmd.token is None
+
+def test_failed_staging_does_not_launch(make_cfg, tmp_path, monkeypatch):
+    cmd = make_command(make_cfg, tmp_path, monkeypatch, fail={1})
+    cmd.full_cmd = cmd.barrier("echo started")
+    assert not cmd.run()
+    assert (tmp_path / "job" / "logs" / "main_command_worker_0.log").read_text() == ""
@@ -0,0 +1,101 @@
+import json
+import time
+import logging
+import threading
+
+import pytest
+
+from jobman.dag import Stage, SetupDAG, run_per_worker
+
+logger = logging.getLogger("jobman.tests")
+
+class Recorder:
+    """Stage functions that log (worker, stage, start, end) and can be made to fail."""
+
+    def __init__(self, fail=(), delay=0.0):
+        self.fail = set(fail)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.runs = []
+
+    def stage(self, name):
+        def fn(i):
+            start = time.monotonic()
+            time.sleep(self.delay)
+            with self.lock:
+                self.runs.append((i, name, start, time.monotonic()))
+            if (i, name) in self.fail:
+                raise RuntimeError(f"{name} failed on {i}")
+        return fn
+
+    def ran(self, i=None):
+        return {(w, n) for w, n, _, _ in self.runs if i is None or w == i}
+
+    def span(self, i, name):
+        return next((s, e) for w, n, s, e in self.runs if (w, n) == (i, name))
+
+def test_stages_run_after_their_prerequisites(tmp_path):
+    rec = Recorder(delay=0.05)
+    stages = [
+        Stage("ssh", rec.stage("ssh")),
+        Stage("gcsfuse", rec.stage("gcsfuse"), after=["ssh"]),
+        Stage("docker", rec.stage("docker"), after=["ssh"]),
+        Stage("container", rec.stage("container"), after=["docker", "gcsfuse"]),
+    ]
+    dag = SetupDAG(stages, workers=[0, 1], logger=logger, timings_file=tmp_path / "timings.json")
+    assert dag.run()
+    for i in (0, 1):
+        assert rec.span(i, "ssh")[1] <= rec.span(i, "gcsfuse")[0]
+        assert rec.span(i, "ssh")[1] <= rec.span(i, "docker")[0]
+        assert max(rec.span(i, "docker")[1], rec.span(i, "gcsfuse")[1]) <= rec.span(i, "container")[0]
+    # Independent stages of one worker overlap
+    g, d = rec.span(0, "gcsfuse"), rec.span(0, "docker")
+    assert g[0] < d[1] and d[0] < g[1]
+    timings = json.loads((tmp_path / "timings.json").read_text())
+    assert {(t["worker"], t["stage"], t["status"]) for t in timings} == {(i, n, "done") for i in (0, 1) for n in ("ssh", "gcsfuse", "docker", "container")}
+
+def test_failure_skips_dependents_on_that_worker_only():
+    rec = Recorder(fail={(1, "docker")})
+    stages = [
+        Stage("ssh", rec.stage("ssh")),
+        Stage("docker", rec.stage("docker"), after=["ssh"]),
+        Stage("container", rec.stage("container"), after=["docker"]),
+        Stage("gcsfuse", rec.stage("gcsfuse"), after=["ssh"]),
+    ]
+    dag = SetupDAG(stages, workers=[0, 1], logger=logger)
+    assert not dag.run()
+    assert (1, "container") not in rec.ran()
+    assert (1, "gcsfuse") in rec.ran() and (0, "container") in rec.ran()
+    assert dag.status[(1, "docker")] == "failed"
+    assert dag.status[(1, "container")] == "skipped"
+
+def test_cached_stages_are_not_run_and_on_done_follows_success():
+    rec = Recorder(fail={(0, "env")})
+    done = []
+    stages = [Stage("ssh", rec.stage("ssh")), Stage("env", rec.stage("env"), after=["ssh"])]
+    dag = SetupDAG(
+        stages, workers=[0, 1], logger=logger,
+        cached={(0, "ssh"), (1, "ssh")}, on_done=lambda i, stage: done.append((i, stage.name)),
+    )
+    assert not dag.run()
+    # Cached stages count as done: their dependents run, they do not
+    assert rec.ran() == {(0, "env"), (1, "env")}
+    assert done == [(1, "env")]
+
+def test_failing_on_done_fails_the_stage():
+    def on_done(i, stage):
+        raise OSError("marker not written")
+    rec = Recorder()
+    dag = SetupDAG([Stage("a", rec.stage("a")), Stage("b", rec.stage("b"), after=["a"])], workers=[0], logger=logger, on_done=on_done)
+    assert not dag.run()
+    assert dag.status == {(0, "a"): "failed", (0, "b"): "skipped"}
+
+def test_unknown_prerequisite_is_rejected():
+    with pytest.raises(ValueError):
+        SetupDAG([Stage("a", lambda i: None, after=["missing"])], workers=[0], logger=logger)
+
+def test_run_per_worker():
+    rec = Recorder(fail={(2, "x")})
+    assert not run_per_worker("x", rec.stage("x"), range(3), logger)
+    assert rec.ran() == {(0, "x"), (1, "x"), (2, "x")}
+    assert run_per_worker("x", rec.stage("x"), [], logger)
@@ -0,0 +1,64 @@
+import os
+import json
+
+import pytest
+
+from jobman.data import DATA
+
+def files(n):
+    return [(f"f{k:02d}", f"gs://b/d/f{k:02d}", k, f"c{k}") for k in range(n)]
+
+def make_data(make_cfg, n_files=7, num_workers=3, **data):
+    d = DATA(make_cfg(tpu={"num_workers": num_workers}, data={"source": "gs://b/d", **data}))
+    d.files = files(n_files)
+    return d
+
+@pytest.mark.parametrize("shard", ["round_robin", "contiguous"])
+def test_shards_partition_the_files(make_cfg, shard):
+    d = make_data(make_cfg, shard=shard)
+    shards = [d.shard_files(i) for i in range(3)]
+    assert sorted(sum(shards, [])) == d.files
+    assert all(shards)
+
+def test_shard_assignment(make_cfg):
+    names = lambda d, i: [f[0] for f in d.shard_files(i)]
+    rr = make_data(make_cfg)
+    assert names(rr, 1) == ["f01", "f04"]
+    contiguous = make_data(make_cfg, shard="contiguous")
+    assert [len(contiguous.shard_files(i)) for i in range(3)] == [3, 3, 1]
+    assert names(contiguous, 1) == ["f03", "f04", "f05"]
+    everything = make_data(make_cfg, shard="all")
+    assert everything.shard_files(2) == everything.files
+
+def test_more_workers_than_files(make_cfg):
+    d = make_data(make_cfg, n_files=2, num_workers=4, shard="contiguous")
+    assert [len(d.shard_files(i)) for i in range(4)] == [1, 1, 0, 0]
+
+def test_invalid_shard_is_rejected(make_cfg):
+    with pytest.raises(ValueError):
+        make_data(make_cfg, shard="random")
+
+def test_volatile_local_dirs(make_cfg):
+    assert make_data(make_cfg).volatile
+    assert make_data(make_cfg, local_dir="/dev/shm/data").volatile
+    assert not make_data(make_cfg, local_dir="~/data").volatile
+
+def test_list_files_parses_the_listing(make_cfg, tmp_path, monkeypatch):
+    listing = [
+        {"name": "d/b/x.bin", "bucket": "b", "size": "10", "crc32c_hash": "AAA=="},
+        {"name": "d/a.bin", "bucket": "b", "size": "5", "md5_hash": "BBB=="},
+        {"name": "d/empty/", "bucket": "b", "size": "0"},
+        {"name": "d/c.bin", "bucket": "b"},
+    ]
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "gcloud").write_text(f"#!/bin/bash\ncat <<'EOF'\n{json.dumps(listing)}\nEOF\n")
+    (bin_dir / "gcloud").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    d = DATA(make_cfg(data={"source": "gs://b/d/"}))
+    assert d.list_files() == [
+        ("a.bin", "gs://b/d/a.bin", 5, "BBB=="),
+        ("b/x.bin", "gs://b/d/b/x.bin", 10, "AAA=="),
+        ("c.bin", "gs://b/d/c.bin", 0, "size:0"),
+    ]
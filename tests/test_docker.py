@@ -0,0 +1,42 @@
+import os
+import time
+import signal
+import subprocess
+
+from jobman.envs.docker import DOCKER
+
+def fake_bin(path, name, body):
+    f = path / name
+    f.write_text("#!/bin/bash\n" + body)
+    f.chmod(0o755)
+
+def test_persistent_exec_forwards_sigterm(tmp_path, make_cfg):
+    # `docker exec` runs the command right here, outside the caller's process group as containerd would
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake_bin(bin_dir, "sudo", 'exec "$@"\n')
+    fake_bin(bin_dir, "docker", '[ "$1" = exec ] && shift 2 && exec setsid "$@"\nexit 1\n')
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}")
+    docker = DOCKER(make_cfg(docker={"image": "img", "persistent": True}))
+
+    done = subprocess.run(["bash", "-c", docker.patch_command("echo hi; exit 7")], env=env, capture_output=True, text=True)
+    assert (done.returncode, done.stdout, done.stderr) == (7, "hi\n", "")
+
+    pid_file = tmp_path / "pid"
+    call = subprocess.Popen(["bash", "-c", docker.patch_command(f"echo \\$\\$ > {pid_file}; sleep 60")], env=env, start_new_session=True)
+    for _ in range(100):
+        if pid_file.exists() and pid_file.read_text().strip():
+            break
+        time.sleep(0.05)
+    pid = int(pid_file.read_text())
+    # What remote.KILL_SCRIPT does on cancel or timeout
+    os.killpg(call.pid, signal.SIGTERM)
+    assert call.wait(10) == 143
+    for _ in range(100):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        raise AssertionError("the command in the container survived the call")
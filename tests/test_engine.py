@@ -0,0 +1,94 @@
+import os
+import time
+import shlex
+import signal
+import threading
+import subprocess
+
+import pytest
+
+from jobman.engine import Engine
+from jobman.remote import WRAP_SCRIPT, KILL_SCRIPT
+
+def start(engine, argv, **kwargs):
+    """Run `argv` on `engine` in a thread; returns (thread, results list)."""
+    results = []
+    t = threading.Thread(target=lambda: results.append(engine.run(argv, **kwargs)))
+    t.start()
+    return t, results
+
+def wait_for(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_run_and_check():
+    engine = Engine()
+    result = engine.run(["bash", "-c", "echo out; echo err >&2"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert (result.returncode, result.stdout, result.stderr) == (0, "out\n", "err\n")
+    assert engine.run(["cat"], input="hi", stdout=subprocess.PIPE).stdout == "hi"
+    with pytest.raises(subprocess.CalledProcessError):
+        engine.run(["false"], check=True)
+
+def test_timeout_kills_the_call():
+    engine = Engine()
+    start_time = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        engine.run(["sleep", "10"], timeout=0.2)
+    assert time.monotonic() - start_time < 5
+    assert not engine.procs and not engine.calls
+
+def test_terminate_running_call_reports_sigterm():
+    engine = Engine()
+    # Exits 255 on SIGTERM like ssh does; still reported as terminated
+    t, results = start(engine, ["bash", "-c", "trap 'exit 255' TERM; sleep 30 & wait", "call-a"])
+    wait_for(lambda: engine.procs)
+    assert engine.terminate("call-a") == 1
+    t.join(5)
+    assert results[0].returncode == -signal.SIGTERM
+    assert engine.terminate("call-a") == 0
+
+def test_terminate_drops_queued_calls():
+    engine = Engine(max_concurrency=1)
+    t1, first = start(engine, ["bash", "-c", "sleep 30", "running"])
+    wait_for(lambda: engine.procs)
+    t2, queued = start(engine, ["bash", "-c", "sleep 30", "queued"])
+    wait_for(lambda: len(engine.calls) == 2)
+    assert engine.terminate("queued") == 1
+    t2.join(5)
+    assert queued[0].returncode == -signal.SIGTERM
+    # It never started a process
+    assert len(engine.procs) == 1
+    assert engine.terminate("running") == 1
+    t1.join(5)
+    assert first[0].returncode == -signal.SIGTERM
+
+def test_per_destination_limit():
+    engine = Engine(per_destination=1)
+    start_time = time.monotonic()
+    threads = [start(engine, ["sleep", "0.3"], dest=dest)[0] for dest in ("w0", "w0", "w1")]
+    for t in threads:
+        t.join(5)
+    elapsed = time.monotonic() - start_time
+    # The two calls to w0 take turns, w1 runs alongside them
+    assert 0.6 <= elapsed < 1.5
+
+def test_kill_script_stops_the_wrapped_command(tmp_path):
+    calls, pid_file = tmp_path / "calls", tmp_path / "pid"
+    wrapped = WRAP_SCRIPT.format(dir=calls, token="t1", command=shlex.quote(f"sleep 30 & echo $! > {pid_file}; wait"))
+    # The ssh session that ran it is gone; the command lives on until the kill script runs
+    call = subprocess.Popen(["bash", "-c", wrapped], start_new_session=True)
+    wait_for(lambda: pid_file.exists() and pid_file.read_text().strip() and (calls / "t1").exists())
+    sleeper = int(pid_file.read_text())
+    subprocess.run(["bash", "-c", KILL_SCRIPT.format(dir=calls, token="t1")], check=True)
+    assert call.wait(5) == 128 + signal.SIGTERM
+    def gone():
+        try:
+            os.kill(sleeper, 0)
+            with open(f"/proc/{sleeper}/stat") as f:
+                return f.read().split()[2] == "Z"
+        except (ProcessLookupError, FileNotFoundError):
+            return True
+    wait_for(gone)
+    assert not (calls / "t1").exists()
@@ -0,0 +1,73 @@
+import asyncio
+import subprocess
+
+from jobman import fingerprint as fp_module
+from jobman.fingerprint import fingerprint, StageMarkers
+
+class LocalRemote:
+    """Runs "remote" commands with bash on this host, with HOME pointed at a temp dir."""
+
+    def __init__(self, home, fail=()):
+        self.env = {"HOME": str(home), "PATH": "/usr/bin:/bin"}
+        self.fail = set(fail)
+
+    async def arun(self, i, cmd, stdout=None, stderr=None):
+        if i in self.fail:
+            raise RuntimeError("unreachable")
+        proc = await asyncio.create_subprocess_exec("bash", "-c", cmd, stdout=stdout, stderr=stderr, env=self.env)
+        out, _ = await proc.communicate()
+        return subprocess.CompletedProcess(cmd, proc.returncode, out.decode() if out else None)
+
+    def run(self, i, cmd, stdout=None, stderr=None):
+        return subprocess.run(["bash", "-c", cmd], stdout=stdout, stderr=stderr, env=self.env)
+
+class CannedRemote:
+    def __init__(self, stdout, returncode=0):
+        self.result = subprocess.CompletedProcess("", returncode, stdout)
+
+    async def arun(self, i, cmd, stdout=None, stderr=None):
+        return self.result
+
+def test_fingerprint_hashes_files_by_content(tmp_path):
+    f = tmp_path / "requirements.txt"
+    f.write_text("jax\n")
+    base = fingerprint("venv", f)
+    assert base == fingerprint("venv", f) and len(base) == 16
+    # A path string is just a string; the Path is read
+    assert base != fingerprint("venv", str(f))
+    f.write_text("jax==0.4.30\n")
+    assert fingerprint("venv", f) != base
+
+def test_fingerprint_separates_parts():
+    assert fingerprint("ab", "c") != fingerprint("a", "bc")
+    assert fingerprint("a", "b") != fingerprint("b", "a")
+    assert fingerprint("docker", "img", None) != fingerprint("docker", "img", "")
+
+def test_markers_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setattr(fp_module, "MEM_DIR", str(tmp_path / "shm"))
+    markers = StageMarkers(LocalRemote(tmp_path / "home", fail={2}))
+    assert markers.write(0, "docker", "aaaa")
+    assert markers.write(0, "gcsfuse", "bbbb", volatile=True)
+    assert markers.write(0, "docker", "cccc")
+    # An unreachable worker has no markers rather than failing the read
+    assert markers.read_all([0, 2]) == {0: {("docker", False): "cccc", ("gcsfuse", True): "bbbb"}, 2: {}}
+
+def test_markers_parsing_ignores_junk():
+    home = "/home/u/.jobman/stages"
+    out = f"{home} docker aaaa\n{fp_module.MEM_DIR} gcsfuse bbbb\n{home} broken\n\n{home} venv with spaces\n"
+    assert StageMarkers(CannedRemote(out)).read_all([0]) == {0: {("docker", False): "aaaa", ("gcsfuse", True): "bbbb"}}
+    assert StageMarkers(CannedRemote(out, returncode=255)).read_all([0]) == {0: {}}
+
+def test_docker_fingerprint_follows_the_digest(make_cfg):
+    from jobman.envs.docker import DOCKER
+    a = DOCKER(make_cfg(docker={"image": "repo/img@sha256:" + "a" * 64}))
+    b = DOCKER(make_cfg(docker={"image": "repo/img@sha256:" + "b" * 64}))
+    assert a.digest() == "sha256:" + "a" * 64
+    assert a.pinned() == "jobman-pinned:" + "a" * 16
+    assert a.fingerprint() != b.fingerprint()
+    # A moved tag changes the fingerprint even though the reference is the same
+    c = DOCKER(make_cfg(docker={"image": "repo/img:latest"}))
+    c.resolved = "sha256:" + "c" * 64
+    d = DOCKER(make_cfg(docker={"image": "repo/img:latest"}))
+    d.resolved = "sha256:" + "d" * 64
+    assert c.fingerprint() != d.fingerprint()
@@ -0,0 +1,75 @@
+import os
+import threading
+import subprocess
+
+import pytest
+
+from jobman.gcloud import GCloud, command_verb, summarize_ledger
+
+@pytest.fixture
+def fake_gcloud(tmp_path, monkeypatch):
+    """A `gcloud` on PATH that logs each call; `describe` is slow so concurrent calls overlap."""
+    calls = tmp_path / "calls"
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "gcloud"
+    script.write_text(
+        "#!/bin/bash\n"
+        f'echo "$*" >> {calls}\n'
+        'case "$*" in *describe*) sleep 0.3;; esac\n'
+        'case "$*" in *missing*) echo "not found" >&2; exit 1;; esac\n'
+        'echo "out $*"\n'
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    return lambda: calls.read_text().splitlines() if calls.exists() else []
+
+@pytest.fixture
+def gc(tmp_path):
+    g = GCloud(ttl=60)
+    g.set_ledger_file(tmp_path / "ledger.jsonl")
+    return g
+
+DESCRIBE = ["gcloud", "compute", "tpus", "tpu-vm", "describe", "tpu-a", "--zone=z"]
+
+def test_command_verb():
+    assert command_verb(DESCRIBE) == "describe"
+    assert command_verb(["gcloud", "compute", "tpus", "tpu-vm", "create", "tpu-a", "--format", "list"]) == "create"
+    assert command_verb(["gcloud", "storage", "cp", "a", "b"]) is None
+
+def test_concurrent_reads_are_coalesced(fake_gcloud, gc, tmp_path):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gc.run(DESCRIBE, stdout=subprocess.PIPE))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(fake_gcloud()) == 1
+    assert {r.stdout for r in results} == {"out " + " ".join(DESCRIBE[1:]) + "\n"}
+    [row] = summarize_ledger(tmp_path / "ledger.jsonl")
+    assert row[:6] == ["compute tpus tpu-vm describe", 5, 1, 0, 4, 0]
+
+def test_reads_are_cached_until_a_write(fake_gcloud, gc):
+    gc.run(DESCRIBE, stdout=subprocess.PIPE)
+    assert gc.run(DESCRIBE, stdout=subprocess.PIPE).returncode == 0
+    assert len(fake_gcloud()) == 1
+    # A caller that needs fresher state than the cache gets a new call
+    gc.run(DESCRIBE, stdout=subprocess.PIPE, max_age=0)
+    assert len(fake_gcloud()) == 2
+    gc.run(["gcloud", "compute", "tpus", "tpu-vm", "delete", "tpu-b", "--zone=z"], stdout=subprocess.PIPE)
+    gc.run(DESCRIBE, stdout=subprocess.PIPE)
+    assert len(fake_gcloud()) == 4
+
+def test_failed_reads_are_not_cached(fake_gcloud, gc):
+    argv = ["gcloud", "compute", "tpus", "tpu-vm", "list", "--zone=missing"]
+    assert gc.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode == 1
+    with pytest.raises(subprocess.CalledProcessError):
+        gc.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert len(fake_gcloud()) == 2
+
+def test_ledger_files_filter_by_match(fake_gcloud, tmp_path):
+    g = GCloud()
+    g.set_ledger_file(tmp_path / "a.jsonl", match="tpu-a")
+    g.run(DESCRIBE, stdout=subprocess.PIPE)
+    g.run(["gcloud", "storage", "ls", "gs://b"], stdout=subprocess.PIPE)
+    assert [r[0] for r in summarize_ledger(tmp_path / "a.jsonl")] == ["compute tpus tpu-vm describe"]
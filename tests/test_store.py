@@ -0,0 +1,110 @@
+import json
+import threading
+
+import pytest
+
+from jobman.store import JobStore
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(tmp_path / "jobs.db")
+
+def test_create_job_allocates_sequential_ids(store):
+    job_id, meta = store.create_job(lambda job_id: {"job_dir": f"jobs/u/{job_id}"})
+    assert (job_id, meta) == ("000001", {"job_id": "000001", "job_dir": "jobs/u/000001"})
+    assert store.create_job(lambda job_id: {})[0] == "000002"
+    assert [m["job_id"] for m in store.list_jobs()] == ["000001", "000002"]
+
+def test_concurrent_creates_get_unique_ids(tmp_path):
+    ids = []
+    def create():
+        # One store per thread, like separate jobman processes
+        for _ in range(10):
+            ids.append(JobStore(tmp_path / "jobs.db").create_job(lambda job_id: {})[0])
+    threads = [threading.Thread(target=create) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(ids) == [f"{i:06d}" for i in range(1, 41)]
+
+def test_failed_transaction_rolls_back(store):
+    def build(job_id):
+        raise RuntimeError("boom")
+    with pytest.raises(RuntimeError):
+        store.create_job(build)
+    assert store.list_jobs() == []
+    # The counter was rolled back with the row
+    assert store.create_job(lambda job_id: {})[0] == "000001"
+
+def test_update_and_remove_job(store):
+    job_id, _ = store.create_job(lambda job_id: {"status": "CREATED"})
+    assert store.update_job(job_id, status="RUNNING", backend="daemon")["status"] == "RUNNING"
+    assert store.get_job(job_id) == {"job_id": job_id, "status": "RUNNING", "backend": "daemon"}
+    assert store.remove_job(job_id)
+    assert not store.remove_job(job_id)
+    assert store.get_job(job_id) is None
+
+def test_migrate_legacy_files(store, tmp_path):
+    meta_file, cntr_file = tmp_path / "meta.json", tmp_path / "next_job_id.txt"
+    meta_file.write_text(json.dumps({
+        "job_000003": {"job_id": "000003", "status": "FINISHED"},
+        "job_000007": {"status": "RUNNING"},
+    }))
+    cntr_file.write_text("7")
+
+    assert store.migrate_legacy(meta_file, cntr_file)
+    assert store.get_job("000003")["status"] == "FINISHED"
+    assert store.get_job("000007") == {"status": "RUNNING"}
+    assert store.create_job(lambda job_id: {})[0] == "000008"
+    # Renamed, so the import never runs twice
+    assert not meta_file.exists() and (tmp_path / "meta.json.migrated").exists()
+    assert not store.migrate_legacy(meta_file, cntr_file)
+
+def test_migrate_legacy_keeps_newer_counter(store, tmp_path):
+    for _ in range(5):
+        store.create_job(lambda job_id: {})
+    cntr_file = tmp_path / "next_job_id.txt"
+    cntr_file.write_text("2")
+    assert store.migrate_legacy(tmp_path / "meta.json", cntr_file)
+    assert store.create_job(lambda job_id: {})[0] == "000006"
+
+def put_idle(store, name="tpu-a", zone="z", expires_at=100.0):
+    store.put_slice(name, zone, "v4-16", "tpu-ubuntu2204-base", "spot", owner=None, expires_at=expires_at)
+
+def test_reclaim_idle_slice(store):
+    put_idle(store)
+    before, taken = store.reclaim_slice("tpu-a", "z", "000001", now=50.0)
+    assert taken and before["owner"] is None
+    assert store.get_slice("tpu-a", "z")["owner"] == "000001"
+    assert store.get_slice("tpu-a", "z")["expires_at"] is None
+    # Reclaiming again as the same owner is a no-op success
+    assert store.reclaim_slice("tpu-a", "z", "000001", now=60.0)[1]
+
+def test_reclaim_refuses_expired_or_owned_slices(store):
+    put_idle(store, expires_at=100.0)
+    assert store.reclaim_slice("tpu-a", "z", "000001", now=150.0) == (store.get_slice("tpu-a", "z"), False)
+    store.set_slice_owner("tpu-a", "z", "000002")
+    before, taken = store.reclaim_slice("tpu-a", "z", "000001", now=50.0)
+    assert not taken and before["owner"] == "000002"
+    assert store.get_slice("tpu-a", "z")["owner"] == "000002"
+    assert store.reclaim_slice("tpu-b", "z", "000001", now=50.0) == (None, False)
+
+def test_reclaim_and_lease_race_has_one_winner(store):
+    put_idle(store)
+    key = {"zone": "z", "accelerator": "v4-16", "version": "tpu-ubuntu2204-base", "pricing": "spot"}
+    assert store.lease_slice([key], "000002", now=50.0)["name"] == "tpu-a"
+    assert store.reclaim_slice("tpu-a", "z", "000001", now=50.0)[1] is False
+    assert store.lease_slice([key], "000003", now=50.0) is None
+
+def test_pool_reclaim_renames_a_job_that_lost_its_slice(store, make_cfg):
+    from jobman.pool import WarmPool
+    pool = WarmPool(store)
+    cfg = make_cfg(tpu={"name": "tpu-a", "zone": "z", "ips": [{"worker": 0}]})
+    put_idle(store, expires_at=float("inf"))
+    assert not pool.reclaim(cfg, "000001")
+    assert cfg.tpu.name == "tpu-a"
+
+    store.set_slice_owner("tpu-a", "z", "000002")
+    assert pool.reclaim(cfg, "000001")
+    assert (cfg.tpu.name, list(cfg.tpu.ips)) == ("tpu-a-j000001", [])
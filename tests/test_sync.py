@@ -0,0 +1,93 @@
+import io
+import json
+import base64
+import asyncio
+import tarfile
+import subprocess
+
+from jobman.sync import SYNC, MANIFEST, DELETED
+
+class LocalRemote:
+    """Runs each worker's commands with bash on this host, in its own HOME."""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.calls = []
+
+    async def arun(self, i, cmd, check=False, input=None, stdout=None, stderr=None):
+        self.calls.append(i)
+        home = self.tmp_path / f"worker{i}"
+        home.mkdir(exist_ok=True)
+        proc = await asyncio.create_subprocess_exec(
+            "bash", "-c", cmd, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr,
+            env={"HOME": str(home), "PATH": "/usr/bin:/bin"},
+        )
+        out, err = await proc.communicate(input.encode() if input else None)
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, out, err)
+        return subprocess.CompletedProcess(cmd, proc.returncode, out.decode() if out else None)
+
+def unpack(delta):
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(delta)), mode="r:gz") as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+
+def make_sync(make_cfg, tmp_path):
+    sync = SYNC(make_cfg())
+    sync.remote = LocalRemote(tmp_path)
+    return sync
+
+def test_delta_sends_only_changes(make_cfg, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "same.py").write_text("same\n")
+    (src / "edited.py").write_text("new\n")
+    (src / "added.py").write_text("added\n")
+    sync = make_sync(make_cfg, tmp_path)
+    local = sync.manifest(src)
+    remote = {"same.py": local["same.py"], "edited.py": "0" * 16, "gone.py": "1" * 16, "also gone.py": "2" * 16}
+
+    delta, changed, deleted, size = sync._delta(src, local, remote)
+    assert (changed, deleted) == (2, 2)
+    files = unpack(delta)
+    assert list(files) == ["added.py", "edited.py", DELETED, MANIFEST]
+    assert files[DELETED].split(b"\0") == [b"gone.py", b"also gone.py"]
+    assert json.loads(files[MANIFEST]) == local
+    assert size == len(base64.b64decode(delta))
+
+def test_delta_is_reproducible(make_cfg, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.py").write_text("a\n")
+    sync = make_sync(make_cfg, tmp_path)
+    local = sync.manifest(src)
+    assert sync._delta(src, local, {}) == sync._delta(src, local, {})
+    # Nothing changed: only the manifest travels
+    _, changed, deleted, _ = sync._delta(src, local, local)
+    assert (changed, deleted) == (0, 0)
+
+def test_sync_roundtrip(make_cfg, tmp_path):
+    src = tmp_path / "src"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg" / "a.py").write_text("a\n")
+    (src / "b.py").write_text("b\n")
+    sync = make_sync(make_cfg, tmp_path)
+
+    counts = lambda stats: {i: s[:2] for i, s in stats.items()}
+    assert counts(sync.sync(src, "~/code")) == {0: (2, 0), 1: (2, 0)}
+    for i in (0, 1):
+        dest = tmp_path / f"worker{i}" / "code"
+        assert (dest / "pkg" / "a.py").read_text() == "a\n"
+        assert not (dest / DELETED).exists()
+
+    # An unchanged tree sends nothing
+    assert sync.sync(src, "~/code") == {0: (0, 0, 0), 1: (0, 0, 0)}
+
+    (src / "b.py").unlink()
+    (src / "pkg" / "a.py").write_text("a2\n")
+    # Worker 1 fell behind: it gets its own delta
+    (tmp_path / "worker1" / "code" / MANIFEST).write_text("{}")
+    assert counts(sync.sync(src, "~/code")) == {0: (1, 1), 1: (1, 0)}
+    for i in (0, 1):
+        dest = tmp_path / f"worker{i}" / "code"
+        assert (dest / "pkg" / "a.py").read_text() == "a2\n"
+    assert not (tmp_path / "worker0" / "code" / "b.py").exists()